@@ -28,13 +28,68 @@ from psycopg2.extensions import AsIs
 import os
 import datetime
 import numpy
-import scipy.stats as stats
 import glob
 import getpass
 import logging
 import sys
 import pandas as pd
 import math
+import collections
+
+import Util
+
+# The tblmetadata columns filled for each sattype, geom is made from the geom (wkt)
+    # and geoptsSRID fields of the metadata
+rsat_meta_columns = ('acDOY', 'geom', 'acDateTime', 'antennaPointing', 'beam', 'beams', 'bitsPerSample',
+    'notes', 'copyright', 'dimgname', 'freqSAR', 'granule', 'lineSpacing', 'looks_Az', 'looks_Rg',
+    'lutApplied', 'n_bands', 'n_beams', 'n_cols', 'n_geopts', 'n_rows', 'orbit', 'order_Az', 'order_Rg',
+    'passDirection', 'pixelSpacing', 'polarization', 'processingFacility', 'productType',
+    'satellite', 'sattype', 'theta_far', 'theta_near', 'sat_heading', 'location')
+
+s1_meta_columns = ('acDOY', 'geom', 'acDateTime', 'beam', 'bitsPerSample',
+    'notes', 'copyright', 'dimgname', 'granule', 'lineSpacing', 'n_bands', 'n_cols', 'n_geopts', 'n_rows',
+    'passDirection', 'pixelSpacing', 'polarization',
+    'satellite', 'sattype', 'location')
+
+meta_columns = {
+    'RSAT1' : rsat_meta_columns,
+    'RSAT2' : rsat_meta_columns,
+    'RS2' : rsat_meta_columns,
+    'SEN-1' : s1_meta_columns,
+    }
+
+def metaValues(columns, named=True):
+    """
+    The VALUES row of an insert into tblmetadata, with a placeholder for each column
+    
+    **Parameters**
+    
+        *columns* : tblmetadata columns (see meta_columns)
+
+        *named*   : placeholders for a dict (%(column)s), otherwise for a tuple (%s, see 
+                    Metadata.MetaRecord.row)
+    """
+
+    values = []
+    for column in columns:
+        if column == 'geom':
+            values.append('ST_GeomFromText(%(geom)s, %(geoptsSRID)s)' if named else 'ST_GeomFromText(%s, %s)')
+        else:
+            values.append('%(' + column + ')s' if named else '%s')
+    return '(' + ', '.join(values) + ')'
+
+def metaInsertSql(table, columns):
+    """
+    Insert one image's metadata into a metadata table
+    
+    **Parameters**
+    
+        *table*   : name of the metadata table
+
+        *columns* : tblmetadata columns (see meta_columns)
+    """
+
+    return 'INSERT INTO ' + table + ' (' + ', '.join(columns) + ') VALUES ' + metaValues(columns)
 
 class Database:
     """
@@ -115,33 +170,8 @@ class Database:
         sqlDel = '''DELETE FROM ''' + self.table_to_query + ''' WHERE dimgname = %(dimgname)s'''
 
         #upload the data
-        if metaDict['sattype'] == 'RSAT1' or metaDict['sattype'] == 'RSAT2'or metaDict['sattype'] == 'RS2':
-            sqlIns = '''INSERT INTO ''' + self.table_to_query + ''' 
-            (acDOY, geom, acDateTime, antennaPointing, beam, beams, bitsPerSample, 
-            notes, copyright, dimgname, freqSAR, granule, lineSpacing, looks_Az, looks_Rg, 
-            lutApplied, n_bands, n_beams, n_cols, n_geopts, n_rows, orbit, order_Az, order_Rg, 
-            passDirection, pixelSpacing, polarization, processingFacility, productType,
-            satellite, sattype, theta_far, theta_near, sat_heading, location) 
-            VALUES ( 
-            %(acDOY)s, ST_GeomFromText(%(geom)s, %(geoptsSRID)s), %(acDateTime)s, %(antennaPointing)s, %(beam)s, %(beams)s, %(bitsPerSample)s,
-            %(notes)s, %(copyright)s, %(dimgname)s, %(freqSAR)s, %(granule)s, %(lineSpacing)s, %(looks_Az)s, %(looks_Rg)s, 
-            %(lutApplied)s, %(n_bands)s, %(n_beams)s, %(n_cols)s, %(n_geopts)s, %(n_rows)s, %(orbit)s, %(order_Az)s, %(order_Rg)s, 
-            %(passDirection)s, %(pixelSpacing)s, %(polarization)s, %(processingFacility)s, %(productType)s,
-            %(satellite)s, %(sattype)s, %(theta_far)s, %(theta_near)s, %(sat_heading)s, %(location)s
-            )'''
-        
-        elif metaDict['sattype'] == 'SEN-1':
-            sqlIns = '''INSERT INTO ''' + self.table_to_query + ''' 
-            (acDOY, geom, acDateTime, beam, bitsPerSample, 
-            notes, copyright, dimgname, granule, lineSpacing, n_bands, n_cols, n_geopts, n_rows, 
-            passDirection, pixelSpacing, polarization,
-            satellite, sattype, location) 
-            VALUES ( 
-            %(acDOY)s, ST_GeomFromText(%(geom)s, %(geoptsSRID)s), %(acDateTime)s, %(beam)s, %(bitsPerSample)s,
-            %(notes)s, %(copyright)s, %(dimgname)s, %(granule)s, %(lineSpacing)s, %(n_bands)s, %(n_cols)s, %(n_geopts)s, %(n_rows)s, 
-            %(passDirection)s, %(pixelSpacing)s, %(polarization)s,
-            %(satellite)s, %(sattype)s, %(location)s
-            )'''
+        if metaDict['sattype'] in meta_columns:
+            sqlIns = metaInsertSql(self.table_to_query, meta_columns[metaDict['sattype']])
             
         else:
             print("Warning! Satellite type {} not supported in the mode.".format(self.metaDict.sattype))
@@ -163,6 +193,52 @@ class Database:
         self.logger.info("dimgname:    " + metaDict['dimgname'] )
         self.logger.info("[Succesfuly added "+ metaDict['dimgname'] + " metadata into " + self.table_to_query + ".]" )
 
+    #DATABASE UTILITY FUNCTION
+    def metaBatch2db(self, records, pageSize=1000):
+        """
+        Uploads the metadata of many images at once, as meta2db does for one: records 
+        with the same dimgname (or granule) are replaced. One delete and a multi-row 
+        insert per satellite type, committed together, so use batches of a few hundred 
+        to a few thousand images.
+        
+        **Parameters**
+        
+            *records*  : list of Metadata.MetaRecord (Metadata.createRecord)
+
+            *pageSize* : rows sent per INSERT statement
+
+        **Returns**
+
+            *skipped*  : dimgnames that were not uploaded (satellite type not supported)
+        """
+
+        rows = collections.OrderedDict()   # the last of a dimgname wins (the archive has duplicates)
+        skipped = []
+        for record in records:
+            if record.sattype in meta_columns:
+                rows[record.dimgname] = record
+            else:
+                skipped.append(record.dimgname)
+                self.logger.error("Satellite type %s not supported, %s skipped", record.sattype, record.dimgname)
+
+        if len(rows) == 0:
+            return skipped
+
+        sqlDel = 'DELETE FROM ' + self.table_to_query + ' WHERE dimgname = ANY(%s) OR granule = ANY(%s)'
+
+        curs = self.connection.cursor()
+        curs.execute(sqlDel, (list(rows.keys()), [record.granule for record in rows.values()]))
+        for columns in set(meta_columns.values()):
+            batch = [record.row(columns) for record in rows.values() if meta_columns[record.sattype] == columns]
+            if len(batch) > 0:
+                sqlIns = 'INSERT INTO ' + self.table_to_query + ' (' + ', '.join(columns) + ') VALUES %s'
+                psycopg2.extras.execute_values(curs, sqlIns, batch, template=metaValues(columns, named=False), 
+                                               page_size=pageSize)
+        self.connection.commit()
+
+        self.logger.info("[Succesfuly added %i images' metadata into %s.]", len(rows), self.table_to_query)
+        return skipped
+
     #DATABASE UTILITY FUNCTION    
     def createTblMetadata(self):
         """
@@ -851,22 +927,23 @@ class Database:
         """
         noDataVal = 0
 
-        polyData = imgData[numpy.where( imgData != noDataVal )]
+        polyData = Util.validValues(imgData, noDataVal)
+        polyStats = Util.validStats(polyData)
         
         upload = {
             'granule' : granule,
             'bandname' : bandName,
             'inst' : inst,
             'dimgname' : dimgname,
-            'mean' : str(polyData.mean()),  # convert real or get can't adapt error
-            'var' :  str(polyData.var()),
-            'maxdata' : str(polyData.max()), 
-            'mindata' : str(polyData.min()),
-            'median' : str(numpy.median(polyData)),
-            'quart1' : str(stats.scoreatpercentile(polyData, 25)),
-            'quart3' : str(stats.scoreatpercentile(polyData, 75)),
-            'skew' : str(stats.skew(polyData, None)),
-            'kurtosis' : str(stats.kurtosis(polyData, None))
+            'mean' : str(polyStats['mean']),  # convert real or get can't adapt error
+            'var' :  str(polyStats['var']),
+            'maxdata' : str(polyStats['max']), 
+            'mindata' : str(polyStats['min']),
+            'median' : str(polyStats['median']),
+            'quart1' : str(polyStats['quart1']),
+            'quart3' : str(polyStats['quart3']),
+            'skew' : str(polyStats['skew']),
+            'kurtosis' : str(polyStats['kurtosis'])
             }
 
         curs = self.connection.cursor()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+**Geometry.py**
+
+This module contains the SAR range geometry used by Metadata: the slant range of
+each column from the ground to slant range (SRGR) polynomial, the ground range and
+the incidence angle. Everything works on whole numpy arrays, a vector for a scene
+or a grid (lines x columns) when the SRGR coefficients change along the image.
+
+**Common Parameters of this Module:**
+
+*gsr* : ground to slant range coefficients, a list of 6 floats (or an array, one row per set)
+
+*pixelSpacing* : the image resolution in range (m)
+
+*n_cols* : how many pixels in range
+
+*order_Rg* : pixel time ordering, increasing or decreasing (the vectors are flipped)
+
+*radius* : earth radius (m), see earthRadius
+
+*sat_alt* : satellite altitude (m)
+"""
+
+import numpy
+
+D2R = numpy.pi / 180.0
+
+
+def earthRadius(ellip_maj, ellip_min, plat_lat):
+    """
+    Calculates the earth radius at the latitude of the satellite from the ellipsoid params
+
+    **Parameters**
+
+        *ellip_maj* : semi-major axis of the ellipsoid
+
+        *ellip_min* : semi-minor axis of the ellipsoid
+
+        *plat_lat*  : latitude (degrees), a value or an array
+    """
+
+    ellip_maj = float(ellip_maj)
+    ellip_min = float(ellip_min)
+    tan2 = numpy.tan(numpy.asarray(plat_lat, dtype=numpy.float64) * D2R) ** 2
+    return ellip_min * numpy.sqrt(1 + tan2) / numpy.sqrt((ellip_min / ellip_maj) ** 2 + tan2)
+
+
+def groundDistance(pixelSpacing, n_cols, groundRangeOrigin=0.0):
+    """
+    Ground range of each column from the SRGR origin
+
+    **Parameters**
+
+        *groundRangeOrigin* : a value, or an array (one per SRGR set) to get one row per set
+    """
+
+    ground = pixelSpacing * numpy.arange(n_cols, dtype=numpy.float64)
+    origin = numpy.asarray(groundRangeOrigin, dtype=numpy.float64)
+    if origin.ndim == 0:
+        return ground - origin
+    return ground[numpy.newaxis, :] - origin[:, numpy.newaxis]
+
+
+def evalSRGR(gsr, ground):
+    """
+    Evaluates the ground to slant range polynomial(s) with Horner's method
+
+    **Parameters**
+
+        *gsr*    : 6 coefficients, or an array with a row of coefficients for each row of ground
+
+        *ground* : ground range vector (or array, see groundDistance)
+    """
+
+    gsr = numpy.asarray(gsr, dtype=numpy.float64)
+    if gsr.ndim == 1:
+        return numpy.polynomial.polynomial.polyval(ground, gsr)
+
+    slantRange = numpy.empty_like(ground)
+    slantRange[...] = gsr[:, -1:]
+    for k in range(gsr.shape[1] - 2, -1, -1):
+        slantRange *= ground
+        slantRange += gsr[:, k:k+1]
+    return slantRange
+
+
+def slantRange(gsr, pixelSpacing, n_cols, order_Rg, groundRangeOrigin=0.0):
+    """
+    Slant range of each column (float32), valid for SLC as well as SGF
+
+    **Parameters**
+
+        *groundRangeOrigin* : for RSat2 (seems to be zero always)
+    """
+
+    ground = groundDistance(pixelSpacing, n_cols, groundRangeOrigin)
+    vector = evalSRGR(gsr, ground).astype(numpy.float32)
+
+    if order_Rg.lower() == 'decreasing':  #see Altrix doc (applies to all SAR sats - I think)
+        vector = vector[::-1].copy()
+    return vector
+
+
+def slantRangeGrid(gsr, origins, setLines, lines, pixelSpacing, n_cols, order_Rg):
+    """
+    Slant range of each column for the lines given (float32, lines x columns) when there is
+    a set of SRGR coefficients for several times along the image. The slant range is
+    linear between the sets and held constant before the first and after the last one.
+
+    **Parameters**
+
+        *gsr*      : array of SRGR coefficients, one row per set
+
+        *origins*  : ground range origin of each set
+
+        *setLines* : the (fractional) line of each set
+
+        *lines*    : the lines wanted
+    """
+
+    gsr = numpy.atleast_2d(numpy.asarray(gsr, dtype=numpy.float64))
+    setLines = numpy.atleast_1d(numpy.asarray(setLines, dtype=numpy.float64))
+    lines = numpy.atleast_1d(numpy.asarray(lines, dtype=numpy.float64))
+
+    order = numpy.argsort(setLines)    # the sets are in time order, lines may run the other way
+    setLines = setLines[order]
+    sets = evalSRGR(gsr[order], groundDistance(pixelSpacing, n_cols, numpy.asarray(origins)[order]))
+
+    if len(setLines) == 1:
+        grid = numpy.repeat(sets, len(lines), axis=0)
+    else:
+        upper = numpy.searchsorted(setLines, lines).clip(1, len(setLines) - 1)
+        lower = upper - 1
+        weight = (lines - setLines[lower]) / (setLines[upper] - setLines[lower])
+        weight = weight.clip(0, 1)[:, numpy.newaxis]
+        grid = sets[lower] * (1 - weight) + sets[upper] * weight
+
+    grid = grid.astype(numpy.float32)
+    if order_Rg.lower() == 'decreasing':
+        grid = grid[:, ::-1].copy()
+    return grid
+
+
+def groundRange(slantRange, radius, sat_alt):
+    """
+    Finds the ground range from nadir which corresponds to a given slant range
+    must be an slc image, must have calculated the slantRange first
+
+    **Parameters**
+
+        *slantRange* : a value, vector or grid
+    """
+
+    r, R, A = numpy.asarray(slantRange, dtype=numpy.float64), radius, sat_alt
+    numer = A*A + 2*A*R + 2*R*R - r*r
+    denom = 2*A*R + 2*R*R
+    return R*numpy.arccos(numer/denom)
+
+
+def incidenceAngle(slantRange, radius, sat_alt):
+    """
+    Incidence angle (radians, float32) at each slant range
+
+    **Parameters**
+
+        *slantRange* : a vector or grid
+    """
+
+    RS = numpy.asarray(slantRange, dtype=numpy.float64)
+    r, h = radius, sat_alt
+    theta = numpy.arccos((h ** 2 - RS ** 2 + 2 * r * h) / (2 * RS * r))
+    return theta.astype(numpy.float32)
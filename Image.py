@@ -37,10 +37,15 @@ import logging
 import shlex
         
 import gc
+import collections
+import concurrent.futures
+from xml.etree import ElementTree
 
 from configparser import ConfigParser
 
 from osgeo import gdal
+from osgeo import osr
+from osgeo import ogr
 from osgeo.gdalconst import *
 from osgeo import gdal_array
 
@@ -60,14 +65,49 @@ class Image(object):
 
             *meta*      : reference to the meta class
 
-            *imgType*   : amp, sigma, beta or gamma
+            *imgType*   : amp, sigma, noise, theta or phase - or a list of these (or a space/comma 
+                          separated string) to produce several products from one read of the raw data. 
+                          Quad pol scenes can also have span, the total power of the Pauli decomposition
 
             *imgFormat* : gdal format code gtiff, vrt
 
             *zipname*  
+
+            *bandMath*  : expressions to evaluate on the calibrated chunks (see Util.parseBandMath) 
+                          eg. 'ratio = sigma_HH/sigma_HV; sigma_HH_dB = 10*log10(sigma_HH)'
+
+            *encoding*  : compact encoding for sigma products: db16, float16 or zstd (see sigmaEncoding)
+
+            *discardLSB*: number of mantissa bits to drop with the zstd encoding (precision truncation)
+
+            *multilook* : azimuth and range looks to block average by as the image is written (eg. '4 4')
+
+            *stretch*   : stretch to make a byte version of each product with, from the histograms
+                          collected by imgWrite: 'std 3', 'min-max' or 'percentile 2 98'
+
+            *stretchFormat* : vrt to make the stretched products as VRT views of the calibrated 
+                          products (see stretchVRT) rather than byte copies
+
+            *dem*       : DEM raster (in projDir) to take the terrain height of each GCP from 
+                          (see correct_known_elevation)
+
+            *memLimit*  : intermediate files up to this size (MB) are kept in memory (/vsimem/) 
+                          rather than written to tmpDir (see Util.intermediatePath)
+
+            *tmpBudget* : most intermediates (MB) allowed on disk in tmpDir at once, writing more 
+                          fails (see Util.ArtifactRegistry)
+
+            *speckle*   : speckle filter for sigma products, applied as they are written: 
+                          'boxcar 5', 'lee 5 1' or 'refinedlee 7 1' (filter, window size, looks)
     """
 
-    def __init__(self, fname, path, meta, imgType, imgFormat, zipname, imgDir, tmpDir, projDir, loghandler = None, eCorr = None, initOnly=False):
+    dBScale = 0.01     # dB per count of the db16 encoding
+    dBOffset = -100.0  # dB at count 0 (so that 0 can stay nodata)
+    demHeightCache = {}  # (dimgname, dem): tie point heights sampled from the DEM
+    windowBlock = 256    # lines per calibrated block kept for readWindow
+    windowBlocks = 16    # calibrated blocks kept (least recently used are dropped)
+
+    def __init__(self, fname, path, meta, imgType, imgFormat, zipname, imgDir, tmpDir, projDir, loghandler = None, eCorr = None, initOnly=False, bandMath=None, encoding=None, discardLSB=None, multilook=None, stretch=None, stretchFormat=None, dem=None, memLimit=None, tmpBudget=None, speckle=None):
 
         self.status = "ok"  ### For testing
         self.tifname = ""   ### For testing
@@ -87,12 +127,40 @@ class Image(object):
         self.fname = fname # the filename to open
         self.path = path
         self.meta = meta
-        self.imgType = imgType
+        if isinstance(imgType, str):
+            imgType = imgType.replace(',', ' ').split()
+        self.imgTypes = list(imgType)   # all the products to make
+        self.imgType = self.imgTypes[0] # the product currently being worked on
+        self.productFiles = {}          # imgType: file written by imgWrite
+        self.productBandNames = {}      # imgType: band names of that file
         self.imgFormat = imgFormat
-        self.FileNames = [os.path.splitext(zipname)[0]] # list of all generated files
+        budget = int(float(tmpBudget) * 2**20) if tmpBudget else 0
+        self.artifacts = Util.ArtifactRegistry(os.path.splitext(zipname)[0], budget, self.logger) # all generated files
         self.proj = 'nil' # initialize to nil (then change as appropriate)
         self.projdir = projDir
         self.elevationCorrection = eCorr
+        self.dem = dem if dem else None  # DEM file for per GCP heights
+        self.memLimit = int(float(memLimit) * 2**20) if memLimit else 0  # bytes, 0 = all on disk
+        if isinstance(bandMath, str):
+            bandMath = Util.parseBandMath(bandMath)
+        self.bandMath = bandMath    # list of (name, expression) or None
+        if encoding is not None and encoding.lower() in ['', 'float32']:
+            encoding = None
+        self.encoding = encoding    # None for plain Float32 sigma
+        self.discardLSB = discardLSB
+        if isinstance(multilook, str):
+            multilook = multilook.replace(',', ' ').replace('x', ' ').split()
+        if multilook:
+            multilook = (int(multilook[0]), int(multilook[-1]))  # one value = same in both directions
+            if multilook == (1, 1):
+                multilook = None
+        self.looks = multilook      # (azimuth, range) looks or None
+        self.stretch = parseStretch(stretch)  # applyStretch keywords or None
+        self.stretchFormat = (stretchFormat or 'gtiff').lower()
+        self.speckle = parseSpeckle(speckle)  # (filter, size, looks) or None
+        self.histograms = {}        # imgType: histograms and moments of the bands written (see accumulateHist)
+        self.blockCache = collections.OrderedDict()  # (imgType, band, block): calibrated lines (see readWindow)
+        self.gcpTransformer = None  # georeferenced to pixel/line coordinates of the raw data
             
         # if values might change make a local copy
         try:
@@ -119,26 +187,42 @@ class Image(object):
         if not initOnly:
             self.openDataset(self.fname, self.path)
 
-            if self.imgType == 'amp' and 'Q' in self.meta.beam:  # this would be a quad pol scene...
-                self.decomp(format='GTiff')
-            elif self.sattype == 'ASF_CEOS':
+            imgTypes = list(self.imgTypes)
+            if 'Q' in self.meta.beam and ('amp' in imgTypes or 'span' in imgTypes):  # this would be a quad pol scene...
+                self.decomp(format='GTiff', power='span' in imgTypes)
+                imgTypes = [imgType for imgType in imgTypes if imgType not in ['amp', 'span']]
+            elif 'span' in imgTypes:
+                self.logger.error('span (Pauli power) is only made for quad pol scenes')
+                imgTypes.remove('span')
+                self.imgTypes.remove('span')
+            if self.sattype == 'ASF_CEOS':
                 self.asfR1Process()
-            else:
-                self.status = self.imgWrite(format='GTiff')
+            elif imgTypes:
+                self.status = self.imgWrite(format='GTiff', imgTypes=imgTypes)
+            self.selectProduct(self.imgType)
 
             self.inds = None
 
+    @property
+    def FileNames(self):
+        """
+        The files of the image being worked on: the granule, the product and the files 
+        made from it, in order (the chain of self.artifacts)
+        """
+
+        return self.artifacts.chain
+
     def openDataset(self, fname, path=''):
         """
-        Opens a dataset with gdal
+        Opens a dataset with gdal (through Util.datasetCache, so a file that is already 
+        open is not parsed again)
 
         **Parameters**
             
             *fname* : filename
         """
         
-        gdal.AllRegister() # for all purposes
-        self.inds = gdal.Open(os.path.join(path, fname), GA_ReadOnly) # open file
+        self.inds = Util.datasetCache.open(os.path.join(path, fname)) # open file
         self.n_cols = self.inds.RasterXSize
         self.n_rows = self.inds.RasterYSize
         self.n_bands = self.inds.RasterCount
@@ -151,7 +235,24 @@ class Image(object):
             self.n_bands = self.meta.n_bands
 
 
-    def imgWrite(self, format='imgFormat', stretchVals=None):
+    def intermediate(self, fname, nbytes=0):
+        """
+        Where to write an intermediate file: in memory if it is not bigger than 
+        self.memLimit, otherwise fname in tmpDir (see Util.intermediatePath)
+
+        **Parameters**
+
+            *fname*  : file name in tmpDir
+
+            *nbytes* : (estimated) size, 0 for a vrt
+        """
+
+        fname = Util.intermediatePath(fname, nbytes, self.memLimit)
+        if not Util.isMemFile(fname):
+            self.artifacts.reserve(nbytes)
+        return fname
+
+    def imgWrite(self, format='imgFormat', stretchVals=None, imgTypes=None):
         """
         Takes an input dataset and writes an image.
 
@@ -159,24 +260,55 @@ class Image(object):
 
         all bands are output (amp, sigma)
 
+        Several products can be made at once by sending a list of imgTypes - each chunk of 
+        raw data is read only once and every product is calculated from it and written 
+        to its own file (see self.productFiles)
+
         Also used to scale an integer img to byte with stretch, if stretchVals are included
         
         Note there is a parameter called chunk_size hard coded here that could be changed 
             If you are running with lots of RAM
+
+        **Parameters**
+
+            *format*      : gdal format code (gtiff, hfa) or imgFormat to use the one given at init
+
+            *stretchVals* : array of stretch values (see applyStretch)
+
+            *imgTypes*    : list of products to make, defaults to self.imgTypes
         """
 
         chunkSize = 300 # 300 seems to work ok, go lower if RAM is wimpy...
 
+        if imgTypes is None:
+            imgTypes = self.imgTypes
+        if stretchVals is not None:
+            imgTypes = [self.imgType]  # a stretch applies to the current product only
+
+        # multilook (block average) the products before they are written
+        looks = self.looks if stretchVals is None else None
+        if looks:
+            az, rg = looks
+            chunkSize = max(az, (chunkSize // az) * az)   # whole blocks in each chunk
+            out_rows, out_cols = self.n_rows // az, self.n_cols // rg
+            self.logger.info('Multilooking by ' + str(az) + ' x ' + str(rg) + ' (az x rg)')
+        else:
+            out_rows, out_cols = self.n_rows, self.n_cols
+
+        # speckle filtering needs the lines around each chunk (halo)
+        halo = self.speckle[1] // 2 if self.speckle and stretchVals is None else 0
+        if halo:
+            self.logger.info('Speckle filtering sigma with ' + ' '.join(map(str, self.speckle)) + ' (filter, size, looks)')
+
         ############################################## SETUP FOR OUTPUT
         
+        options = []
         if format.lower() == 'gtiff':
             ext = '.tif'
             driver = gdal.GetDriverByName('GTiff')
             options = ['COMPRESS=LZW']
             if self.n_bands > 3:
                     options = ['PHOTOMETRIC=MINISBLACK'] #probs here if you LZW compress
-            if self.imgType == 'sigma':
-                    options.append('BIGTIFF=YES')
         elif format.lower() == 'hfa':
             ext = '.img'
             driver = gdal.GetDriverByName('HFA')
@@ -192,116 +324,720 @@ class Image(object):
                 options = ['COMPRESS=LZW']
                 if self.n_bands > 3:
                     options = ['PHOTOMETRIC=MINISBLACK']
-                if self.imgType == 'sigma':
-                    options.append('BIGTIFF=YES')
         
         else:
             self.logger.error('That image type is not supported')
             return "error"
 
-        n_bands, dataType, outname = self.fnameGenerate()
-
-        if stretchVals is not None:
-            outname = outname +'_temp_stretch'
-            dataType = GDT_Byte # Hard coded here...
+        # one output dataset per product: [imgType, outds, n_bands, outname]
+        outputs = []
+        for imgType in imgTypes:
+            n_bands, dataType, outname = self.fnameGenerate(imgType)
+            if stretchVals is None:
+                self.productBandNames[imgType] = self.bandNames
+            outOptions = list(options)
+            if imgType == 'sigma' and ext == '.tif':
+                outOptions.append('BIGTIFF=YES')
+            encode = imgType == 'sigma' and stretchVals is None and self.encoding is not None
+            if encode:
+                dataType, encOptions = self.sigmaEncoding()
+                outOptions = [o for o in outOptions if not o.startswith('COMPRESS')] + encOptions
 
-        outds = driver.Create(outname+ext, self.n_cols, self.n_rows, n_bands,
-                              dataType, options) # not working with options?? , options)
-        
+            if stretchVals is not None:
+                outname = os.path.splitext(self.productFiles.get(imgType, outname+ext))[0] +'_temp_stretch'
+                dataType = GDT_Byte # Hard coded here...
+            else:
+                nbytes = out_cols * out_rows * n_bands * gdal.GetDataTypeSize(dataType) // 8
+                outname = os.path.splitext(self.intermediate(outname+ext, nbytes))[0]
+
+            Util.datasetCache.invalidate(outname+ext)
+            outds = driver.Create(outname+ext, out_cols, out_rows, n_bands,
+                                  dataType, outOptions) # not working with options?? , options)
+            if encode:
+                self.setEncodingMetadata(outds)
+            outputs.append([imgType, outds, n_bands, outname])
+
+        # band math: one single band output per expression [name, expr, outds, outname]
+        mathOutputs = []
+        if stretchVals is None and self.bandMath:
+            for name, expr in self.bandMath:
+                outname = str(self.meta.dimgname+'_'+name)
+                outname = os.path.splitext(self.intermediate(outname+ext, out_cols * out_rows * 4))[0]
+                Util.datasetCache.invalidate(outname+ext)
+                outds = driver.Create(outname+ext, out_cols, out_rows, 1,
+                                      GDT_Float32, options)
+                mathOutputs.append([name, expr, outds, outname])
+                self.productBandNames[name] = [name]
+
+            # products used in an expression must be calculated, even if they are not written
+            usedNames = []
+            for name, expr in self.bandMath:
+                usedNames.extend(Util.bandMathNames(expr))
+            for imgType in ['amp', 'sigma', 'theta', 'noise', 'phase']:
+                used = [n for n in usedNames if n == imgType or n.startswith(imgType+'_')]
+                if used and imgType not in [output[0] for output in outputs]:
+                    n_bands = self.fnameGenerate(imgType)[0]
+                    outputs.append([imgType, None, n_bands, None])
         
         ############################################## READ RAW DATA
-        for band in range(1,n_bands+1):
-            self.logger.info('Processing band ' + str(band))
+        maxBands = max([output[2] for output in outputs])
 
-            bandobj = self.inds.GetRasterBand(band)
-
-            if stretchVals is not None:
-                scaleRange = stretchVals[band-1,1]
-                dynRange = stretchVals[band-1,2]
-                minVal = stretchVals[band-1,3]
-                offset = stretchVals[band-1,4]
-
-                #PROCESS IN CHUNKS
-            n_chunks = int(self.n_rows / chunkSize + 1)
-            n_lines = chunkSize
+            #PROCESS IN CHUNKS
+        n_chunks = int(self.n_rows / chunkSize + 1)
+        n_lines = chunkSize
+        self.logger.info('Processing ' + str(maxBands) + ' band(s) in ' + str(n_chunks) + ' chunks')
 
-            for chunk in range(n_chunks):
+        for chunk in range(n_chunks):
 
-                first_line = chunkSize*chunk
-                if chunk == n_chunks - 1:
-                    n_lines = self.n_rows - first_line
+            first_line = chunkSize*chunk
+            if chunk == n_chunks - 1:
+                n_lines = self.n_rows - first_line
+            if n_lines <= 0:
+                break
+            out_line = first_line // looks[0] if looks else first_line
+            read_line = max(first_line - halo, 0)
+            read_lines = min(first_line + n_lines + halo, self.n_rows) - read_line
 
-                # read in a chunk of data
-                datachunk = gdal_array.BandReadAsArray(bandobj, 0, first_line,            
-                                                       self.n_cols, n_lines)
+            bandData = {}  # calibrated chunks for the band math (sigma_HH, theta, etc.)
 
-                if datachunk is None:
-                    self.logger.error("Error datachunk =  None")
-                    self.logger.error("GDAL unable to read scene!")
+            for band in range(1, maxBands+1):
 
-                    self.tifname = outname+ext          ###
-                    return "error"
+                bandobj = self.inds.GetRasterBand(band)
+                # theta and noise are made from the metadata, no need to read for them alone
+                readData = stretchVals is not None or \
+                    len([o for o in outputs if o[2] >= band and o[0] not in ['theta', 'noise']]) > 0
 
                 if stretchVals is not None:
-                    outdata = self.stretchLinear(datachunk, scaleRange,
-                                                 dynRange, minVal, offset)
+                    scaleRange = stretchVals[band-1,1]
+                    dynRange = stretchVals[band-1,2]
+                    minVal = stretchVals[band-1,3]
+                    offset = stretchVals[band-1,4]
+
+                # read in a chunk of data - once for all products
+                datachunk = None
+                if readData:
+                    datachunk = gdal_array.BandReadAsArray(bandobj, 0, read_line,            
+                                                           self.n_cols, read_lines)
+
+                    if datachunk is None:
+                        self.logger.error("Error datachunk =  None")
+                        self.logger.error("GDAL unable to read scene!")
+
+                        self.tifname = outputs[0][3]+ext          ###
+                        for output in outputs:
+                            self.artifacts.add(output[3]+ext, 'nil')  # so cleanFiles can remove them
+                        return "error"
+
+                for imgType, outds, n_bands, outname in outputs:
+                    if band > n_bands:
+                        continue
+
+                    if stretchVals is not None:
+                        outdata = self.stretchLinear(datachunk, scaleRange,
+                                                     dynRange, minVal, offset)
 
-                else:
-                    # decide what to do with the datachunk
-                    if self.imgType == 'amp':  # assumes no values will be zero
-                        if datachunk.dtype == numpy.complex64 or \
-                        datachunk.dtype == numpy.complex128:
-                            outdata = self.getMag(datachunk)
-                        else:
-                            outdata = self.getAmp(datachunk)
-                    if self.imgType == 'sigma':
-                        outdata =  self.getSigma(datachunk, n_lines)
-                    if self.imgType == 'theta':
-                        outdata = self.getTheta(n_lines)
-                    if self.imgType == 'noise':
-                        outdata = self.getNoise(n_lines)
-                    if self.imgType == 'phase':
-                        outdata = self.getPhase(datachunk)
-
-                # write caldata from datachunk to outds
-                if self.imgType == 'amp' and stretchVals is None:
-                    gdal_array.BandWriteArray( outds.GetRasterBand(band), outdata.astype(int), 0, first_line )
-                elif stretchVals is not None:
-                    gdal_array.BandWriteArray( outds.GetRasterBand(band), outdata.astype(int), 0, first_line )  ###BYTE? outds should be defined as byte anyhow (see above)
-                else:
-                    gdal_array.BandWriteArray( outds.GetRasterBand(band), outdata.astype(float), 0, first_line )
-
-                outds.FlushCache()   # flush all write cached data to disk
-                ##end chunk loop
+                    else:
+                        outdata = self.getProduct(imgType, datachunk, read_lines, read_line, band)
+                        if imgType == 'sigma' and halo:
+                            outdata = self.filterSpeckle(outdata, first_line - read_line, n_lines)
+                        elif halo:
+                            outdata = outdata[first_line-read_line:first_line-read_line+n_lines]
+                        if looks:
+                            outdata = self.multilook(outdata, imgType)
+
+                    if mathOutputs:
+                        bandData[self.bandKey(imgType, band)] = outdata
+
+                    if outds is None:  # only needed for the band math
+                        continue
+
+                    # write caldata from datachunk to outds
+                    if imgType == 'amp' and stretchVals is None:
+                        outdata = outdata.astype(int)
+                    elif stretchVals is not None:
+                        outdata = outdata.astype(int)  ###BYTE? outds should be defined as byte anyhow (see above)
+                    elif imgType == 'sigma' and self.encoding is not None:
+                        outdata = self.encodeSigma(outdata)
+                    else:
+                        outdata = outdata.astype(float)
+                    gdal_array.BandWriteArray( outds.GetRasterBand(band), outdata, 0, out_line )
+                    if stretchVals is None:
+                        self.accumulateHist(imgType, band, outdata, outds)
+                ## end band loop
+
+            # derived bands, from the calibrated chunks already in memory
+            for name, expr, outds, outname in mathOutputs:
+                outdata = Util.evalBandMath(expr, bandData)
+                gdal_array.BandWriteArray( outds.GetRasterBand(1), outdata, 0, out_line )
+                self.accumulateHist(name, 1, outdata, outds)
+
+            bandData = None
+            ##end chunk loop
 
-            outBand = outds.GetRasterBand(band)
-            outBand.SetNoDataValue(0)  # if warranted (if before stats, then good)
-            outBand.FlushCache()
-            outBand.GetStatistics(False, True)
-            band = None
-            ## end band loop
+        outputs = [output for output in outputs if output[1] is not None]
+        outputs = outputs + [[name, outds, 1, outname] for name, expr, outds, outname in mathOutputs]
+
+        # byte versions of the products, stretched with the histograms from this pass
+        if stretchVals is None and self.stretch is not None and self.stretchFormat != 'vrt':
+            stretched = []
+            for imgType, outds, n_bands, outname in outputs:
+                stretchds = self.writeStretch(imgType, outds, n_bands, outname+'_stretch'+ext, 
+                                              driver, options, chunkSize)
+                if stretchds is not None:
+                    stretched.append([imgType+'_stretch', stretchds, n_bands, outname+'_stretch'])
+                    self.productBandNames[imgType+'_stretch'] = self.productBandNames[imgType]
+            outputs = outputs + stretched
+
+        for imgType, outds, n_bands, outname in outputs:
+            outds.FlushCache()   # flush all write cached data to disk
+            for band in range(1, n_bands+1):
+                outBand = outds.GetRasterBand(band)
+                outBand.SetNoDataValue(0)  # if warranted (if before stats, then good)
+                outBand.FlushCache()
+                if imgType in self.histograms:
+                    # from the histograms, saves reading the file again
+                    stats = self.histStats(imgType)[band-1]
+                    outBand.SetStatistics(stats[4], stats[5], stats[6], stats[7])
+                else:
+                    outBand.GetStatistics(False, True)
+                outBand = None
 
-        # finish the geotiff file
+        # finish the geotiff file(s)
         
         if self.proj == 'nil':
-            if self.elevationCorrection == "1":
+            if self.dem:
+                self.logger.info("Using terrain corrected GCPs with heights from DEM {}".format(self.dem))
+                gcp_list = self.correct_known_elevation()
+            elif self.elevationCorrection == "1":
                 self.logger.info("Using terrain corrected GCPs with user input elevation = {} m".format(self.elevationCorrection))
                 gcp_list = self.correct_known_elevation()
+            else:
+                gcp_list = self.meta.geopts
+            if looks:
+                gcp_list = scaleGCPs(gcp_list, looks)
+        else:
+            geotrans = list(self.inds.GetGeoTransform())
+            if looks:
+                geotrans[1], geotrans[2] = geotrans[1]*looks[1], geotrans[2]*looks[0]
+                geotrans[4], geotrans[5] = geotrans[4]*looks[1], geotrans[5]*looks[0]
+
+        for imgType, outds, n_bands, outname in outputs:
+            if self.proj == 'nil':
                 outds.SetGCPs(gcp_list, self.meta.geoptsGCS)
             else:
-                outds.SetGCPs(self.meta.geopts, self.meta.geoptsGCS)
+                # copy the proj info from before...
+                outds.SetGeoTransform(geotrans)
+                outds.SetProjection(self.inds.GetProjection())
+        
+            if stretchVals is None:
+                self.artifacts.add(outname+ext, 'stretch' if imgType.endswith('_stretch') else 'nil')
+                self.productFiles[imgType] = outname+ext
+                if imgType not in self.imgTypes:   # band math products are processed like the others
+                    self.imgTypes.append(imgType)
+                self.logger.debug('Image written ' + outname+ext)
+
+                self.tifname = outname+ext          ###
+        
+        written = [(imgType, outname) for imgType, outds, n_bands, outname in outputs]
+        outputs = None         # release the dataset(s) so they can be closed
+
+        # stretched views of the products, now that they are on disk with their georeferencing
+        if stretchVals is None and self.stretch is not None and self.stretchFormat == 'vrt':
+            for imgType, outname in written:
+                stats = self.histStats(imgType)
+                if stats is None:
+                    continue
+                vals = self.stretchValues(stats, imgType=imgType, **self.stretch)
+                if vals is None or isinstance(vals, str):
+                    continue
+                if self.stretchVRT(vals, outname+ext, outname+'_stretch.vrt'):
+                    self.artifacts.add(outname+'_stretch.vrt', 'stretch', sources=[outname+ext])
+                    self.productFiles[imgType+'_stretch'] = outname+'_stretch.vrt'
+                    self.productBandNames[imgType+'_stretch'] = self.productBandNames[imgType]
+                    if imgType+'_stretch' not in self.imgTypes:
+                        self.imgTypes.append(imgType+'_stretch')
+
+    def filterSpeckle(self, caldata, top, n_lines):
+        """
+        Speckle filters (self.speckle) a chunk of calibrated power, split in strips of 
+        lines filtered on a few threads (numpy releases the GIL). Each strip takes the 
+        lines it needs around it from caldata, which has halo lines read before and after 
+        the chunk so that it is filtered as if the whole image were
+
+        **Parameters**
+
+            *caldata* : calibrated chunk, with the halo lines
+
+            *top*     : number of halo lines before the chunk
+
+            *n_lines* : number of lines in the chunk
+
+        **Returns**
+
+            *outdata* : filtered chunk (n_lines), float32
+        """
+
+        method, size, looks = self.speckle
+        halo = size // 2
+        n_threads = min(4, os.cpu_count() or 1)
+        n_strips = max(1, min(n_threads, n_lines // (2*halo + 1)))
+        bounds = numpy.linspace(top, top + n_lines, n_strips + 1).astype(int)
+
+        def filterStrip(strip):
+            first, last = bounds[strip], bounds[strip+1]
+            lo, hi = max(first - halo, 0), min(last + halo, len(caldata))
+            return Util.speckleFilter(caldata[lo:hi], method, size, looks)[first-lo:last-lo]
+
+        if n_strips == 1:
+            return filterStrip(0)
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as pool:
+            return numpy.concatenate(list(pool.map(filterStrip, range(n_strips))))
+
+    def multilook(self, outdata, imgType, noDataVal=0):
+        """
+        Block average a chunk of a product by self.looks (azimuth, range) pixels. 
+        Averaging is done in the power domain (amplitudes are squared first), phases are 
+        averaged as unit vectors and nodata pixels are left out of the average. Partial 
+        blocks at the end of a line/chunk are dropped.
+        
+        **Parameters**
+            
+            *outdata*   : chunk of the product, the number of lines should be a multiple of the azimuth looks
+
+            *imgType*   : amp, sigma, theta, noise or phase
+
+            *noDataVal* : nodata value
+
+        **Returns**
+
+            *mean*      : multilooked chunk
+        """
+
+        az, rg = self.looks
+        rows, cols = outdata.shape[0] // az, outdata.shape[1] // rg
+        block = outdata[:rows*az, :cols*rg].reshape(rows, az, cols, rg)
+        valid = block != noDataVal
+        count = valid.sum(axis=(1, 3))
+
+        if imgType == 'amp':
+            data = numpy.square(block, dtype=numpy.float32)
+        elif imgType == 'phase':
+            data = numpy.exp(1j * block)
         else:
-            # copy the proj info from before...
-            outds.SetGeoTransform(self.inds.GetGeoTransform())
-            outds.SetProjection(self.inds.GetProjection())
+            data = block.astype(numpy.float32)
+        total = numpy.where(valid, data, 0).sum(axis=(1, 3))
+        mean = total / numpy.maximum(count, 1)
+
+        if imgType == 'amp':
+            mean = numpy.rint(numpy.sqrt(mean))
+        elif imgType == 'phase':
+            mean = numpy.angle(mean)
+        mean[count == 0] = noDataVal
+        return mean.astype(numpy.float32)
+
+    def accumulateHist(self, imgType, band, outdata, outds, noDataVal=0):
+        """
+        Adds a chunk of a band that was written to the histogram of that product (see 
+        Util.histKeys) along with the count, sum and sum of squares for the mean and std. 
+        Nodata and non-finite values are left out.
+
+        **Parameters**
+
+            *imgType*   : product the chunk belongs to
+
+            *band*      : band number (1 based)
+
+            *outdata*   : chunk as written to the file
+
+            *outds*     : the output dataset (for the band count and data type)
+
+            *noDataVal* : nodata value
+        """
+
+        if imgType not in self.histograms:
+            n_bands = outds.RasterCount
+            self.histograms[imgType] = {'hist' : numpy.zeros((n_bands, 65536), dtype=numpy.int64),
+                                        'moments' : numpy.zeros((n_bands, 3)),   # count, sum, sum of squares
+                                        'min' : numpy.full(n_bands, numpy.inf),
+                                        'max' : numpy.full(n_bands, -numpy.inf),
+                                        'dataType' : outds.GetRasterBand(1).DataType}
+        h = self.histograms[imgType]
+        index = band-1
+
+        valid = Util.validValues(outdata, noDataVal).astype(numpy.float64)
+        if valid.size == 0:
+            return
+        h['hist'][index] += numpy.bincount(Util.histKeys(valid), minlength=65536)
+        h['moments'][index] += [valid.size, valid.sum(), numpy.dot(valid, valid)]
+        h['min'][index] = min(h['min'][index], valid.min())
+        h['max'][index] = max(h['max'][index], valid.max())
+
+    def histStats(self, imgType=None):
+        """
+        Stats of a product from the histograms collected as it was written, in the 
+        same array as getImgStats - 1 row per band
+        cols: band, dynamicRange, dataType, nodata value, min, max, mean, std
+
+        **Parameters**
+
+            *imgType* : product, defaults to self.imgType
+
+        **Returns**
+
+            *stats*   : array of 1 row per band, or None if no histogram was collected
+        """
+
+        if imgType is None:
+            imgType = self.imgType
+        if imgType not in self.histograms:
+            return None
+        h = self.histograms[imgType]
+
+        n_bands = h['hist'].shape[0]
+        stats = numpy.zeros((n_bands, 8))
+        for index in range(n_bands):
+            count, total, squares = h['moments'][index]
+            if count == 0:
+                stats[index,:] = [index+1, 0, h['dataType'], 0, 0, 0, 0, 0]
+                continue
+            mean = total / count
+            std = math.sqrt(max(squares / count - mean**2, 0))
+            minVal, maxVal = h['min'][index], h['max'][index]
+            stats[index,:] = [index+1, maxVal-minVal, h['dataType'], 0, minVal, maxVal, mean, std]
+        return stats
+
+    def writeStretch(self, imgType, outds, n_bands, outname, driver, options, chunkSize):
+        """
+        Writes a byte version of a product that imgWrite just wrote, stretched (self.stretch) 
+        with the histograms collected in the same pass. The calibrated chunks are read back 
+        from the open dataset, there is no need to recalibrate or to compute stats.
+
+        **Parameters**
+
+            *imgType*   : product to stretch
+
+            *outds*     : open dataset of the product
+
+            *n_bands*   : number of bands
+
+            *outname*   : name of the stretched file (with extension)
+
+            *driver*    : gdal driver to write with
+
+            *options*   : creation options
+
+            *chunkSize* : lines to process at a time
+
+        **Returns**
+
+            *stretchds* : the stretched dataset, or None if this product can not be stretched
+        """
+
+        stats = self.histStats(imgType)
+        if stats is None:
+            return None
+        stretchVals = self.stretchValues(stats, imgType=imgType, **self.stretch)
+        if stretchVals is None or isinstance(stretchVals, str):
+            return None
+
+        self.logger.info('Writing stretched ' + imgType + ' ' + outname)
+        outds.FlushCache()
+        n_cols, n_rows = outds.RasterXSize, outds.RasterYSize
+        Util.datasetCache.invalidate(outname)
+        stretchds = driver.Create(outname, n_cols, n_rows, n_bands, GDT_Byte, options)
+
+        for band in range(1, n_bands+1):
+            inBand = outds.GetRasterBand(band)
+            outBand = stretchds.GetRasterBand(band)
+            scaleRange, dynRange, minVal, offset = stretchVals[band-1,1:5]
+            for first_line in range(0, n_rows, chunkSize):
+                n_lines = min(chunkSize, n_rows-first_line)
+                datachunk = gdal_array.BandReadAsArray(inBand, 0, first_line, n_cols, n_lines)
+                outdata = self.stretchLinear(datachunk, scaleRange, dynRange, minVal, offset).astype(int)
+                gdal_array.BandWriteArray(outBand, outdata, 0, first_line)
+                self.accumulateHist(imgType+'_stretch', band, outdata, stretchds)
+        return stretchds
+
+    def sigmaEncoding(self):
+        """
+        Data type and creation options for the compact encodings of sigma products (self.encoding):
+
+            *db16*    : dB scaled Int16, where dB = value*dBScale + dBOffset (0 is nodata) 
+
+            *float16* : half precision float (NBITS=16)
+
+            *zstd*    : float with a floating point predictor and ZSTD compression, 
+                        dropping self.discardLSB bits of the mantissa if given
+
+        **Returns**
+
+            *dataType* : gdal data type
+
+            *options*  : list of creation options for the GTiff driver
+        """
+
+        encoding = self.encoding.lower()
+        if encoding == 'db16':
+            return GDT_Int16, ['COMPRESS=LZW', 'PREDICTOR=2']
+        elif encoding == 'float16':
+            return GDT_Float32, ['NBITS=16', 'COMPRESS=LZW']
+        elif encoding == 'zstd':
+            options = ['COMPRESS=ZSTD', 'PREDICTOR=3', 'ZSTD_LEVEL=9']
+            if self.discardLSB:
+                options.append('DISCARD_LSB=' + str(self.discardLSB))
+            return GDT_Float32, options
+        else:
+            raise ValueError('Sigma encoding ' + self.encoding + ' not supported')
+
+    def setEncodingMetadata(self, outds):
+        """
+        Records the encoding in the GeoTIFF metadata so that readers can decode the values. 
+        For db16, the scale and offset are set on each band (gdal applies them with -unscale)
         
-        if stretchVals is None:
-            self.FileNames.append(outname+ext)
-            self.logger.debug('Image written ' + outname+ext)
+        **Parameters**
+            
+            *outds* : gdal dataset being written
+        """
 
-            self.tifname = outname+ext          ###
+        encoding = self.encoding.lower()
+        outds.SetMetadataItem('SIGMA_ENCODING', encoding)
+        if encoding == 'db16':
+            outds.SetMetadataItem('SIGMA_DB_SCALE', str(self.dBScale))
+            outds.SetMetadataItem('SIGMA_DB_OFFSET', str(self.dBOffset))
+            outds.SetMetadataItem('SIGMA_DECODE', 'sigma = 10**((value*SIGMA_DB_SCALE + SIGMA_DB_OFFSET)/10), 0 is nodata')
+            for band in range(1, outds.RasterCount+1):
+                outds.GetRasterBand(band).SetScale(self.dBScale)
+                outds.GetRasterBand(band).SetOffset(self.dBOffset)
+                outds.GetRasterBand(band).SetUnitType('dB')
+        elif encoding == 'zstd' and self.discardLSB:
+            outds.SetMetadataItem('SIGMA_DISCARD_LSB', str(self.discardLSB))
+
+    def encodeSigma(self, caldata):
+        """
+        Converts a chunk of sigma nought (linear) to the array to write for self.encoding
         
-        outds = None         # release the dataset so it can be closed
+        **Parameters**
+            
+            *caldata* : calibrated chunk (linear power)
+
+        **Returns**
+
+            *encoded* : chunk ready to write (Int16 for db16, float32 otherwise)
+        """
+
+        if self.encoding.lower() != 'db16':
+            return caldata.astype(numpy.float32)
+
+        valid = caldata > 0
+        dB = numpy.zeros(caldata.shape, dtype=numpy.float32)
+        numpy.log10(caldata, out=dB, where=valid)
+        dB *= 10
+        encoded = numpy.rint((dB - self.dBOffset) / self.dBScale)
+        numpy.clip(encoded, 1, 32767, out=encoded)   # keep 0 for nodata
+        encoded[~valid] = 0
+        return encoded.astype(numpy.int16)
+
+    def creationOptions(self):
+        """
+        The -co options for gdal_translate to use when rewriting the current product, so that 
+        a compact sigma encoding survives the subset/compress steps 
+        """
+
+        if self.imgType == 'sigma' and self.encoding is not None:
+            options = self.sigmaEncoding()[1]
+        else:
+            options = ['COMPRESS=LZW']
+        return ' '.join(['-co "' + o + '"' for o in options])
+
+    def getProduct(self, imgType, datachunk, n_lines, first_line=0, band=1):
+        """
+        Decide what to do with the datachunk, given the type of product wanted
+
+        **Parameters**
+
+            *imgType*    : amp, sigma, theta, noise or phase
+
+            *datachunk*  : chunk of raw data being processed (not needed for theta or noise)
+
+            *n_lines*    : size of the chunk
+
+            *first_line* : line of the image the chunk starts at
+
+            *band*       : band of the raw data the chunk is from
+
+        **Returns**
+
+            *outdata*   : chunk of data for this product
+        """
+
+        if imgType == 'amp':  # assumes no values will be zero
+            if datachunk.dtype == numpy.complex64 or \
+            datachunk.dtype == numpy.complex128:
+                outdata = self.getMag(datachunk)
+            else:
+                outdata = self.getAmp(datachunk)
+        if imgType == 'sigma':
+            outdata =  self.getSigma(datachunk, n_lines, first_line, band)
+        if imgType == 'theta':
+            outdata = self.getTheta(n_lines)
+        if imgType == 'noise':
+            outdata = self.getNoise(n_lines, first_line, band)
+        if imgType == 'phase':
+            outdata = self.getPhase(datachunk)
+        return outdata
+
+    def readWindow(self, region, product='sigma'):
+        """
+        Calibrated data for a region of the scene, made from the raw data on demand 
+        (nothing is written). Calibrated blocks of lines are kept (least recently used 
+        are dropped) so overlapping or repeated regions are not calibrated again.
+
+        **Parameters**
+
+            *region*  : bounding box (minx, miny, maxx, maxy) or polygon (wkt or ogr geometry) 
+                        in the coordinates of the GCPs (self.meta.geoptsGCS, lon/lat)
+
+            *product* : amp, sigma, theta, noise or phase
+
+        **Returns**
+
+            *data*    : float32 array (lines, pixels) or (bands, lines, pixels) if the product 
+                        has more than one band, 0 (nodata) outside a polygon. None if the 
+                        region is not in the scene
+        """
+
+        if isinstance(region, (list, tuple)):
+            minx, miny, maxx, maxy = region
+            geom = ogr.CreateGeometryFromWkt('POLYGON (({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))'.format(minx, miny, maxx, maxy))
+            polygon = False
+        else:
+            geom = region.Clone() if isinstance(region, ogr.Geometry) else ogr.CreateGeometryFromWkt(region)
+            polygon = True
+
+        self.openDataset(self.fname, self.path)   # raw data (a product may have been opened since)
+        rawds = self.inds
+        self.inds = None
+
+        if self.gcpTransformer is None:
+            if self.dem or self.elevationCorrection == "1":
+                gcp_list = self.correct_known_elevation()
+            else:
+                gcp_list = self.meta.geopts
+            gcpds = gdal.GetDriverByName('MEM').Create('', self.n_cols, self.n_rows, 0)
+            gcpds.SetGCPs(gcp_list, self.meta.geoptsGCS)
+            self.gcpTransformer = gdal.Transformer(gcpds, None, ['MAX_GCP_ORDER=3'])
+        if not pixelGeometry(geom, self.gcpTransformer):
+            self.logger.error('Could not find the region in the scene')
+            return None
+
+        minPx, maxPx, minLn, maxLn = geom.GetEnvelope()
+        first_px, first_line = max(int(math.floor(minPx)), 0), max(int(math.floor(minLn)), 0)
+        last_px, last_line = min(int(math.ceil(maxPx)), self.n_cols), min(int(math.ceil(maxLn)), self.n_rows)
+        if last_px <= first_px or last_line <= first_line:
+            self.logger.error('Region is not in the scene')
+            return None
+
+        n_bands = 1 if product in ['theta', 'noise'] else rawds.RasterCount
+        data = numpy.zeros((n_bands, last_line-first_line, last_px-first_px), dtype=numpy.float32)
+        for band in range(1, n_bands+1):
+            for block in range(first_line // self.windowBlock, (last_line-1) // self.windowBlock + 1):
+                caldata = self.calibratedBlock(rawds, product, band, block)
+                top = block * self.windowBlock
+                lines = slice(max(first_line, top), min(last_line, top + len(caldata)))
+                data[band-1, lines.start-first_line:lines.stop-first_line] = \
+                    caldata[lines.start-top:lines.stop-top, first_px:last_px]
+
+        if polygon:
+            # rasterize the polygon (in pixel/line coordinates) on the window
+            maskds = gdal.GetDriverByName('MEM').Create('', last_px-first_px, last_line-first_line, 1, GDT_Byte)
+            maskds.SetGeoTransform((first_px, 1, 0, first_line, 0, 1))
+            vectds = ogr.GetDriverByName('Memory').CreateDataSource('')
+            layer = vectds.CreateLayer('region')
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometry(geom)
+            layer.CreateFeature(feature)
+            gdal.RasterizeLayer(maskds, [1], layer, burn_values=[1])
+            data[:, maskds.ReadAsArray() == 0] = 0
+            maskds = vectds = None
+
+        self.logger.debug('Read window {}:{} x {}:{} of {}'.format(first_line, last_line, first_px, last_px, product))
+        return data[0] if n_bands == 1 else data
+
+    def calibratedBlock(self, rawds, imgType, band, block):
+        """
+        A block of windowBlock lines (full width) of a product, calibrated from the raw 
+        data or taken from self.blockCache
+
+        **Parameters**
+
+            *rawds*   : the raw dataset
+
+            *imgType* : amp, sigma, theta, noise or phase
+
+            *band*    : band of the product
+
+            *block*   : block number (first line is block*windowBlock)
+
+        **Returns**
+
+            *caldata* : float32 array (lines, self.n_cols)
+        """
+
+        key = (imgType, band, block)
+        if key in self.blockCache:
+            self.blockCache.move_to_end(key)
+            return self.blockCache[key]
+
+        first_line = block * self.windowBlock
+        n_lines = min(self.windowBlock, self.n_rows - first_line)
+        datachunk = None
+        if imgType not in ['theta', 'noise']:
+            datachunk = gdal_array.BandReadAsArray(rawds.GetRasterBand(band), 0, first_line,
+                                                   self.n_cols, n_lines)
+        caldata = numpy.asarray(self.getProduct(imgType, datachunk, n_lines, first_line, band), 
+                                dtype=numpy.float32)
+
+        self.blockCache[key] = caldata
+        while len(self.blockCache) > self.windowBlocks:
+            self.blockCache.popitem(last=False)
+        return caldata
+
+    def bandKey(self, imgType, band):
+        """
+        Name a band of a product so it can be used in a band math expression:
+        sigma_HH, amp_HV, etc. or theta and noise, which have one band only
+
+        **Parameters**
+
+            *imgType* : amp, sigma, theta, noise or phase
+
+            *band*    : band number (1 based)
+        """
+
+        if imgType in ['theta', 'noise']:
+            return imgType
+        if isinstance(self.polarization, str):
+            pols = self.polarization.split()
+        else:
+            pols = list(self.polarization)
+        return imgType + '_' + pols[band-1].upper()
+
+    def selectProduct(self, imgType):
+        """
+        Make one of the products written by imgWrite the current image so that 
+        projectImg, cropImg, maskImg, etc. operate on it
+
+        **Parameters**
+
+            *imgType* : one of self.imgTypes
+        """
+
+        self.imgType = imgType
+        if imgType not in self.productFiles:
+            return
+        self.tifname = self.productFiles[imgType]
+        self.bandNames = self.productBandNames[imgType]
+        self.artifacts.chain = [self.artifacts.root, self.tifname]
 
     #OBSOLETE
     def reduceImg(self, xfactor, yfactor):
@@ -375,32 +1111,28 @@ class Image(object):
 
         os.chdir(self.tmpDir)
 
-        inname = ''
-        for file in self.FileNames:
-            if 'a.tif' in file or 's.tif' in file: #handle multiple instances
-                inname = file
-        if not inname:
-            inname = self.FileNames[-1] #last file
-            print("Here {}".format(inname))
+        inname = self.FileNames[-1] #last file
+        for fname in self.FileNames:
+            if self.artifacts.stage(fname) in ['nil', 'stretch']: # the product, even after earlier subsets
+                inname = fname
 
         outname = os.path.splitext(inname)[0] + '_proj' + ext
+        if imgFormat == 'VRT':
+            outname = self.intermediate(outname)
+        else:
+            outname = self.intermediate(outname, Util.datasetBytes(Util.datasetCache.open(inname)))
+        Util.datasetCache.invalidate(outname)
 
         if proj == '':
-            command = 'gdalwarp -of ' + imgFormat +  ' -t_srs ' +\
+            options = '-of ' + imgFormat +  ' -t_srs ' +\
                     'EPSG:' + projSRID +\
-                        ' -order 3 -dstnodata 0 -r ' + resample +' '+clobber+ \
-                        inname + ' ' + outname
+                        ' -order 3 -dstnodata 0 -r ' + resample +' '+clobber
         else:
-            command = 'gdalwarp -of ' + imgFormat + ' -t_srs ' + \
+            options = '-of ' + imgFormat + ' -t_srs ' + \
                       os.path.join(self.projdir, proj + '.wkt') + \
-                      ' -order 3 -dstnodata 0 -r ' + resample + ' ' + clobber + \
-                      inname + ' ' + outname
+                      ' -order 3 -dstnodata 0 -r ' + resample + ' ' + clobber
 
-        try:
-            ok = subprocess.Popen(command).wait()  # run the other way on linux
-        except:
-            cmd = shlex.split(command)  #TODO this may be a problem for windows
-            ok = subprocess.Popen(cmd).wait()
+        ok = Util.gdalUtil('gdalwarp', outname, inname, options)
 
         if ok == 0:
             if proj == '':
@@ -409,7 +1141,7 @@ class Image(object):
                 self.proj = proj
             self.logger.info('Completed image projection')
             
-            self.FileNames.append(outname)
+            self.artifacts.add(outname, 'proj', sources=[inname] if imgFormat == 'VRT' else [])
         else:
             self.logger.error('Image projection failed')
 
@@ -493,12 +1225,18 @@ class Image(object):
         command = 'asf_mapready {}'.format(self.zipname + '.cfg')
         os.system(command)
 
-        self.FileNames.append(outname + ext)
+        self.artifacts.add(outname + ext, 'nil')
+        self.productFiles[self.imgType] = outname + ext
+        self.productBandNames[self.imgType] = self.bandNames
 
 
-    def fnameGenerate(self, names=False):
+    def fnameGenerate(self, imgType=None):
         """
         Generate a specific filename for this product.
+
+        **Parameters**
+
+            *imgType*  : product to name, defaults to self.imgType
         
         **Returns**
             
@@ -509,29 +1247,36 @@ class Image(object):
             *outname*  : New filename
         """
 
-        if self.imgType == "amp":
+        if imgType is None:
+            imgType = self.imgType
+
+        if imgType == "amp":
             bands = self.n_bands
             if self.bitsPerSample == 8:
                 dataType = GDT_Byte
             else:
                 dataType = GDT_UInt16
             self.bandNames = None
-        if self.imgType == "sigma":
+        if imgType == "sigma":
             bands = self.n_bands
             dataType = GDT_Float32
             self.bandNames = None
-        if self.imgType == "noise":
+        if imgType == "noise":
             bands = 1
             dataType = GDT_Float32
-            self.bandNames['noise']
-        if self.imgType == "theta":
+            self.bandNames = ['noise']
+        if imgType == "theta":
             bands = 1
             self.bandNames = ['theta']
             dataType = GDT_Float32
-        if self.imgType == "phase":
+        if imgType == "phase":
             bands = self.n_bands
             dataType = GDT_Float32
             self.bandNames = None
+        if imgType == "span":
+            bands = 1
+            dataType = GDT_Float32
+            self.bandNames = ['span']
 
         if self.sattype == 'SEN-1':
                 self.bandNames = self.polarization
@@ -540,10 +1285,12 @@ class Image(object):
             self.bandNames = []
             names = self.polarization.split()
             for name in names:
-                self.bandNames.append(self.imgType[0].lower()+name)
+                self.bandNames.append(imgType[0].lower()+name)
 
 
-        outname = str(self.meta.dimgname+'_'+self.imgType[0:1].lower())
+        outname = str(self.meta.dimgname+'_'+imgType[0:1].lower())
+        if imgType == "span":  # s is taken by sigma
+            outname = str(self.meta.dimgname+'_span')
         return bands, dataType, outname
 
 
@@ -583,28 +1330,25 @@ class Image(object):
         imgFormat = 'vrt'
         ext = '.vrt'
         inname = self.FileNames[-1] # this is potentially an issue here
-        outname = os.path.splitext(inname)[0] +'_'+str(subscene) +ext
+        outname = self.intermediate(os.path.splitext(inname)[0] +'_'+str(subscene) +ext)
+        Util.datasetCache.invalidate(outname)
         
         sep = ' '
         crop = str(llur[0][0]) +sep+ str(llur[0][1]) +sep+ str(llur[1][0]) +sep+ str(llur[1][1])
 
         if 'EPSG:' in self.proj:
-            cmd = 'gdalwarp -of ' + imgFormat + ' -te ' + crop + ' -t_srs ' +\
+            options = '-of ' + imgFormat + ' -te ' + crop + ' -t_srs ' +\
                     self.proj +\
-                ' -r near -order 1 -dstnodata 0 ' +\
-                inname + ' ' + outname
+                ' -r near -order 1 -dstnodata 0'
         else:
-            cmd = 'gdalwarp -of ' + imgFormat + ' -te ' + crop + ' -t_srs ' + \
+            options = '-of ' + imgFormat + ' -te ' + crop + ' -t_srs ' + \
                   os.path.join(self.projdir, self.proj + '.wkt') + \
-                  ' -r near -order 1 -dstnodata 0 ' + \
-                  inname + ' ' + outname
-
-        command = shlex.split(cmd)
+                  ' -r near -order 1 -dstnodata 0'
 
-        ok = subprocess.Popen(command).wait()
+        ok = Util.gdalUtil('gdalwarp', outname, inname, options)
         if ok == 0:
             self.logger.debug('img cropped -method warp') 
-            self.FileNames.append(outname)
+            self.artifacts.add(outname, 'crop', sources=[inname])
         else:
             self.logger.error('Could not crop image in cropBig')
         return ok
@@ -624,21 +1368,19 @@ class Image(object):
         imgFormat = 'vrt'
         ext = '.vrt'
         inname = self.FileNames[-1] # this is potentially an issue here
-        outname = os.path.splitext(inname)[0] +'_'+str(subscene) +ext
+        outname = self.intermediate(os.path.splitext(inname)[0] +'_'+str(subscene) +ext)
+        Util.datasetCache.invalidate(outname)
 
         self.fname_nosubest = inname
        
         sep = ' '
         crop = str(urll[0][0]) +sep+ str(urll[0][1]) +sep+ str(urll[1][0]) +sep+ str(urll[1][1])
-        cmd = 'gdal_translate -projwin ' + crop + ' -a_nodata 0 -of '+ imgFormat +' ' +\
-            inname + ' ' + outname
-
-        command = shlex.split(cmd)
+        options = '-projwin ' + crop + ' -a_nodata 0 -of '+ imgFormat
 
-        ok = subprocess.Popen(command).wait()
+        ok = Util.gdalUtil('gdal_translate', outname, inname, options)
         if ok == 0:
             self.logger.debug('img cropped -method crop_Small')
-            self.FileNames.append(outname)
+            self.artifacts.add(outname, 'crop', sources=[inname])
         else:
             self.logger.error('Could not crop image in crop_Small')
         return ok
@@ -676,18 +1418,16 @@ class Image(object):
         bstr = ''
 
         # must list the bands to mask if more than 1 band
-        ds = gdal.Open(inname)
+        ds = Util.datasetCache.open(inname)
 
         for band in range(1,ds.RasterCount+1):
             bstr = bstr + bandFlag + str(band)
                 
         ds = None
-        cmd = 'gdal_rasterize ' + sidecode + bstr +\
-            ' -burn 0' + ' -l ' +\
-            mask + ' ' + os.path.join(vectdir, mask  + '.shp') +\
-            ' ' + inname
+        Util.datasetCache.invalidate(inname)  # burnt in place
+        options = sidecode + bstr + ' -burn 0' + ' -l ' + mask
 
-        ok = os.system(cmd)
+        ok = Util.gdalUtil('gdal_rasterize', inname, os.path.join(vectdir, mask  + '.shp'), options)
 
         if ok == 0:
             self.logger.info('Completed image mask')
@@ -705,6 +1445,7 @@ class Image(object):
             ' --config USE_RRD YES ' +\
             inname +' 2 4 8 16 32 64'
 
+        Util.datasetCache.invalidate(inname)  # overviews are added to it
         command = shlex.split(cmd)
 
         ok = subprocess.Popen(command).wait()
@@ -714,28 +1455,37 @@ class Image(object):
         else:
             self.logger.error('Image pyramid scheme collapsed')
 
-    def vrt2RealImg(self, subset=None):
+    def vrt2RealImg(self, subset=None, outdir=None):
         """
         Used to convert a vrt to a tiff (or another image format)
+
+        **Parameters**
+
+            *subset* : not used
+
+            *outdir* : write the image here (eg. imgDir when it is the final product), 
+                       otherwise it is an intermediate (tmpDir or memory)
         """
         
         inname = self.FileNames[-1]
         outname = os.path.splitext(inname)[0] + '_subset'+ self.imgExt
+        if outdir is not None:
+            outname = os.path.join(outdir, os.path.basename(outname))
+        else:
+            outname = self.intermediate(outname, Util.datasetBytes(Util.datasetCache.open(inname)))
+        Util.datasetCache.invalidate(outname)
         
-        cmd = '''gdal_translate -of {} -co "COMPRESS=LZW" -a_nodata 0 {} {}'''.format(self.imgFormat, inname, outname)
-            
-        command = shlex.split(cmd)
-        ok = subprocess.Popen(command).wait()
+        options = '''-of {} {} -a_nodata 0'''.format(self.imgFormat, self.creationOptions())
+        ok = Util.gdalUtil('gdal_translate', outname, inname, options)
 
         if self.imgFormat == 'GTiff' and ok != 0:
             self.logger.info('Normal write failed, attempting BigTiff write')
 
-            cmd = '''gdal_translate -of {} -co "COMPRESS=LZW" -co "BIGTIFF=YES" -a_nodata 0 {} {}'''.format(self.imgFormat, inname, outname)
-            command = shlex.split(cmd)
-            ok = subprocess.Popen(command).wait()
+            options = '''-of {} {} -co "BIGTIFF=YES" -a_nodata 0'''.format(self.imgFormat, self.creationOptions())
+            ok = Util.gdalUtil('gdal_translate', outname, inname, options)
 
         if ok == 0:
-            self.FileNames.append(outname)          ###
+            self.artifacts.add(outname, 'subset', final=outdir is not None)          ###
             self.logger.debug('Completed export to tiff ' + outname)
         else:
             self.logger.error('Image export failed')
@@ -744,6 +1494,8 @@ class Image(object):
         """
         Opens a raster and calculates (approx) the stats
         returns an array - 1 row per band
+        If the raster is a product just written by imgWrite, the stats come from the 
+        histograms collected then (see histStats)
         cols: band, dynamicRange, dataType, nodata value, min, max, mean, std
         
         **Returns**
@@ -753,6 +1505,14 @@ class Image(object):
 
         inname = self.FileNames[-1]
 
+        if self.productFiles.get(self.imgType) == inname and self.imgType in self.histograms:
+            # the product has not changed since imgWrite - no need to read it again
+            self.logger.info("Getting image stats for " + inname + " from its histograms")
+            stats = self.histStats()
+            if save_stats:
+                numpy.savetxt(inname[:-4] + "_stats.csv", stats, delimiter = ",")
+            return stats
+
         self.logger.info("Getting image stats for " + inname)
 
         self.openDataset(inname)
@@ -782,11 +1542,10 @@ class Image(object):
             
         return stats
 
-    def applyStretch(self, stats, procedure='std', sd=3, bitDepth=8, sep=False, inst = ''):
+    def applyStretch(self, stats, procedure='std', sd=3, bitDepth=8, sep=False, inst = '', pct=(2, 98), format=None):
         """
         Given an array of stats per band, will stretch a multiband image to the dataType based on
-        procedure (either std for standard deviation, with +ve int in keyword sd,
-        or min-max, also a linear stretch).
+        procedure (see stretchValues) and write it as a new file (_final or _inst)
 
         *A nodata value of 0 is used in all cases*
 
@@ -795,7 +1554,74 @@ class Image(object):
         **Note:** gdal_translate -scale does not honour nodata values
         See: http://trac.osgeo.org/gdal/ticket/3085
 
-        Have to run this one under the imgWrite code. The raster bands must be integer, float or byte
+        Have to run this one under the imgWrite code. 
+
+        To avoid the extra passes over the data, set stretch at init instead and a 
+        stretched product is made along with each product by imgWrite
+        
+        **Parameters**
+        
+            *stats* : Array of stats for a band, in arrary: band, range, dtype, nodata, min,max,mean,std
+            
+            *procedure* : std, min-max or percentile
+            
+            *sd* : # of standard deviations
+            
+            *bitDepth* : # of bits per pixel
+            
+            *sep* : False for same stretch to all bands, True for individual stretches
+
+            *pct* : low and high percentiles for the percentile stretch
+
+            *format* : vrt to write the stretch as a VRT view of the image (see stretchVRT), the 
+                       image is kept. Otherwise a byte copy replaces it
+        """
+
+        stretchVals = self.stretchValues(stats, procedure=procedure, sd=sd, bitDepth=bitDepth, sep=sep, pct=pct)
+        if stretchVals is None or isinstance(stretchVals, str):
+            return stretchVals
+
+        if format is not None and format.lower() == 'vrt':
+            if inst:
+                vrtname = os.path.splitext(self.FileNames[1])[0] + '_inst'+str(inst)+'.vrt'
+            else:
+                vrtname = os.path.splitext(self.FileNames[1])[0] + '_final.vrt'
+            Util.datasetCache.invalidate(vrtname)
+            inname = self.FileNames[-1]
+            if self.stretchVRT(stretchVals, inname, vrtname):
+                self.artifacts.add(vrtname, 'stretch', sources=[inname])
+                self.logger.info('Image stretched (vrt)... ')
+            return
+
+        filename = self.FileNames[-1]
+        self.openDataset(filename)
+
+        #write out a tif of this imgType
+        self.imgWrite(stretchVals=stretchVals)
+        self.inds = None
+        Util.datasetCache.invalidate(self.FileNames[-1])
+        
+        # delete original file and rename tmp
+        if inst:
+            stretchname = os.path.splitext(self.FileNames[1])[0] + '_inst'+str(inst)+'.tif'
+        else:
+            stretchname = os.path.splitext(self.FileNames[1])[0] + '_final.tif'
+        Util.renameFile(os.path.splitext(self.FileNames[1])[0] + '_temp_stretch.tif', stretchname) 
+        self.artifacts.remove(self.FileNames[-1])
+        self.artifacts.add(stretchname, 'stretch')
+
+        
+        self.logger.info('Image stretched... ')
+
+            
+    def stretchValues(self, stats, procedure='std', sd=3, bitDepth=8, sep=False, pct=(2, 98), imgType=None):
+        """
+        Given an array of stats per band, works out how to stretch a multiband image to the dataType 
+        based on procedure (either std for standard deviation, with +ve int in keyword sd,
+        min-max, or percentile which cuts at the pct percentiles of the histograms collected 
+        by imgWrite - all linear stretches).
+
+        The raster bands must be integer, float or byte
         and int data assumed to be only positive. Won't work very well for dB scaled data (obviously)
         it is important that noData is set to 0 and is meaningful.
 
@@ -816,6 +1642,14 @@ class Image(object):
             *bitDepth* : # of bits per pixel
             
             *sep* : False for same stretch to all bands, True for individual stretches
+
+            *pct* : low and high percentiles for the percentile stretch
+
+            *imgType* : product the histograms are from (percentile), defaults to self.imgType
+
+        **Returns**
+
+            *stretchVals* : array of band, scaleRange, dynRange, minVal, offset - 1 row per band
         """
         
         if procedure.lower() == 'std':
@@ -831,7 +1665,7 @@ class Image(object):
         scaleRange = (2**bitDepth)-2  #save 1 position for nodata and one for 0...
         
         # create an array with band number, scaleRange, dynRange, minVal, maxVal
-        stretchVals = numpy.zeros((self.n_bands, 5))
+        stretchVals = numpy.zeros((len(stats[:,0]), 5))
         for band in range(1,len(stats[:,0])+1):
             #go through each band to make the new array
             index = band-1
@@ -840,6 +1674,15 @@ class Image(object):
                 maxVal = stats[index, 5]
                 dynRange = stats[index, 1]
 
+            elif procedure.lower() == 'percentile':
+                if imgType is None:
+                    imgType = self.imgType
+                if imgType not in self.histograms:
+                    self.logger.error('No histogram for ' + imgType + ', percentile stretch needs imgWrite to collect one')
+                    return 'error'
+                minVal, maxVal = Util.histPercentile(self.histograms[imgType]['hist'][index], pct)
+                dynRange = maxVal-minVal
+
             elif procedure.lower() == 'std':
                 #determine -scale src (min max) dst (1 max)
                 mean = stats[index,6]
@@ -905,27 +1748,71 @@ class Image(object):
             # rebuild stretchVals with offset
             stretchVals[:,4] = 0
 
-        filename = self.FileNames[-1]
-        self.openDataset(filename)
+        return stretchVals
 
-        #write out a tif of this imgType
-        self.imgWrite(stretchVals=stretchVals)
-        self.inds = None
-        
-        # delete original file and rename tmp
-        if inst:
-            os.rename(os.path.splitext(self.FileNames[1])[0] + '_temp_stretch.tif', os.path.splitext(self.FileNames[1])[0] + '_inst'+str(inst)+'.tif') 
-            os.remove(self.FileNames[-1])
-            self.FileNames[len(self.FileNames)-1] = os.path.splitext(self.FileNames[1])[0] + '_inst'+str(inst)+'.tif'                 
-        else:
-            os.rename(os.path.splitext(self.FileNames[1])[0] + '_temp_stretch.tif', os.path.splitext(self.FileNames[1])[0] + '_final.tif') 
-            os.remove(self.FileNames[-1])
-            self.FileNames[len(self.FileNames)-1] = os.path.splitext(self.FileNames[1])[0] + '_final.tif'                 
+    def stretchVRT(self, stretchVals, inname, outname):
+        """
+        Writes a linear stretch as a byte VRT that points at the image instead of rewriting it. 
+        Each band gets a ComplexSource with a LUT that does what stretchLinear does (minVal 
+        goes to 1, minVal+dynRange to scaleRange+1, clamped outside of that) and a source 
+        NODATA so that nodata stays 0. Different stretches of the same image are then just 
+        small xml files.
 
-        
-        self.logger.info('Image stretched... ')
+        **Parameters**
+
+            *stretchVals* : array of band, scaleRange, dynRange, minVal, offset (see stretchValues)
+
+            *inname*      : image to stretch
+
+            *outname*     : name of the vrt
+
+        **Returns**
+
+            *ok*          : True if the vrt was written
+        """
+
+        # a byte vrt of the image with its georeferencing, to modify
+        Util.datasetCache.invalidate(outname)
+        ok = Util.gdalUtil('gdal_translate', outname, inname, '-of VRT -ot Byte -a_nodata 0')
+        if ok != 0:
+            self.logger.error('Could not make a vrt of ' + inname)
+            return False
+
+        if Util.isMemFile(outname):
+            vsifile = gdal.VSIFOpenL(outname, 'rb')
+            gdal.VSIFSeekL(vsifile, 0, 2)
+            size = gdal.VSIFTellL(vsifile)
+            gdal.VSIFSeekL(vsifile, 0, 0)
+            tree = ElementTree.ElementTree(ElementTree.fromstring(gdal.VSIFReadL(1, size, vsifile)))
+            gdal.VSIFCloseL(vsifile)
+        else:
+            tree = ElementTree.parse(outname)
+        for bandElem in tree.getroot().findall('VRTRasterBand'):
+            band = int(bandElem.get('band'))
+            scaleRange, dynRange, minVal, offset = stretchVals[band-1,1:5]
+            if not dynRange > 0:
+                self.logger.error('No dynamic range to stretch band ' + str(band))
+                return False
+
+            source = bandElem.find('SimpleSource')
+            if source is None:
+                source = bandElem.find('ComplexSource')
+            source.tag = 'ComplexSource'
+            for tag in ['NODATA', 'LUT', 'ScaleOffset', 'ScaleRatio']:
+                for elem in source.findall(tag):
+                    source.remove(elem)
+            ElementTree.SubElement(source, 'NODATA').text = '0'
+            low = minVal - offset   # stretchLinear adds the offset to the data first
+            lut = ElementTree.SubElement(source, 'LUT')
+            lut.text = '{!r}:1,{!r}:{:d}'.format(float(low), float(low+dynRange), int(scaleRange)+1)
+
+        if Util.isMemFile(outname):
+            gdal.FileFromMemBuffer(outname, ElementTree.tostring(tree.getroot()))
+        else:
+            tree.write(outname)
+        self.logger.debug('Stretch vrt written ' + outname)
+        return True
 
-            
     def stretchLinear(self, datachunk, scaleRange, dynRange, minVal, offset=0):
         """
         Simple linear rescale: where min (max) can be the actual min/max or mean+/- n*std or any other cutoff
@@ -952,16 +1839,8 @@ class Image(object):
 
         noDataVal = 0  # Hard coded here for now
 
-        datachunk = numpy.ma.masked_equal(datachunk, noDataVal)
-        datachunk = datachunk*1.0 #convert to float
-
-        datachunk = datachunk+offset # this adjusts the middles relative to each other
-        stretchData = scaleRange * (datachunk - minVal) / dynRange
-
-        stretchData = numpy.rint(stretchData) # turn into nearest integer
-        stretchData = numpy.clip(stretchData, 0, scaleRange)+1
-        #change stretchData to a regular array filled with nodata = 0
-        stretchData = numpy.ma.filled(stretchData, noDataVal)
+        # the offset adjusts the middles relative to each other, nodata stays 0
+        stretchData = Util.stretchChunk(datachunk, scaleRange, dynRange, minVal, offset, noDataVal)
 
         return stretchData
 
@@ -986,8 +1865,7 @@ class Image(object):
         if inname == None:
             inname = self.FileNames[-1]
             
-        gdal.AllRegister() # for all purposes
-        ds = gdal.Open(inname, GA_ReadOnly)
+        ds = Util.datasetCache.open(inname)
         n_cols = ds.RasterXSize
         n_lines = ds.RasterYSize
         bandobj = ds.GetRasterBand(band)
@@ -1000,77 +1878,81 @@ class Image(object):
 
     def cleanFiles(self, levels=['crop']):
         """
-        Removes intermediate files that have been written within the workflow.
+        Removes intermediate files that have been written within the workflow, now.
 
-        Input a list of items to delete: raw, nil, proj, crop
+        Input a list of the stages that made the files to delete: nil, stretch, proj, crop, subset
+        (only the files of the image being worked on, see FileNames)
         
         **Parameters**
             
             *levels* : a list of different types of files to delete
         """
-        deleteMe = []
-        if 'crop' in levels and len(self.FileNames) > 3:
-            for file in self.FileNames:
-                if 'crop' in file:
-                    deleteMe.append(file)
-        if 'proj' in levels and len(self.FileNames) > 2:
-            for file in self.FileNames:
-                if 'proj' in file:
-                    deleteMe.append(file)
-        if 'nil' in levels and len(self.FileNames) > 1:
-            deleteMe.append(self.tifname)
-            print(self.tifname)
-            #for file in self.FileNames:
-                #if 'nil' in file:   #this needs to be tested
-                    #deleteMe.append(glob.glob(file))
-                    
-        for filename in deleteMe:
-            if filename != []:
-                try:
-                    os.remove(filename)
-                    self.FileNames.remove(filename)
-                except:
-                    self.FileNames.remove(filename)
-                    
 
-    def getSigma(self, datachunk, n_lines):
+        for fname in list(self.FileNames[1:]):
+            if self.artifacts.stage(fname) in levels:
+                self.artifacts.remove(fname)
+
+    def retireFiles(self, levels, allProducts=False):
+        """
+        The files made by these stages will not be used any more: they are deleted as soon 
+        as nothing made from them (eg. a vrt) needs them (see Util.ArtifactRegistry)
+
+        **Parameters**
+            
+            *levels*      : a list of stages (nil, stretch, proj, crop, subset)
+
+            *allProducts* : True for the files of all products, not just the image being 
+                            worked on (see FileNames)
+        """
+
+        if allProducts:
+            self.artifacts.retireStage(levels)
+            return
+        for fname in list(self.FileNames[1:]):
+            if self.artifacts.stage(fname) in levels:
+                self.artifacts.retire(fname)
+
+    def getSigma(self, datachunk, n_lines, first_line=0, band=1):
         """
-        Calibrate data to Sigma Nought values (linear scale)
+        Calibrate data to Sigma Nought values (linear scale). S1 gains change along the 
+        image, they are interpolated for the lines of the chunk (see Metadata.lutGrid)
         
         **Parameters**
         
             *datachunk* : chunk of data being processed
             
             *n_lines* : size of the chunk
+
+            *first_line* : line of the image the chunk starts at
+
+            *band* : band of the raw data the chunk is from
             
         **Returns**
             
             *caldata* : calibrated chunk
         """
         
-        # create an array the size of datachunk that we'll fill with calibrated data
-        caldata = numpy.zeros((n_lines, self.n_cols), dtype=numpy.float32)
         ## note data are calibrated differently if they are slc or detected
+        if self.sattype == 'SEN-1':
+            gains = self.meta.lutGrid('sigma', self.polarization[band-1]).rows(first_line, n_lines)**2
+        elif datachunk.dtype == numpy.complex64 or datachunk.dtype == numpy.complex128:
+            gains = self.meta.calgain**2
+        else:
+            gains = self.meta.calgain
+
         if datachunk.dtype == numpy.complex64 or datachunk.dtype == numpy.complex128:
             #convert to detected image
             datachunk = pow(numpy.real(datachunk), 2) + pow(numpy.imag(datachunk), 2)
-            gains = self.meta.calgain**2
 
         elif self.sattype == 'SEN-1':
             datachunk = numpy.float32(datachunk)**2 # convert to float, prevent integer overflow
-            gains = self.meta.calgain**2
-            
 
         else:       # magnitude detected data
             datachunk = numpy.float32(datachunk)**2 # convert to float, prevent integer overflow
             datachunk = datachunk - self.meta.caloffset
-            gains = self.meta.calgain
-            
-        for i, gain in enumerate(gains):
-                caldata[:, i] = datachunk[:, i] / gain
 
-            
-        return caldata
+        # the gains are a row (one per column) or a grid the size of the chunk
+        return (datachunk / gains).astype(numpy.float32, copy=False)
 
 
     def getTheta(self, n_lines):
@@ -1083,11 +1965,15 @@ class Image(object):
             outdata[:,i] = self.meta.theta[i]
         return outdata
 
-    def getNoise(self, n_lines):
+    def getNoise(self, n_lines, first_line=0, band=1):
         """
-        For making an image with the noise floor as data
+        For making an image with the noise floor as data (for S1 the noise grid of the 
+        band, interpolated for the lines of the chunk)
         """
         
+        if self.sattype == 'SEN-1':
+            pol = self.polarization[min(band, len(self.polarization))-1]
+            return self.meta.lutGrid('noise', pol).rows(first_line, n_lines).copy()
         outdata = numpy.zeros((n_lines, self.n_cols), dtype=numpy.float32)
         for i in range(self.n_cols):
             outdata[:,i] = self.meta.noise[i]
@@ -1116,8 +2002,9 @@ class Image(object):
         """
         
         clipMax = (2**self.bitsPerSample)-2
-        outdata = numpy.clip(datachunk, 0, clipMax)
-        return outdata+1
+        outdata = numpy.clip(datachunk, 0, clipMax)   # a copy - datachunk is shared by the other products
+        outdata += 1
+        return outdata
 
     def getPhase(self, datachunk):
         """
@@ -1125,12 +2012,21 @@ class Image(object):
         """        
         return numpy.angle(datachunk)
 
-    def decomp(self, format='imgFormat'):
+    def decomp(self, format='imgFormat', power=False):
         """
         Takes an input ds of a fully polarimetric image and writes an image of
         the data using a pauli decomposition. 
 
         Differs from imgWrite because it ingests all bands at once...
+
+        Chunks are read and written in order while the decomposition of the chunks 
+        runs on a few threads (numpy releases the GIL). Output is Float32.
+
+        **Parameters**
+
+            *format* : gdal format code (gtiff, hfa) or imgFormat to use the one given at init
+
+            *power*  : also write |k|^2, the total power of the Pauli vector (span), as its own product
         """
 
         #Quick check to see if image supported
@@ -1139,6 +2035,7 @@ class Image(object):
             return  "error"
 
         chunkSize = 300 # seems to work ok, go lower if RAM is wimpy...
+        n_threads = min(4, os.cpu_count() or 1)
 
         ############################################## SETUP FOR OUTPUT
         #
@@ -1163,13 +2060,23 @@ class Image(object):
             self.logger.error('That image type is not supported')
             return "error"
 
-        outname = self.fnameGenerate()[2]
+        outname = self.fnameGenerate('amp')[2]
+        self.productBandNames['amp'] = self.bandNames
 
         n_bands = 3
 
         dataType = GDT_Float32  # use Float to avoid truncation
-        outds = driver.Create(outname+ext, self.n_cols, self.n_rows, n_bands,
-                              dataType, options)
+        outname = os.path.splitext(self.intermediate(outname+ext, self.n_cols * self.n_rows * n_bands * 4))[0]
+        Util.datasetCache.invalidate(outname+ext)
+        outputs = [['amp', driver.Create(outname+ext, self.n_cols, self.n_rows, n_bands,
+                                         dataType, options), n_bands, outname]]
+        if power:
+            spanname = self.fnameGenerate('span')[2]
+            spanname = os.path.splitext(self.intermediate(spanname+ext, self.n_cols * self.n_rows * 4))[0]
+            Util.datasetCache.invalidate(spanname+ext)
+            self.productBandNames['span'] = self.bandNames
+            outputs.append(['span', driver.Create(spanname+ext, self.n_cols, self.n_rows, 1,
+                                                  dataType, options), 1, spanname])
 
         ############################################## READ RAW DATA
         hh = self.inds.GetRasterBand(1)
@@ -1180,93 +2087,192 @@ class Image(object):
         #PROCESS IN CHUNKS
         n_chunks = int(self.n_rows / chunkSize + 1)
         n_lines = chunkSize
+        self.logger.info('Pauli decomposition in ' + str(n_chunks) + ' chunks on ' + str(n_threads) + ' threads')
 
-        for chunk in range( n_chunks ):
-
-            first_line = chunkSize*chunk
-            if chunk == n_chunks - 1:
-                n_lines = self.n_rows - first_line
-
-            # read in a chunk of data
-            datachunk_hh = gdal_array.BandReadAsArray(hh, 0, first_line,
-                                                   self.n_cols, n_lines )
-            datachunk_vv = gdal_array.BandReadAsArray(vv, 0, first_line,
-                                                   self.n_cols, n_lines )
-            datachunk_hv = gdal_array.BandReadAsArray(hv, 0, first_line,
-                                                   self.n_cols, n_lines )
-            datachunk_vh = gdal_array.BandReadAsArray(vh, 0, first_line,
-                                                   self.n_cols, n_lines )
-
-            #these are complex quantities single-bounce, volume scat. double-bounce
-            pauli1 =  numpy.abs( (datachunk_hh - datachunk_vv) / math.sqrt(2) )
-            pauli2 =  numpy.abs( ((datachunk_hv + datachunk_vh)/2.0)* math.sqrt(2) )
-            pauli3 =  numpy.abs(  (datachunk_hh + datachunk_vv) / math.sqrt(2) )
-
-            datachunk_hh, datachunk_vv, datachunk_hv, datachunk_vh = 0, 0, 0, 0 #free memory
-
+        def writeChunk(first_line, pauli):
             # write computed bands from datachunk to outds
-            gdal_array.BandWriteArray( outds.GetRasterBand(1), pauli1.astype(float), 0, first_line )
-            gdal_array.BandWriteArray( outds.GetRasterBand(2), pauli2.astype(float), 0, first_line )
-            gdal_array.BandWriteArray( outds.GetRasterBand(3), pauli3.astype(float), 0, first_line )
-            # since the data are not calibrated, try output as int.  Watch for truncation... pauli.astype(float)
+            for imgType, outds, n_bands, name in outputs:
+                for band in range(1, n_bands+1):
+                    outdata = pauli[band-1] if imgType == 'amp' else pauli[3]
+                    gdal_array.BandWriteArray( outds.GetRasterBand(band), outdata, 0, first_line )
+                    self.accumulateHist(imgType, band, outdata, outds)
 
-            outds.FlushCache()   # flush all write cached data to disk
-            ##end chunk loop
+        pending = collections.deque()   # (first_line, future) in chunk order
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as pool:
+            for chunk in range( n_chunks ):
 
-        for i in range(1, 4):
-            outds.GetRasterBand(i).SetNoDataValue(0)  # if warranted (if before stats, then good)
-            outds.GetRasterBand(i).FlushCache()
-            outds.GetRasterBand(i).GetStatistics(False, True)
+                first_line = chunkSize*chunk
+                if chunk == n_chunks - 1:
+                    n_lines = self.n_rows - first_line
+                if n_lines <= 0:
+                    break
+
+                # read in a chunk of data (reads stay on this thread, GDAL datasets are not thread safe)
+                datachunks = [gdal_array.BandReadAsArray(bandobj, 0, first_line, self.n_cols, n_lines)
+                              for bandobj in [hh, vv, hv, vh]]
+                pending.append((first_line, pool.submit(pauliChunk, *datachunks, power=power)))
+                datachunks = None #free memory
+
+                # keep a few chunks in flight, write the oldest when it is done
+                while len(pending) > n_threads:
+                    writeChunk(pending[0][0], pending.popleft()[1].result())
+                ##end chunk loop
+
+            while pending:
+                writeChunk(pending[0][0], pending.popleft()[1].result())
 
         # finish the geotiff file
         if self.proj == 'nil':
-            if self.elevationCorrection:
+            if self.dem:
+                self.logger.info("Using terrain corrected GCPs with heights from DEM {}".format(self.dem))
+                gcp_list = self.correct_known_elevation()
+            elif self.elevationCorrection:
                 self.logger.info("Using terrain corrected GCPs with user input elevation = {} m".format(self.elevationCorrection))
                 gcp_list = self.correct_known_elevation()
+            else:
+                gcp_list = self.meta.geopts
+
+        for imgType, outds, n_bands, name in outputs:
+            outds.FlushCache()   # flush all write cached data to disk
+            for i in range(1, n_bands+1):
+                stats = self.histStats(imgType)[i-1]
+                outds.GetRasterBand(i).SetNoDataValue(0)  # if warranted (if before stats, then good)
+                outds.GetRasterBand(i).SetStatistics(stats[4], stats[5], stats[6], stats[7])
+
+            if self.proj == 'nil':
                 outds.SetGCPs(gcp_list, self.meta.geoptsGCS)
             else:
-                outds.SetGCPs(self.meta.geopts, self.meta.geoptsGCS)
-        else:
-            # copy the proj info from before...
-            outds.SetGeoTransform(self.inds.GetGeoTransform())
-            outds.SetProjection(self.inds.GetProjection())
+                # copy the proj info from before...
+                outds.SetGeoTransform(self.inds.GetGeoTransform())
+                outds.SetProjection(self.inds.GetProjection())
 
-        self.FileNames.append(outname+ext)
-        self.logger.debug('Image written ' + outname+ext)
+            self.artifacts.add(name+ext, 'nil')
+            self.productFiles[imgType] = name+ext
+            self.logger.debug('Image written ' + name+ext)
 
-        outds = None         # release the dataset so it can be close
+        outputs = None         # release the dataset(s) so they can be closed
         
     def removeHandler(self):
         self.logger.handlers = []
     
     def cleanFileNames(self):
-        temp = [0,0]
-        temp[0] = self.FileNames[0]
-        temp[1] = self.FileNames[1]
-        self.FileNames = temp  
+        self.artifacts.chain = self.artifacts.chain[:2]
         
-    def compress(self):
+    def compress(self, outdir=None):
         '''
-        Use GDAL to LZW compress an image
+        Use GDAL to LZW compress an image (or keep the compact sigma encoding, if used)
+
+        If outdir is given (eg. imgDir for the final product) the compressed image is 
+        written there directly and replaces the uncompressed one in FileNames
         '''
         
         inname = os.path.splitext(self.FileNames[-1])[0]
+        if outdir is None:
+            outname = inname + '_tmp.tif'
+        else:
+            outname = os.path.join(outdir, os.path.basename(inname) + '.tif')
         
-        command = "gdal_translate -of GTiff -co COMPRESS=LZW -a_nodata 0 " + inname + '.tif ' + inname + '_tmp.tif'
-        os.system(command)
+        Util.datasetCache.invalidate(outname)
+        ok = Util.gdalUtil('gdal_translate', outname, inname + '.tif', "-of GTiff " + self.creationOptions() + " -a_nodata 0")
+        if ok != 0:
+            self.logger.error('Image compression failed')
+            return
         
-        os.remove(inname+'.tif')
-        os.rename(inname+'_tmp.tif', inname+'.tif')
+        if outdir is None:
+            stage = self.artifacts.stage(inname+'.tif') or 'compress'
+            Util.datasetCache.invalidate(inname+'.tif')
+            Util.removeFile(inname+'.tif')
+            Util.renameFile(outname, inname+'.tif')
+            self.artifacts.add(inname+'.tif', stage)
+        else:
+            self.artifacts.remove(inname+'.tif')
+            self.artifacts.add(outname, 'compress', final=True)
+
+    def demHeights(self, lat, lng):
+        """
+        Samples the DEM (self.dem, any raster gdal can read, in projDir unless the path is 
+        absolute) at the tie points with bilinear interpolation. Heights are cached per 
+        granule and DEM (Image.demHeightCache) so that every product and every pass on 
+        the scene reuses them. Tie points off the DEM or on its nodata get the processing 
+        height (no correction). Heights should be relative to the same reference as the 
+        processing height (the ellipsoid).
+
+        **Parameters**
+
+            *lat* : N x M tie point latitudes (degrees)
+
+            *lng* : N x M tie point longitudes (degrees)
+
+        **Returns**
+
+            *heights* : N x M heights in meters
+        """
+
+        key = (self.meta.dimgname, self.dem)
+        if key in Image.demHeightCache:
+            return Image.demHeightCache[key]
+
+        demfile = self.dem if os.path.isabs(self.dem) else os.path.join(self.projdir, self.dem)
+        ds = gdal.Open(demfile, GA_ReadOnly)
+        if ds is None:
+            self.logger.error('Could not open DEM ' + demfile + ', using the processing height')
+            return numpy.full(lat.shape, float(self.meta.h_proc))
+
+        # tie points to the DEM's coordinates
+        demSRS = osr.SpatialReference()
+        demSRS.ImportFromWkt(ds.GetProjection())
+        llSRS = osr.SpatialReference()
+        llSRS.ImportFromEPSG(4326)
+        for ref in [demSRS, llSRS]:
+            if hasattr(ref, 'SetAxisMappingStrategy'):  # GDAL 3 - keep x = lng, y = lat
+                ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        trans = osr.CoordinateTransformation(llSRS, demSRS)
+        pts = numpy.array(trans.TransformPoints(numpy.column_stack([lng.ravel(), lat.ravel()]).tolist()))
+
+        invGeo = gdal.InvGeoTransform(ds.GetGeoTransform())
+        if len(invGeo) == 2:  # GDAL 2 returns (success, geotransform)
+            invGeo = invGeo[1]
+        col = invGeo[0] + invGeo[1]*pts[:,0] + invGeo[2]*pts[:,1] - 0.5   # from pixel centres
+        row = invGeo[3] + invGeo[4]*pts[:,0] + invGeo[5]*pts[:,1] - 0.5
+
+        heights = numpy.full(col.shape, numpy.nan)
+        inside = (col >= 0) & (row >= 0) & (col <= ds.RasterXSize-1) & (row <= ds.RasterYSize-1)
+        if inside.any():
+            # read only the window around the tie points
+            x0, y0 = int(col[inside].min()), int(row[inside].min())
+            x1 = min(int(col[inside].max())+2, ds.RasterXSize)
+            y1 = min(int(row[inside].max())+2, ds.RasterYSize)
+            band = ds.GetRasterBand(1)
+            dem = band.ReadAsArray(x0, y0, x1-x0, y1-y0).astype(float)
+            nodata = band.GetNoDataValue()
+            if nodata is not None:
+                dem[dem == nodata] = numpy.nan
+
+            c, r = col[inside]-x0, row[inside]-y0
+            c0 = numpy.minimum(c.astype(int), dem.shape[1]-2) if dem.shape[1] > 1 else numpy.zeros(c.shape, int)
+            r0 = numpy.minimum(r.astype(int), dem.shape[0]-2) if dem.shape[0] > 1 else numpy.zeros(r.shape, int)
+            c1, r1 = numpy.minimum(c0+1, dem.shape[1]-1), numpy.minimum(r0+1, dem.shape[0]-1)
+            fc, fr = c-c0, r-r0
+            heights[inside] = (dem[r0,c0]*(1-fc)*(1-fr) + dem[r0,c1]*fc*(1-fr) +
+                               dem[r1,c0]*(1-fc)*fr + dem[r1,c1]*fc*fr)
+        ds = None
+
+        missing = ~numpy.isfinite(heights)
+        if missing.any():
+            self.logger.info(str(missing.sum()) + ' tie points are off the DEM, using the processing height for them')
+            heights[missing] = float(self.meta.h_proc)
+        heights = heights.reshape(lat.shape)
+
+        Image.demHeightCache[key] = heights
+        return heights
 
     def correct_known_elevation(self):
         '''
         Transforms image GCPs based on a known elevation (rather than the default average)
-        '''
 
-        height_correction = float(self.elevationCorrection)
-
-        self.meta.tie_points['longitude'] = numpy.radians(self.meta.tie_points['longitude'])
-        self.meta.tie_points['latitude'] = numpy.radians(self.meta.tie_points['latitude'])
+        The elevation is self.elevationCorrection for the whole scene or, if self.dem is set,
+        the height of the DEM at each tie point (see demHeights)
+        '''
 
         #Get M by N matrix size and position of tie points
         tie_point_lines = numpy.unique(self.meta.tie_points['line'])
@@ -1274,26 +2280,17 @@ class Image(object):
         M = len(tie_point_pixels)
         N = len(tie_point_lines)
 
-            
-        def m_by_n_array(arr1, arr2=None):
-            if arr2:
-                x = numpy.empty((N,M), dtype=(float, 2))
-            else:
-                x = numpy.empty((N,M), dtype=float)
-            line = 0
-            for i in range(N):
-                for j in range(M):
-                    if arr2:
-                        x[i][j] = (arr1[(i+j)+line], arr2[(i+j)+line])
-                    else:
-                        x[i][j] = arr1[(i+j)+line]
-                line += M-1
-            return x
+        # tie points are listed line by line, so the N x M grids are just a reshape
+        # (radians are kept local, the metadata stays in degrees)
+        pixels = numpy.asarray(self.meta.tie_points['pixel'], dtype=float).reshape(N, M)
+        lines = numpy.asarray(self.meta.tie_points['line'], dtype=float).reshape(N, M)
+        lng_matrix = numpy.radians(numpy.asarray(self.meta.tie_points['longitude'], dtype=float)).reshape(N, M)
+        lat_matrix = numpy.radians(numpy.asarray(self.meta.tie_points['latitude'], dtype=float)).reshape(N, M)
 
-        pixels = m_by_n_array(self.meta.tie_points['pixel'])
-        lines = m_by_n_array(self.meta.tie_points['line'])
-        lng_matrix = m_by_n_array(self.meta.tie_points['longitude'])
-        lat_matrix = m_by_n_array(self.meta.tie_points['latitude'])
+        if self.dem:
+            height_correction = self.demHeights(numpy.degrees(lat_matrix), numpy.degrees(lng_matrix))
+        else:
+            height_correction = float(self.elevationCorrection)
 
         #Transform tie-points from geographic to cartesian space
         xuv, yuv, zuv = Util.geographic_to_cartesian(lat_matrix, lng_matrix, self.meta.ellip_maj, self.meta.ellip_min)
@@ -1327,12 +2324,9 @@ class Image(object):
                     D = (self.meta.n_cols-1-pixels)*self.meta.pixelSpacing-self.meta.gr0
             D_far = (self.meta.n_cols-1)*self.meta.pixelSpacing-self.meta.gr0
 
-            R = 0
-            for i in range(len(self.meta.gsr)):
-                    R += float(self.meta.gsr[i])*D**i
-            R_far = 0
-            for i in range(len(self.meta.gsr)):
-                    R_far += float(self.meta.gsr[i])*D_far**i
+            gsr = numpy.asarray(self.meta.gsr, dtype=float)[::-1]   # highest order first for polyval
+            R = numpy.polyval(gsr, D)
+            R_far = numpy.polyval(gsr, D_far)
 
         #Step 4: Calculate the distance of the satellite to center of ellipse, h_sat
         #This can be performed with the following calculations or by extracting the 
@@ -1384,12 +2378,122 @@ class Image(object):
         #Step 10: Convert back to lat lng and reset GCPs
         lat_corr, lng_corr = Util.cartesian_to_geographic(x_corr, y_corr, z_corr, self.meta.ellip_maj, self.meta.ellip_min)
 
-        gcp_list = []
-        for l in range(len(pixels)):
-            for p in range(len(pixels[l])):
-                if lat_corr[l][p] != 0:
-                    gcp_list.append(gdal.GCP(lng_corr[l][p], lat_corr[l][p], height_correction, pixels[l][p], lines[l][p]))
+        keep = lat_corr != 0
+        heights = numpy.broadcast_to(height_correction, pixels.shape)
+        gcp_list = [gdal.GCP(float(lng), float(lat), float(h), float(p), float(l)) for lng, lat, h, p, l in 
+                    zip(lng_corr[keep], lat_corr[keep], heights[keep], pixels[keep], lines[keep])]
 
         return gcp_list
 
-            
+
+def pixelGeometry(geom, transformer):
+    """
+    Transforms a geometry (in place) from georeferenced to pixel/line coordinates
+
+    **Parameters**
+
+        *geom*        : ogr geometry
+
+        *transformer* : gdal.Transformer of the image (georeferenced to pixel/line is the inverse)
+
+    **Returns**
+
+        *ok*          : False if a point could not be transformed
+    """
+
+    for i in range(geom.GetGeometryCount()):
+        if not pixelGeometry(geom.GetGeometryRef(i), transformer):
+            return False
+    if geom.GetPointCount() == 0:
+        return True
+    points = [geom.GetPoint_2D(i) for i in range(geom.GetPointCount())]
+    pixels, ok = transformer.TransformPoints(1, points)
+    if not all(ok):
+        return False
+    for i, pixel in enumerate(pixels):
+        geom.SetPoint_2D(i, pixel[0], pixel[1])
+    return True
+
+def scaleGCPs(gcps, looks):
+    """
+    Returns a copy of a list of GCPs with pixel/line positions that fit an image 
+    multilooked by looks (azimuth, range)
+    """
+
+    az, rg = looks
+    scaled = []
+    for gcp in gcps:
+        scaled.append(gdal.GCP(gcp.GCPX, gcp.GCPY, gcp.GCPZ, gcp.GCPPixel/rg, gcp.GCPLine/az, gcp.Info, gcp.Id))
+    return scaled
+
+
+def parseStretch(stretch):
+    """
+    Turns the stretch setting ('std 3', 'min-max', 'percentile 2 98') into keywords for 
+    stretchValues, None if blank
+    """
+
+    if stretch is None or isinstance(stretch, dict):
+        return stretch
+    items = stretch.replace(',', ' ').split()
+    if not items:
+        return None
+    procedure = items[0].lower()
+    if procedure == 'std' and len(items) > 1:
+        return {'procedure' : procedure, 'sd' : float(items[1])}
+    if procedure == 'percentile' and len(items) > 2:
+        return {'procedure' : procedure, 'pct' : (float(items[1]), float(items[2]))}
+    return {'procedure' : procedure}
+
+
+def parseSpeckle(speckle):
+    """
+    Turns the speckle setting ('lee', 'boxcar 5', 'refinedlee 7 3': filter, window size 
+    and looks) into (filter, size, looks), None if blank
+    """
+
+    if speckle is None or isinstance(speckle, tuple):
+        return speckle
+    items = speckle.replace(',', ' ').split()
+    if not items:
+        return None
+    method = items[0].lower().replace('_', '').replace('-', '')
+    size = int(items[1]) if len(items) > 1 else 5
+    looks = float(items[2]) if len(items) > 2 else 1.0
+    return (method, size, looks)
+
+
+def pauliChunk(hh, vv, hv, vh, power=False):
+    """
+    Pauli decomposition of a chunk of quad pol data. The complex input chunks are used as 
+    the work space (they are overwritten) so the only new array is the float32 output.
+
+    **Parameters**
+
+        *hh, vv, hv, vh* : complex chunks of each polarization
+
+        *power*          : also return |k|^2 (total power of the Pauli vector)
+
+    **Returns**
+
+        *pauli*          : float32 array of |HH-VV|, |HV+VH|, |HH+VV| all / sqrt(2) 
+                           (single-bounce, volume scat., double-bounce), then |k|^2 if power
+    """
+
+    n_out = 4 if power else 3
+    pauli = numpy.empty((n_out,) + hh.shape, dtype=numpy.float32)
+
+    hh += vv            # hh+vv
+    vv *= -2
+    vv += hh            # hh-vv
+    hv += vh            # hv+vh
+    numpy.abs(vv, out=pauli[0])
+    numpy.abs(hv, out=pauli[1])
+    numpy.abs(hh, out=pauli[2])
+    pauli[:3] *= 1 / math.sqrt(2)
+
+    if power:
+        numpy.square(pauli[0], out=pauli[3])
+        pauli[3] += numpy.square(pauli[1])
+        pauli[3] += numpy.square(pauli[2])
+    return pauli
@@ -17,8 +17,17 @@ later use, output to file, upload to database, etc.
 
 import os
 import binascii
+import array
+import collections
+import concurrent.futures
+import csv
+import dataclasses
 from xml.dom import minidom
+from xml.etree import ElementTree
+from zipfile import BadZipFile
 import datetime
+import json
+from functools import cached_property
 import math
 import numpy
 from scipy import interpolate
@@ -37,6 +46,7 @@ from osgeo.gdalconst import *
 from future.utils import iteritems
 
 import Util
+import Geometry
 import pdb
 
 D2R = math.pi / 180.0
@@ -197,6 +207,110 @@ asf_ceos_records = {
     '10-70-18-20' : 'sdr_hist_rec'
     }
 
+# CEOS record header: sequence number, the four record type codes, record length
+ceos_header = struct.Struct('>lBBBBl')
+
+# bump when the metadata read changes, so that cached metadata (see Metadata.saveCache) is read again
+metadata_version = 1
+
+# attributes that belong to a run (paths, logging) rather than the image, not cached
+cache_skip = ('logger', 'loghandler', 'path', 'location', 'granule', 'fname', 'image', 'metafile', 
+              'status', 'cacheFile', 'cacheKey', 'geopts', 'lutGrids')
+
+ceos_layouts = {}   # sattype: the fields above compiled by compileCEOSFields, on first use
+
+# the start of a processed data record (one image line) in the CDPF image file: the record 
+    # type codes and the lat of the first, mid and last pixel then their long (1e-6 deg)
+ceos_line_record = numpy.dtype({'names': ['key', 'coords'], 'formats': [('u1', (4,)), ('>i4', (6,))], 
+    'offsets': [4, 132], 'itemsize': 156})
+ceos_line_key = (50, 11, 18, 20)
+
+# RADARSAT-2 product.xml and lutSigma.xml
+# the values are found by parseXML in one pass of the file: (name, tag, type)
+# name is the Metadata attribute, the tag is the first element with that name 
+# (or tag@attribute for one of its attributes)
+
+def floats(text):
+    return [float(value) for value in text.split()]
+
+def float32s(text):
+    return numpy.array(text.split(), dtype=numpy.float32)
+
+rs2_product_fields = [
+    ('beam', 'beamModeMnemonic', str),
+    ('beams', 'beams', str),
+    ('polarization', 'polarizations', str),
+    ('freqSAR', 'radarCenterFrequency', float),
+    ('acDateTime', 'rawDataStartTime', str),
+    ('antennaPointing', 'antennaPointing', str),
+    ('passDirection', 'passDirection', str),
+    ('processingFacility', 'processingFacility', str),
+    ('lutApplied', 'lutApplied', str),
+    ('looks_Rg', 'numberOfRangeLooks', int),
+    ('looks_Az', 'numberOfAzimuthLooks', int),
+    ('bitsPerSample', 'bitsPerSample', int),
+    ('n_cols', 'numberOfSamplesPerLine', int),
+    ('n_rows', 'numberOfLines', int),
+    ('pixelSpacing', 'sampledPixelSpacing', float),
+    ('lineSpacing', 'sampledLineSpacing', float),
+    ('theta_near', 'incidenceAngleNearRange', str),
+    ('theta_far', 'incidenceAngleFarRange', str),
+    ('orbit', 'orbitDataFile', str),
+    ('copyright', 'product@copyright', str),
+    ('acquisitionType', 'acquisitionType', str),   # for terrain correction with known height
+    ('h_proc', 'geodeticTerrainHeight', float),
+    ('near_range', 'slantRangeNearEdge', float),
+    ('gr0', 'groundRangeOrigin', float),     # ground to slant range, first set only
+    ('gsr', 'groundToSlantRangeCoefficients', floats),
+    ('order_Az', 'lineTimeOrdering', str),
+    ('order_Rg', 'pixelTimeOrdering', str),
+    ('ellip_maj', 'semiMajorAxis', float),
+    ('ellip_min', 'semiMinorAxis', float),
+    ('sat_alt', 'satelliteHeight', float),
+    ('productType', 'productType', str),
+    ]
+
+# used to work out the attributes, not kept
+rs2_product_values = [
+    ('start', 'zeroDopplerTimeFirstLine', str),
+    ('stop', 'zeroDopplerTimeLastLine', str),
+    ('plat_lat', 'latitudeOffset', float),
+    ]
+
+# every one of these (the tie points) goes in an array
+rs2_tie_point_lists = {
+    'pixel': 'pixel',
+    'line': 'line',
+    'longitude': 'longitude',
+    'latitude': 'latitude',
+    'height': 'height',
+    }
+
+# one dict for each of these elements, with its attributes and the sub elements listed
+rs2_product_groups = {
+    'noise': ('referenceNoiseLevel', ['pixelFirstNoiseValue', 'stepSize',
+                                      'numberOfNoiseLevelValues', 'noiseLevelValues']),
+    'srgr': ('slantRangeToGroundRange', ['zeroDopplerAzimuthTime', 'groundRangeOrigin',
+                                         'groundToSlantRangeCoefficients']),
+    }
+
+rs2_lut_fields = [
+    ('caloffset', 'offset', float),
+    ('calgain', 'gains', float32s),
+    ]
+
+# Sentinel-1 calibration-*.xml and noise-*.xml (annotation/calibration), one of each per 
+# polarization. The vectors are read with parseXML: {name: (tag, subtags)}
+s1_calibration_groups = {
+    'sigma': ('calibrationVector', ['line', 'pixel', 'sigmaNought']),
+    }
+s1_noise_groups = {
+    'noise': ('noiseRangeVector', ['line', 'pixel', 'noiseRangeLut']),
+    'noiseOld': ('noiseVector', ['line', 'pixel', 'noiseLut']),    # before IPF 2.9
+    'azimuth': ('noiseAzimuthVector', ['firstAzimuthLine', 'firstRangeSample', 'lastAzimuthLine', 
+                                       'lastRangeSample', 'line', 'noiseAzimuthLut']),
+    }
+
 # define global variables
 global gll
 global glr
@@ -213,7 +327,8 @@ class Metadata(object):
 
             *imgname* : image filename without extention 
 
-            *path* : path to the image in string format
+            *path* : path to the image in string format, can be a directory in the zip file 
+                     (see Util.zipPath) to read the metadata without unzipping
             
             *zipfile* : a valid zipfile name with full path and extension 
 
@@ -221,13 +336,17 @@ class Metadata(object):
 
             *loghandler* : A valid pre-set loghandler (Optional)
 
+            *cacheDir*   : directory of cached metadata (Optional). The metadata of a zip file 
+                           is read from there if the zip file has not changed, otherwise it 
+                           is saved there (see saveCache)
+
         **Returns**
             
             An instance of Metadata
         """ 
 
 
-    def __init__(self, granule, imgname, path, zipfile, sattype, loghandler=None):     
+    def __init__(self, granule, imgname, path, zipfile, sattype, loghandler=None, cacheDir=None):     
         
         if loghandler != None:
             self.loghandler = loghandler             #Logging setup if loghandler sent, otherwise, set up a console only logging system
@@ -251,6 +370,17 @@ class Metadata(object):
         self.dimgname = imgname   # update dimgname after accessing meta
         self.status = "ok"
         self.fname = None
+        self.cacheFile = None
+
+        if cacheDir:
+            try:
+                self.cacheKey = Util.zipKey(zipfile) + '_' + str(metadata_version)
+                self.cacheFile = os.path.join(cacheDir, granule + '.npz')
+            except (OSError, BadZipFile) as e:
+                self.logger.debug("Metadata will not be cached: %s", e)
+            if self.cacheFile is not None and self.loadCache():
+                self.logger.debug("Metadata read from " + self.cacheFile)
+                return
         
         #pdb.set_trace()
         # now... image, describe thyself!
@@ -298,6 +428,78 @@ class Metadata(object):
         self.az_llul = Util.az(ll,ul)
         self.az_lrur = Util.az(lr,ur)
 
+        if self.cacheFile is not None:
+            self.saveCache()
+
+    def saveCache(self):
+        """
+        Saves the metadata to cacheFile (.npz): the arrays as they are, the GCPs as an 
+        array and everything else as json. calgain, noise and theta are saved if they 
+        have been worked out, so save again after using them to keep them as well
+        """
+
+        arrays = {'key': numpy.array(self.cacheKey)}
+        state = {}
+        for attr, value in self.__dict__.items():
+            if attr in cache_skip:
+                continue
+            if isinstance(value, numpy.ndarray):
+                arrays['array.' + attr] = value
+            elif isinstance(value, dict) and len(value) > 0 and \
+                    all(isinstance(v, numpy.ndarray) for v in value.values()):
+                for key, v in value.items():
+                    arrays['dict.' + attr + '.' + key] = v
+            else:
+                state[attr] = value
+
+        if getattr(self, 'geopts', None):
+            arrays['geopts'] = numpy.array([(gcp.GCPX, gcp.GCPY, gcp.GCPZ, gcp.GCPPixel, gcp.GCPLine) 
+                                            for gcp in self.geopts])
+            arrays['geoptIds'] = numpy.array([str(gcp.Id) for gcp in self.geopts])
+
+        try:
+            arrays['state'] = numpy.array(json.dumps(state, default=jsonValue))
+            tmpFile = self.cacheFile + '.tmp'
+            with open(tmpFile, 'wb') as fp:
+                numpy.savez(fp, **arrays)
+            os.replace(tmpFile, self.cacheFile)   # in one go, another process may be reading it
+        except (OSError, TypeError, ValueError) as e:
+            self.logger.debug("Could not cache the metadata: %s", e)
+
+    def loadCache(self):
+        """
+        Reads the metadata from cacheFile (see saveCache), if it is there and it was made 
+        from the same zip file and version of this module
+
+        **Returns**
+
+            *ok* : True if the metadata was read
+        """
+
+        if not os.path.isfile(self.cacheFile):
+            return False
+        try:
+            with numpy.load(self.cacheFile, allow_pickle=False) as cache:
+                if str(cache['key']) != self.cacheKey:
+                    return False
+                state = json.loads(str(cache['state']), object_hook=jsonObject)
+                for name in cache.files:
+                    kind, sep, attr = name.partition('.')
+                    if kind == 'array':
+                        state[attr] = cache[name]
+                    elif kind == 'dict':
+                        attr, sep, key = attr.partition('.')
+                        state.setdefault(attr, {})[key] = cache[name]
+                if 'geopts' in cache.files:
+                    state['geopts'] = tuple(gdal.GCP(x, y, z, pixel, line, 'info', str(gcpId)) 
+                        for (x, y, z, pixel, line), gcpId in zip(cache['geopts'].tolist(), cache['geoptIds'].tolist()))
+        except (OSError, KeyError, ValueError) as e:
+            self.logger.debug("Could not read the cached metadata: %s", e)
+            return False
+
+        self.__dict__.update(state)
+        return True
+
     def getgdalmeta(self):    #give better description, summarize fields, don't list all
         """
         Open file with gdal and get metadata that it can read. Limited!
@@ -310,18 +512,17 @@ class Metadata(object):
         if self.sattype == "ASF_CEOS":
             imgname = self.imgname + '.D'
         if self.sattype == "CDPF":
-            imgname = self.imgname + '.img'
+            self.getCEOSmetafile()
+            imgname = os.path.basename(self.image)
         if self.sattype == "RS2":
             imgname = 'product.xml'
         if self.sattype == "SEN-1":
             imgname = 'manifest.safe'
 
-	    ### register all drivers at once ... works for reading data but not for creating data sets
-        gdal.AllRegister() # for all purposes
         self.fname = os.path.join(self.path, imgname)
         
-	    ### now that the driver has been registered, use the stand-alone Open method to return a Dataset object
-        ds = gdal.Open(self.fname, GA_ReadOnly)
+	    ### open through the cache, Image opens the same file next
+        ds = Util.datasetCache.open(self.fname)
 
         #TODO, more info here
 
@@ -464,9 +665,10 @@ class Metadata(object):
             self.metafile = [os.path.join(self.path, self.imgname) + '.L']
         if self.sattype == "CDPF":
             fname = os.path.join(self.path, self.imgname)
-            leader = fname + ".led"
-            trailer = fname + ".trl"
-            self.image = fname + ".img"
+            # renamed by Util.getFilename, unless read from the zip file
+            leader = Util.findFile(fname, [".led", ".sarl"])
+            trailer = Util.findFile(fname, [".trl", ".sart"])
+            self.image = Util.findFile(fname, [".img", ".sard", "01f.sard"])
             self.metafile = [leader,trailer] # image hangs get_ceos_meta
             #self.allfiles = [leader,trailer,image];
             #return [leader,trailer]
@@ -502,10 +704,9 @@ class Metadata(object):
         for attr, value in iteritems(self.__dict__):
             ###tblmetadata is filled with this dict
 
-            if attr != 'geopts' and attr != 'noise' and attr != 'calgain' and \
-                        attr != 'theta':
+            if attr not in ('geopts', 'noise', 'calgain', 'theta', 'noiseLevels', 'srgr', 's1lut', 'lutGrids'):
                 try:
-                    if type(value) == type(self.calgain):
+                    if isinstance(value, numpy.ndarray):
                         metaDict[attr] = value.tolist()
                     else:
                         if is_it_int(value):
@@ -516,6 +717,14 @@ class Metadata(object):
                     metaDict[attr] = value
         return metaDict
 
+    def createRecord(self):
+        """
+        The fields of the metadata table as a MetaRecord (typed, see MetaRecord.fromMeta), 
+        lighter than createMetaDict to send between processes and upload in bulk
+        """
+
+        return MetaRecord.fromMeta(self)
+
     def get_ceos_metadata(self, *file_names):
         """
         Take file names as input and return a dictionary of metadata
@@ -554,76 +763,23 @@ class Metadata(object):
         #                file_names = (file_names,)
                 # Build record index
 
-        record_index = {}
-        for field in rsat_fields:
-            if field[0] in record_index:
-                record_index[field[0]].append(field)
-            else:
-                record_index[field[0]] = [field]
+        if self.sattype not in ceos_layouts:
+            ceos_layouts[self.sattype] = compileCEOSFields(rsat_fields)
+        layouts = ceos_layouts[self.sattype]
 
         # Extract from files
         result = {}
         for file_name in file_names:#
-        
-            fp = open(file_name, 'rb')
-
-
-            # Get file size
-            fp.seek(0,2)
-            file_size = fp.tell()
-
-            # Search the file
-            record_offset = 0
-
-            while record_offset < file_size:
-
-                fp.seek(record_offset,0)
-                header_data = fp.read(12)
-
-                #after reading 12 bytes, get the record identifier
-                record_key = str(byte2int(header_data[4])) + '-' + \
-                    str(byte2int(header_data[5])) + '-' + \
-                    str(byte2int(header_data[6])) + '-' + \
-                    str(byte2int(header_data[7]))
-
-                # read the record length from CEOS data
-                record_length = byte2int(header_data[8:12])
-                if record_key in rsat_records:
-                    record_name = rsat_records[record_key]
-                else:
-                    record_name = "Unknown Record"
-
-                # if we are looking for this record, then get data in record
-                if record_key in record_index:
-
-                    # read in the data in native format
-                    record_data = get_data_block(fp, record_offset, record_length)
-                    #
-
-                    # iterate through fields that are found in this record
-                    for field in record_index[record_key]:
-                        # determine if the field has repeat values (not a single value)
-                        if len(field)>5:
-                            field_result = [] #result will be a list
-                            # the repeat values info could be in a tuple
-                            if type(field[5]) == type(()):
-                                #then get the field type, size and offest
-                                count = get_field_value(record_data,field[5][0],field[5][1],field[5][2]-1)
-                            # the repeat value info is an integer (how many repeats)
-                            else:
-                                count = field[5]
-                            # get the values x the repeat number
-                            for i in range(count):
-                                field_result.append(get_field_value(record_data,field[2],field[3],field[4]+i*field[3]-1))
-
-                        # if the values don't repeat - single values
-                        else:
-                            field_result = get_field_value(record_data,field[2],field[3],field[4]-1)
-                        if type(field_result) == type(b''):
-                            field_result = debyte(field_result)
-                        result[field[1]] = str(field_result)  # add data to result dictionary
 
-                record_offset = record_offset + record_length
+            with Util.mapFile(file_name) as buf:
+                for record_offset, record_key, record_length in scanCEOSRecords(buf):
+                    # if we are looking for this record, then get data in record
+                    if record_key in layouts:
+                        record = readCEOSRecord(buf, record_offset, record_length, layouts[record_key])
+                        for name, field_result in record.items():
+                            if type(field_result) == type(b''):
+                                field_result = debyte(field_result)
+                            result[name] = str(field_result)  # add data to result dictionary
         return result
 
     def extractGCPs(self, interval):
@@ -639,58 +795,11 @@ class Metadata(object):
             *gcps (tuple)* : GCP's returned in tuple format
         """
 
-        file_name = self.image
-
-        fp = open(file_name, 'rb')
-
-
-        # Get file size
-        fp.seek(0,2)                ### Changes the current file position (records the number of bytes from 0 to 2)
-        file_size = fp.tell()
-
-        first = []
-        mid = []
-        last = []
-
-        line_num =-1
-        n_gcps = 0
-        record_offset = 0
-
-        # Search the file
-        while record_offset < file_size:
-
-            #Increase the number of lines
-            line_num = line_num + 1
-
-            fp.seek(record_offset,0)
-            header_data = fp.read(12)
-
-            # CEOS data is Big Endian, here is the code to read it:
-                # header one long int, four unsigned bytes, one long int
-            seq, sub1, type, sub2, sub3, record_length = struct.unpack('>lBBBBl', header_data)
-
-            record_key = str(sub1) +'-'+ str(type) +'-'+ str(sub2) +'-'+ str(sub3)
-
-            if record_key == '50-11-18-20':
-
-                fp.seek(record_offset+132,0) # go to start of coord data
-                coords_bin = fp.read(24)
-
-                coords_int = struct.unpack('>llllll', coords_bin)
-                
-                first.append((coords_int[3]/1e6, coords_int[0]/1e6))
-                mid.append((coords_int[4]/1e6, coords_int[1]/1e6))
-                last.append((coords_int[5]/1e6, coords_int[2]/1e6))
-
-
-            record_offset = (record_offset) + record_length
-
-        lines = list(range(0, line_num, interval))        ### Take every nth line (nth = interval)
-
-        # Make sure to extract the pixels from the last line
-        if line_num - 1 not in lines:
-            lines.append(line_num - 1)
+        with Util.mapFile(self.image) as buf:
+            coords, line_num, lines = readCEOSLineCoords(buf, interval)
 
+        lat = coords[:, :3] / 1e6       # first, mid and last pixel of each line
+        lon = coords[:, 3:] / 1e6
 
         pixels = [0.5, self.n_cols/2, self.n_cols - 0.5]
 
@@ -698,29 +807,18 @@ class Metadata(object):
 
         for i, line in enumerate(lines):            ### Iterate lines[]
             for j, pixel in enumerate(pixels):      ### Iterate pixels[]
-                img = (pixel, line+0.5)
-                if pixel == 0.5:
-                    coord = first[line]
-                elif pixel == self.n_cols/2:
-                    coord = mid[line]
-                elif pixel == self.n_cols -0.5:
-                    coord = last[line]
-
-
                 # Put into a GCP
                 gcp = gdal.GCP()
                 gcp.Id = str(i)+'_'+str(j)
                 gcp.Info = 'info'
-                gcp.GCPX = coord[0]
-                gcp.GCPY = coord[1]
+                gcp.GCPX = float(lon[i, j])
+                gcp.GCPY = float(lat[i, j])
                 gcp.GCPZ = 0.0
-                gcp.GCPPixel = img[0]
-                gcp.GCPLine = img[1]
+                gcp.GCPPixel = pixel
+                gcp.GCPLine = line+0.5
                 gcps.append(gcp)
 
-                n_gcps = n_gcps + 1
-
-                #gdal.GDAL_GCP_GCPX_get(gcp) # find out what made it into the gcp
+        n_gcps = len(gcps)
 
         self.geopts = tuple(gcps)
         self.n_geopts = n_gcps
@@ -734,10 +832,11 @@ class Metadata(object):
         """
 
         #Option 1 - get metadata from manifest.... 
-        xmldoc = minidom.parse(self.fname)
+        with Util.openFile(self.fname) as fp:
+            xmldoc = minidom.parse(fp)
         
         #Option 2 - find metadata in here.... 
-        dataset = gdal.Open(self.fname)
+        dataset = Util.datasetCache.open(self.fname)
         geotrans = dataset.GetGeoTransform()
         
         #These are priority fields
@@ -769,112 +868,128 @@ class Metadata(object):
         self.satellite = xmldoc.getElementsByTagName('safe:familyName')[0].firstChild.data + xmldoc.getElementsByTagName('safe:number')[0].firstChild.data
         self.copyright = "ESA"     #hardcoded
 
-        pathToCal = os.path.join(os.path.join(self.path, 'annotation'), 'calibration')
-        calFile = os.listdir(pathToCal)[0]
+        xmldoc.unlink()
+        self.getDimgname()   #CHECK TO SEE IF THIS WORKS
+        
+
+    def getS1calgain(self):
+        """
+        The sigma nought calibration of the first line for every column (first polarization), 
+        Image calibrates with the whole grid (see lutGrid)
+        """
+
+        return self.lutGrid('sigma', self.polarization[0]).rows(0, 1)[0]
+
+    def getS1luts(self):
+        """
+        Reads the calibration and noise annotation of every polarization (in parallel, a 
+        thread each) into grids: the lines and pixels of the vectors and their values
 
-        caldoc = minidom.parse(os.path.join(pathToCal, calFile))
+        **Returns**
 
-        s1CalPixels = caldoc.getElementsByTagName('pixel')[0].firstChild.data
-        s1CalPixels = s1CalPixels.split(' ')
-        s1CalPixels = [int(i) for i in s1CalPixels]
-        s1CalVals = caldoc.getElementsByTagName('sigmaNought')[0].firstChild.data
-        s1CalVals = s1CalVals.split(' ')
-        s1CalVals = [float(i) for i in s1CalVals]
+            *luts* : dict of arrays, pol.lut.line, pol.lut.pixel and pol.lut.values for 
+                     each polarization (HH...) and lut (sigma, noise) found
+        """
 
-        numCals = numpy.arange(0, self.n_cols, 1)
-        calgain = numpy.interp(numCals, s1CalPixels, s1CalVals)
+        pathToCal = os.path.join(os.path.join(self.path, 'annotation'), 'calibration')
+        names = Util.listDir(pathToCal)
+
+        def polFiles(pol):
+            files = []
+            for prefix in ('calibration-', 'noise-'):
+                found = [name for name in names if name.startswith(prefix) and 
+                         '-' + pol.lower() + '-' in name and name.endswith('.xml')]
+                files.append(os.path.join(pathToCal, found[0]) if found else None)
+            return files
+
+        def readPol(pol):
+            calFile, noiseFile = polFiles(pol)
+            luts = {}
+            if calFile is not None:
+                with Util.openFile(calFile) as fp:
+                    groups = parseXML(fp, groups=s1_calibration_groups)
+                luts['sigma'] = s1Grid(groups['sigma'], 'sigmaNought')
+            if noiseFile is not None:
+                with Util.openFile(noiseFile) as fp:
+                    groups = parseXML(fp, groups=s1_noise_groups)
+                if groups['noise']:
+                    luts['noise'] = s1Grid(groups['noise'], 'noiseRangeLut', groups['azimuth'])
+                elif groups['noiseOld']:
+                    luts['noise'] = s1Grid(groups['noiseOld'], 'noiseLut')
+            return pol, luts
+
+        grids = {}
+        with concurrent.futures.ThreadPoolExecutor(max(1, len(self.polarization))) as pool:
+            for pol, luts in pool.map(readPol, self.polarization):
+                for lut, (lines, pixels, values) in luts.items():
+                    grids[pol + '.' + lut + '.line'] = lines
+                    grids[pol + '.' + lut + '.pixel'] = pixels
+                    grids[pol + '.' + lut + '.values'] = values
+                if 'sigma' not in luts:
+                    self.logger.error('No calibration annotation for ' + pol)
+        return grids
+
+    def lutGrid(self, lut, pol):
+        """
+        The interpolator (Util.LutGrid) of a S1 calibration or noise grid, made on first use
 
-        self.calgain = calgain.astype(numpy.float32)
+        **Parameters**
 
-            #if self.order_Rg.lower() == 'decreasing':
-            #    self.calgain = self.calgain[::-1].copy()  # REVERSE!!
+            *lut* : sigma or noise
 
-        caldoc.unlink()
+            *pol* : polarization (HH, HV...)
+        """
 
-        xmldoc.unlink()
-        self.getDimgname()   #CHECK TO SEE IF THIS WORKS
-        
+        key = pol + '.' + lut
+        if key not in self.lutGrids:
+            self.lutGrids[key] = Util.LutGrid(self.s1lut[key + '.line'], self.s1lut[key + '.pixel'], 
+                                              self.s1lut[key + '.values'], self.n_cols)
+        return self.lutGrids[key]
 
-    def getRS2metadata(self):         #Get a better description for this function, summarize fields, don't list all
+    @cached_property
+    def s1lut(self):
         """
-        Open a Radarsat2 product.xml file and get all the required metadata
+        The S1 calibration and noise grids, read on first use (see getS1luts, {} for other sattypes)
         """
+        if self.sattype == 'SEN-1':
+            return self.getS1luts()
+        return {}
 
-        file = os.path.join(self.path, "product.xml")
+    @cached_property
+    def lutGrids(self):
+        return {}   # pol.lut: Util.LutGrid, see lutGrid
 
-        xmldoc = minidom.parse(os.path.join(self.path, file))
+    def getRS2metadata(self):         #Get a better description for this function, summarize fields, don't list all
+        """
+        Open a Radarsat2 product.xml file and get all the required metadata
+        """
 
-        # get all the 1:1 data first
+        fields = rs2_product_fields + rs2_product_values
+        with Util.openFile(os.path.join(self.path, "product.xml")) as fp:
+            meta = parseXML(fp, fields, rs2_tie_point_lists, rs2_product_groups)
+        for name, tag, convert in rs2_product_fields:
+            setattr(self, name, meta[name])
 
         '''Changed to 5 characters'''
-        self.beam = xmldoc.getElementsByTagName('beamModeMnemonic')[0].firstChild.data
         self.beam = self.beam + '_____'  # this will pad the beam name
         self.beam = self.beam[0:5] # keep this to 5 chars
 
-        self.beams = xmldoc.getElementsByTagName('beams')[0].firstChild.data
         self.n_beams = len(self.beams.split())
-        self.polarization = xmldoc.getElementsByTagName('polarizations')[0].firstChild.data
-        self.freqSAR = float(xmldoc.getElementsByTagName('radarCenterFrequency')[0].firstChild.data)
-        self.acDateTime = xmldoc.getElementsByTagName('rawDataStartTime')[0].firstChild.data
         self.acDateTime = readdate(self.acDateTime, self.sattype)
         self.acDOY = date2doy(self.acDateTime, float=True)
 
-        self.antennaPointing = xmldoc.getElementsByTagName('antennaPointing')[0].firstChild.data
-        self.passDirection = xmldoc.getElementsByTagName('passDirection')[0].firstChild.data
-        self.processingFacility = xmldoc.getElementsByTagName('processingFacility')[0].firstChild.data
-        self.lutApplied = xmldoc.getElementsByTagName('lutApplied')[0].firstChild.data
-        self.looks_Rg = int(xmldoc.getElementsByTagName('numberOfRangeLooks')[0].firstChild.data)
-        self.looks_Az = int(xmldoc.getElementsByTagName('numberOfAzimuthLooks')[0].firstChild.data)
-
-        self.bitsPerSample = int(xmldoc.getElementsByTagName('bitsPerSample')[0].firstChild.data)
-        self.n_cols = int(xmldoc.getElementsByTagName('numberOfSamplesPerLine')[0].firstChild.data)
-        self.n_rows = int(xmldoc.getElementsByTagName('numberOfLines')[0].firstChild.data)
-        self.pixelSpacing = float(xmldoc.getElementsByTagName('sampledPixelSpacing')[0].firstChild.data)
-        self.lineSpacing = float(xmldoc.getElementsByTagName('sampledLineSpacing')[0].firstChild.data)
-
-        self.theta_near = xmldoc.getElementsByTagName('incidenceAngleNearRange')[0].firstChild.data
-        self.theta_far = xmldoc.getElementsByTagName('incidenceAngleFarRange')[0].firstChild.data
-
-        self.orbit = xmldoc.getElementsByTagName('orbitDataFile')[0].firstChild.data
         self.orbit, tmp = self.orbit.split('_')
         self.orbit = int(self.orbit)
         self.sat_heading = None # get this later?
         self.satellite = 'Radarsat-2'
-        self.copyright = xmldoc.getElementsByTagName('product')[0].attributes["copyright"].value
-
-        #values for terrain correction with known height
-        self.acquisitionType = xmldoc.getElementsByTagName('acquisitionType')[0].firstChild.data
-        self.h_proc = float(xmldoc.getElementsByTagName('geodeticTerrainHeight')[0].firstChild.data)
-        self.near_range = float(xmldoc.getElementsByTagName('slantRangeNearEdge')[0].firstChild.data)
-        #self.t_first = xmldoc.getElementsByTagName('zeroDopplerTimeFirstLine')[0].firstChild.data
-        #self.t_last = xmldoc.getElementsByTagName('zeroDopplerTimeLastLine')[0].firstChild.data
-        self.tie_points = {
-                        'pixel': [],
-                        'line': [],
-                        'longitude': [],
-                        'latitude': [],
-                        'height': []
-                    }
-        for key,val in self.tie_points.items():
-            for node in xmldoc.getElementsByTagName(key):
-                val.append(float(node.firstChild.data))
-            val = numpy.array(val)
 
-        #INCIDENCE ANGLE (THETA)
-        # get the ground to slant range inputs (from first set of data only)
-        sr2gr = xmldoc.getElementsByTagName('slantRangeToGroundRange')[0]
-        self.gr0 = float(sr2gr.getElementsByTagName('groundRangeOrigin')[0].firstChild.data)
-        gsr = sr2gr.getElementsByTagName('groundToSlantRangeCoefficients')[0].firstChild.data
-        gsr = gsr.split()
-        for i in range(len(gsr)):
-                gsr[i] = float(gsr[i])
-        self.gsr = gsr
-        self.order_Az = xmldoc.getElementsByTagName('lineTimeOrdering')[0].firstChild.data
-        self.order_Rg = xmldoc.getElementsByTagName('pixelTimeOrdering')[0].firstChild.data
+        # tie points for terrain correction with known height (numpy arrays)
+        self.tie_points = dict((key, meta[key]) for key in rs2_tie_point_lists)
 
+        #INCIDENCE ANGLE (THETA)
         #check that the gsr will be ok for the entire scene (valid for about 2 min)
-        start = xmldoc.getElementsByTagName('zeroDopplerTimeFirstLine')[0].firstChild.data
-        stop = xmldoc.getElementsByTagName('zeroDopplerTimeLastLine')[0].firstChild.data
+        start = meta['start']
+        stop = meta['stop']
         if self.order_Az.lower() == 'decreasing':
             duration = readdate(start,self.sattype)-readdate(stop,self.sattype)
         elif self.order_Az.lower() == 'increasing':
@@ -887,33 +1002,88 @@ class Metadata(object):
             self.notes.append('Warning SRGR coefficient issue, image duration is '+ str(duration.seconds))
 
 
-        slantRange = getSlantRange(gsr, self.pixelSpacing, self.n_cols, self.order_Rg, self.gr0)
+        self.radius = getEarthRadius(self.ellip_maj, self.ellip_min, meta['plat_lat'])
 
-        self.ellip_maj = float(xmldoc.getElementsByTagName('semiMajorAxis')[0].firstChild.data)
-        self.ellip_min = float(xmldoc.getElementsByTagName('semiMinorAxis')[0].firstChild.data)
-        self.sat_alt = float(xmldoc.getElementsByTagName('satelliteHeight')[0].firstChild.data)
-        plat_lat = float(xmldoc.getElementsByTagName('latitudeOffset')[0].firstChild.data)
+        # every SRGR set and the line it is for, see getThetaGrid
+        first = readdate(start, self.sattype)
+        span = (readdate(stop, self.sattype) - first).total_seconds()
+        sets = meta['srgr'] or [{'zeroDopplerAzimuthTime': start, 'groundRangeOrigin': self.gr0,
+                                 'groundToSlantRangeCoefficients': ' '.join(str(c) for c in self.gsr)}]
+        setLines = []
+        for srgr in sets:
+            seconds = (readdate(srgr['zeroDopplerAzimuthTime'], self.sattype) - first).total_seconds()
+            setLines.append(seconds / span * (self.n_rows - 1) if span != 0 else 0.0)
+        self.srgr = {'line': numpy.array(setLines),
+                     'origin': numpy.array([float(srgr['groundRangeOrigin']) for srgr in sets]),
+                     'coefs': numpy.array([floats(srgr['groundToSlantRangeCoefficients']) for srgr in sets])}
 
-        radius = getEarthRadius(self.ellip_maj, self.ellip_min, plat_lat)
+        # theta, noise and calgain are worked out when they are first used
+        self.noiseLevels = meta['noise']
 
-        self.theta = getThetaVector(self.n_cols, slantRange, radius, self.sat_alt)*R2D # now in degrees
+        self.getDimgname()
 
-        self.productType = xmldoc.getElementsByTagName('productType')[0].firstChild.data
-        if self.productType == 'SLC': # then you might want groundRange
-            groundRange = getGroundRange(slantRange, radius, self.sat_alt)
+    @cached_property
+    def theta(self):
+        """
+        Incidence angle (degrees) of each column, worked out on first use (RS2, () otherwise)
+        """
+        if self.sattype == 'RS2':
+            slantRange = getSlantRange(self.gsr, self.pixelSpacing, self.n_cols, self.order_Rg, self.gr0)
+            return getThetaVector(self.n_cols, slantRange, self.radius, self.sat_alt)*R2D # now in degrees
+        return ()
+
+    @cached_property
+    def noise(self):
+        """
+        Noise level (power) of each column, worked out on first use (RS2, the first line of 
+        the first polarization for S1, () otherwise)
+        """
+        if self.sattype == 'RS2':
+            return self.getRS2noise()
+        if self.sattype == 'SEN-1' and self.polarization[0] + '.noise.values' in self.s1lut:
+            return self.lutGrid('noise', self.polarization[0]).rows(0, 1)[0]
+        return ()
+
+    @cached_property
+    def calgain(self):
+        """
+        Calibration gain of each column, read on first use (RS2 lutSigma.xml or the S1 
+        calibration annotation)
+        """
+        if self.sattype == 'RS2':
+            lut = self.getRS2lut()
+            self.caloffset = lut['caloffset']
+            return lut['calgain']
+        if self.sattype == 'SEN-1':
+            return self.getS1calgain()
+        return None
+
+    @cached_property
+    def caloffset(self):
+        """
+        Calibration offset, read on first use (RS2)
+        """
+        if self.sattype == 'RS2':
+            lut = self.getRS2lut()
+            self.calgain = lut['calgain']
+            return lut['caloffset']
+        return None
+
+    def getRS2noise(self):
+        """
+        Interpolate the sigma nought noise levels of product.xml to every column
+        """
 
         #NOISE VECTOR
-        noise = xmldoc.getElementsByTagName('referenceNoiseLevel')
-        for i in range(len(noise)):
-            test = noise[i].attributes["incidenceAngleCorrection"].value
-            if test == "Sigma Nought":
-                break    # break # preserve i as the index you want
-        FirstNoisePixel = int(noise[1].getElementsByTagName('pixelFirstNoiseValue')[0].firstChild.data)
-        stepSize = int(noise[1].getElementsByTagName('stepSize')[0].firstChild.data)
-        n_noise = int(noise[1].getElementsByTagName('numberOfNoiseLevelValues')[0].firstChild.data)
-        noiseLevelValues = noise[1].getElementsByTagName('noiseLevelValues')[0].firstChild.data
-        noiseList = noiseLevelValues.split()  #make a list
-        noiseList = [float(n) for n in noiseList]
+        noise = self.noiseLevels[1]  # the sigma nought one
+        for level in self.noiseLevels:
+            if level.get('incidenceAngleCorrection') == "Sigma Nought":
+                noise = level
+                break
+        FirstNoisePixel = int(noise['pixelFirstNoiseValue'])
+        stepSize = int(noise['stepSize'])
+        n_noise = int(noise['numberOfNoiseLevelValues'])
+        noiseList = floats(noise['noiseLevelValues'])
         
         nx = [npixel*stepSize+ FirstNoisePixel for npixel in range(n_noise)] #pixel numbers zero-based
         cubicspline = interpolate.splrep(nx, noiseList, s=0)  #cubic spline, no smoothing
@@ -921,37 +1091,52 @@ class Metadata(object):
         #no extrapolation before first pixel or after last pixel in noiseList
         interpnoise[0:FirstNoisePixel] = noiseList[0]
         interpnoise[nx[-1]:] = noiseList[-1]
-        self.noise = Util.getPowerScale(interpnoise)
+        noise = Util.getPowerScale(interpnoise)
        
         if self.order_Rg.lower() == 'decreasing':
-                self.noise = self.noise[::-1].copy() # REVERSE!!
-      
-        # done, clear file
-        xmldoc.unlink()
+                noise = noise[::-1].copy() # REVERSE!!
+        return noise
+
+    def getRS2lut(self):
+        """
+        Read the calibration offset and gains from lutSigma.xml
+
+        **Returns**
+
+            *lut* : dict of caloffset and calgain
+        """
 
         # get lut
         file = 'lutSigma.xml'
-        if os.path.isfile(os.path.join(self.path, file)):
-        # read in LUT
-            xmldoc = minidom.parse(os.path.join(self.path, file))
-        else:
+        if not Util.fileExists(os.path.join(self.path, file)):
             self.logger.error("lutSigma.xml cannot be found")
             #error handler
 
-        self.caloffset = float(xmldoc.getElementsByTagName('offset')[0].firstChild.data)
-        gains = xmldoc.getElementsByTagName('gains')[0].firstChild.data
-        gains = gains.split()
-        calgain = numpy.zeros(len(gains), numpy.float32)
-        for i in range(len(gains)):
-            calgain[i] = float(gains[i])
-        self.calgain = calgain
-
+        with Util.openFile(os.path.join(self.path, file)) as fp:
+            lut = parseXML(fp, rs2_lut_fields)
 
         if self.order_Rg.lower() == 'decreasing':
-                self.calgain = self.calgain[::-1].copy() # REVERSE!!
+                lut['calgain'] = lut['calgain'][::-1].copy() # REVERSE!!
+        return lut
 
-        xmldoc.unlink()
-        self.getDimgname()
+    def getThetaGrid(self, lines):
+        """
+        Incidence angle (degrees) of every column for the lines given, following the ground 
+        to slant range coefficients as they change along the image (RS2 only). theta is the 
+        same for the first set of coefficients only
+        
+        **Parameters**
+            
+            *lines* : list or array of image lines (zero-based)
+
+        **Returns**
+
+            *theta* : float32 array, lines x columns
+        """
+
+        slantRange = Geometry.slantRangeGrid(self.srgr['coefs'], self.srgr['origin'], self.srgr['line'], 
+                                             lines, self.pixelSpacing, self.n_cols, self.order_Rg)
+        return Geometry.incidenceAngle(slantRange, self.radius, self.sat_alt) * R2D
 
     def clean_metaCDPF(self, result):
         #ONLY CDPF
@@ -1307,6 +1492,185 @@ class Metadata(object):
     def removeHandler(self):
         self.logger.handlers = []
 
+@dataclasses.dataclass(slots=True)
+class MetaRecord:
+    """
+    The metadata of an image that goes in the metadata table (see Database.meta_columns), 
+    one typed field per column. A field the sattype does not have is None. 
+
+    Lists of records are uploaded by Database.metaBatch2db and written by writeRecords, 
+    recordColumns turns them into a column (numpy array) per field.
+    """
+
+    dimgname: str = None
+    granule: str = None
+    location: str = None
+    sattype: str = None
+    satellite: str = None
+    acDateTime: datetime.datetime = None
+    acDOY: float = None
+    beam: str = None
+    beams: str = None
+    n_beams: int = None
+    polarization: str = None
+    n_bands: int = None
+    n_cols: int = None
+    n_rows: int = None
+    bitsPerSample: int = None
+    pixelSpacing: float = None
+    lineSpacing: float = None
+    looks_Az: int = None
+    looks_Rg: int = None
+    freqSAR: float = None
+    lutApplied: str = None
+    antennaPointing: str = None
+    passDirection: str = None
+    order_Az: str = None
+    order_Rg: str = None
+    orbit: int = None
+    sat_heading: float = None
+    theta_near: float = None
+    theta_far: float = None
+    productType: str = None
+    processingFacility: str = None
+    copyright: str = None
+    notes: str = None
+    n_geopts: int = None
+    geom: str = None
+    geoptsSRID: int = None
+
+    @classmethod
+    def fromMeta(cls, meta):
+        """
+        The record of a Metadata instance, its attributes converted to the type of each field
+
+        **Parameters**
+
+            *meta* : Metadata (or anything with the attributes)
+        """
+
+        return cls(*[recordValue(getattr(meta, field.name, None), field.type) 
+                     for field in dataclasses.fields(cls)])
+
+    def asDict(self):
+        return {field.name: getattr(self, field.name) for field in dataclasses.fields(self)}
+
+    def row(self, columns):
+        """
+        The values for an insert of these columns (see Database.metaValues), geom is 
+        followed by geoptsSRID
+        """
+
+        values = []
+        for column in columns:
+            values.append(getattr(self, column))
+            if column == 'geom':
+                values.append(self.geoptsSRID)
+        return tuple(values)
+
+record_dtypes = {int: numpy.int64, float: numpy.float64, str: object, 
+                 datetime.datetime: 'datetime64[us]'}
+
+def recordValue(value, kind):
+    """
+    Converts a metadata attribute to the type of a MetaRecord field, None if it is missing 
+    or can not be converted
+
+    **Parameters**
+
+        *value* : attribute value
+
+        *kind*  : int, float, str or datetime.datetime
+    """
+
+    if value is None:
+        return None
+    if kind is str:
+        if isinstance(value, (list, tuple)):   # polarization (S1), notes
+            return ' '.join(str(v) for v in value)
+        return str(value)
+    if kind is datetime.datetime:
+        return value if isinstance(value, datetime.datetime) else None
+    try:
+        if kind is int:
+            return int(float(value))
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def recordColumns(records, names=None):
+    """
+    A list of MetaRecords as columns: a numpy array per field. Missing values are NaN for 
+    floats, NaT for dates and None for strings, int columns are masked arrays
+
+    **Parameters**
+
+        *records* : list of MetaRecord
+
+        *names*   : the fields wanted (all by default)
+
+    **Returns**
+
+        *columns* : dict of name: array, in the order of the fields
+    """
+
+    kinds = {field.name: field.type for field in dataclasses.fields(MetaRecord)}
+    names = names or list(kinds)
+    columns = {}
+    for name in names:
+        values = [getattr(record, name) for record in records]
+        kind = kinds[name]
+        if kind is int:
+            missing = numpy.array([value is None for value in values], dtype=bool)
+            data = numpy.array([0 if value is None else value for value in values], dtype=numpy.int64)
+            columns[name] = numpy.ma.MaskedArray(data, mask=missing)
+        elif kind is float:
+            columns[name] = numpy.array([numpy.nan if value is None else value for value in values], 
+                                        dtype=numpy.float64)
+        elif kind is datetime.datetime:
+            columns[name] = numpy.array([numpy.datetime64('NaT') if value is None else value for value in values], 
+                                        dtype=record_dtypes[kind])
+        else:
+            columns[name] = numpy.array(values, dtype=object)
+    return columns
+
+def writeRecords(records, fname, names=None):
+    """
+    Writes a list of MetaRecords to a csv file, or a Parquet file if fname ends with 
+    .parquet (needs pyarrow)
+
+    **Parameters**
+
+        *records* : list of MetaRecord
+
+        *fname*   : file to write (replaced)
+
+        *names*   : the fields wanted (all by default)
+    """
+
+    names = names or [field.name for field in dataclasses.fields(MetaRecord)]
+
+    if fname.lower().endswith('.parquet'):
+        import pyarrow          # only needed here
+        import pyarrow.parquet
+        arrays = []
+        for name, column in recordColumns(records, names).items():
+            if numpy.ma.isMaskedArray(column):
+                arrays.append(pyarrow.array(column.data, mask=numpy.ma.getmaskarray(column)))
+            else:
+                arrays.append(pyarrow.array(column, from_pandas=True))   # NaN and NaT are null
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(arrays, names=names), fname)
+        return
+
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        for record in records:
+            row = [getattr(record, name) for name in names]
+            writer.writerow(['' if value is None else 
+                             value.isoformat() if isinstance(value, datetime.datetime) else value 
+                             for value in row])
+
 def byte2int(byte):
     """
     Reads a byte and converts to an integer
@@ -1374,6 +1738,316 @@ def get_field_value(data, field_type, length, offset):
         #values are binary integers
         return byte2int(data_str)
 
+def ceosFormat(field_type, length):
+    """
+    numpy format of a CEOS field: big endian unsigned for binary integers, otherwise 
+    raw bytes (converted by convertCEOSValue)
+    """
+    if field_type == 'BI' and length in (1, 2, 4, 8):
+        return '>u' + str(length)
+    return 'V' + str(length)
+
+def convertCEOSValue(value, field_type):
+    """
+    Convert a raw field value (from ceosFormat) to its data type, as get_field_value does
+    """
+    if field_type == 'A':
+        return value
+    if field_type == 'AI':
+        return int(value)
+    if field_type == 'AF':
+        return float(value)
+    if field_type == 'BI':
+        return value if type(value) == type(1) else int.from_bytes(value, 'big')
+
+def compileCEOSFields(fields):
+    """
+    Compile a table of CEOS fields (eg. rsat_cdpf_fields) into a numpy structured dtype 
+    for each record type, so that all the fields of a record are read in one go. 
+    Fields may overlap. A field repeated a number of times found in the record itself is 
+    read separately.
+    
+    **Parameters**
+       
+        *fields* : list of CEOS fields (record key, name, type, length, start, [repeat])
+            
+    **Returns**
+        
+        *layouts* : {record key: (dtype, field types, variable repeat fields)}
+    """
+    layouts = collections.OrderedDict()
+    for field in fields:
+        if field[0] not in layouts:
+            layouts[field[0]] = ([], [], [], [], [])
+        names, formats, offsets, types, repeats = layouts[field[0]]
+        if len(field) > 5 and type(field[5]) == type(()):
+            repeats.append(field)
+            continue
+        fmt = ceosFormat(field[2], field[3])
+        if len(field) > 5:
+            fmt = (fmt, (field[5],))
+        names.append(field[1])
+        formats.append(fmt)
+        offsets.append(field[4]-1)
+        types.append(field[2])
+
+    for key, (names, formats, offsets, types, repeats) in layouts.items():
+        itemsize = 1
+        for fmt, offset in zip(formats, offsets):
+            itemsize = max(itemsize, offset + numpy.dtype(fmt).itemsize)
+        dtype = numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': itemsize})
+        layouts[key] = (dtype, types, repeats)
+    return layouts
+
+def scanCEOSRecords(buf):
+    """
+    Find the records of a CEOS file by reading their headers, one after the other
+    
+    **Parameters**
+       
+        *buf* : the file contents (see Util.mapFile)
+            
+    **Returns**
+        
+        *records* : list of (offset, record key, record length)
+    """
+    records = []
+    offset = 0
+    while offset + ceos_header.size <= len(buf):
+        seq, sub1, type, sub2, sub3, length = ceos_header.unpack_from(buf, offset)
+        records.append((offset, str(sub1) +'-'+ str(type) +'-'+ str(sub2) +'-'+ str(sub3), length))
+        if length <= 0:  # corrupt, stop here
+            break
+        offset = offset + length
+    return records
+
+def readCEOSRecord(buf, offset, length, layout):
+    """
+    Read the fields of one CEOS record
+    
+    **Parameters**
+       
+        *buf*    : the file contents (see Util.mapFile)
+
+        *offset* : where the record starts
+
+        *length* : record length
+
+        *layout* : the compiled fields of this record type (see compileCEOSFields)
+            
+    **Returns**
+        
+        *record* : {name: value}, repeated fields give a list
+    """
+    dtype, types, repeats = layout
+    data = bytes(buf[offset:offset+length]).ljust(dtype.itemsize, b'\0')
+    values = numpy.frombuffer(data, dtype, count=1).tolist()[0]
+
+    record = collections.OrderedDict()
+    for name, field_type, value in zip(dtype.names, types, values):
+        if isinstance(value, numpy.ndarray):
+            record[name] = [convertCEOSValue(v, field_type) for v in value.tolist()]
+        else:
+            record[name] = convertCEOSValue(value, field_type)
+
+    for field in repeats:
+        count = get_field_value(data, field[5][0], field[5][1], field[5][2]-1)
+        record[field[1]] = [get_field_value(data, field[2], field[3], field[4]+i*field[3]-1) for i in range(count)]
+    return record
+
+def readCEOSLineCoords(buf, interval):
+    """
+    Read the lat/long of every nth line of a CEOS image file (CDPF). The image lines are 
+    fixed length records after the file descriptor, so they are read as a strided array 
+    and only the records of the lines wanted are touched. Otherwise the records are found 
+    by their headers (scanCEOSRecords).
+    
+    **Parameters**
+       
+        *buf*      : the file contents (see Util.mapFile)
+
+        *interval* : line spacing between extractions
+            
+    **Returns**
+        
+        *coords*   : int array (lines x 6), see ceos_line_record
+
+        *line_num* : number of lines
+
+        *lines*    : the lines read, every nth and the last one
+    """
+    first_length = ceos_header.unpack_from(buf, 0)[5]
+    line_length = ceos_header.unpack_from(buf, first_length)[5] if len(buf) >= first_length + ceos_header.size else 0
+    line_num = (len(buf) - first_length) // line_length if line_length >= ceos_line_record.itemsize else 0
+
+    lines = list(range(0, line_num, interval))        ### Take every nth line (nth = interval)
+    # Make sure to extract the pixels from the last line
+    if line_num - 1 not in lines:
+        lines.append(line_num - 1)
+
+    records = None
+    if line_num > 0 and first_length + line_num * line_length == len(buf):
+        image = numpy.ndarray((line_num,), ceos_line_record, buffer=buf, offset=first_length, strides=(line_length,))
+        records = image[lines]      # a copy, only these records are read
+        del image       # let go of buf
+        if not (records['key'] == ceos_line_key).all():
+            records = None
+
+    if records is None:     # not all the same length, look at every record
+        offsets = []
+        headers = scanCEOSRecords(buf)
+        for offset, key, length in headers:
+            if key == '-'.join(str(code) for code in ceos_line_key):
+                offsets.append(offset)
+        line_num = len(headers) - 1
+
+        lines = list(range(0, line_num, interval))
+        if line_num - 1 not in lines:
+            lines.append(line_num - 1)
+
+        starts = numpy.array(offsets)[lines] + ceos_line_record.fields['coords'][1]
+        data = numpy.frombuffer(buf, numpy.uint8)
+        records = numpy.zeros(len(lines), ceos_line_record)
+        records['coords'] = data[starts[:, None] + numpy.arange(24)].copy().view('>i4')
+        del data
+
+    return records['coords'].astype(numpy.int64), line_num, lines
+
+def parseXML(source, fields=(), lists=None, groups=None):
+    """
+    Reads the values wanted from an xml file in one pass (iterparse), without building 
+    the document tree. Namespaces are ignored.
+    
+    **Parameters**
+       
+        *source* : xml file name or open file (eg. a zip member)
+
+        *fields* : list of (name, tag, type), the text of the first element with that tag 
+                   (or tag@attribute for one of its attributes) converted with type
+
+        *lists*  : {name: tag}, the text of every element with that tag, in a float array
+
+        *groups* : {name: (tag, subtags)}, a list with a dict for every element with that tag: 
+                   its attributes and the text of the first of each subtag inside it
+            
+    **Returns**
+        
+        *values* : dict of name: value (a field that is not found is left out)
+    """
+
+    texts = {}
+    attributes = {}
+    for name, tag, convert in fields:
+        element, sep, attribute = tag.partition('@')
+        if sep:
+            attributes.setdefault(element, []).append((name, attribute, convert))
+        else:
+            texts.setdefault(element, []).append((name, convert))
+    lists = lists or {}
+    listTags = dict((tag, name) for name, tag in lists.items())
+    collected = dict((name, array.array('d')) for name in lists)
+    groups = groups or {}
+    groupTags = dict((tag, (name, subtags)) for name, (tag, subtags) in groups.items())
+
+    values = dict((name, []) for name in groups)
+    group = None   # dict of the group element being read
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        tag = elem.tag.rpartition('}')[2]
+        if event == 'start':
+            if tag in attributes:
+                for name, attribute, convert in attributes[tag]:
+                    if name not in values and attribute in elem.attrib:
+                        values[name] = convert(elem.attrib[attribute])
+            if tag in groupTags:
+                group = dict(elem.attrib)
+            continue
+
+        text = (elem.text or '').strip()
+        if tag in listTags:
+            collected[listTags[tag]].append(float(text))
+        if tag in texts:
+            for name, convert in texts[tag]:
+                if name not in values:
+                    values[name] = convert(text)
+        if group is not None:
+            if tag in groupTags:
+                values[groupTags[tag][0]].append(group)
+                group = None
+            else:
+                for name, subtags in groupTags.values():
+                    if tag in subtags and tag not in group:
+                        group[tag] = text
+        elem.clear()   # done with it, keeps memory down
+
+    for name, data in collected.items():
+        values[name] = numpy.frombuffer(data, dtype=numpy.float64)
+    return values
+
+def s1Grid(vectors, lutTag, azimuth=()):
+    """
+    Puts the S1 calibration or noise vectors (see parseXML groups) together in a grid. When 
+    the vectors are not for the same pixels all are interpolated to all of the pixels. 
+
+    **Parameters**
+
+        *vectors* : list of dicts, with the line, pixel and lutTag text of each vector
+
+        *lutTag*  : the values (sigmaNought, noiseRangeLut...)
+
+        *azimuth* : noise azimuth vectors, to scale the noise of the lines and pixels they 
+                    cover (at the nodes of the grid)
+
+    **Returns**
+
+        *lines*   : line of each row (increasing)
+
+        *pixels*  : pixel of each column (increasing)
+
+        *values*  : float32 array (lines x pixels)
+    """
+
+    lines = numpy.array([float(vector['line']) for vector in vectors])
+    pixels = [numpy.array(vector['pixel'].split(), dtype=numpy.float64) for vector in vectors]
+    luts = [float32s(vector[lutTag]) for vector in vectors]
+
+    if all(len(p) == len(pixels[0]) and (p == pixels[0]).all() for p in pixels):
+        grid = numpy.vstack(luts)
+        common = pixels[0]
+    else:
+        common = numpy.unique(numpy.concatenate(pixels))
+        grid = numpy.vstack([numpy.interp(common, p, lut) for p, lut in zip(pixels, luts)])
+
+    lines, rows = numpy.unique(lines, return_index=True)  # in order, once each
+    grid = grid[rows].astype(numpy.float32)
+
+    for vector in azimuth:
+        inLines = (lines >= float(vector['firstAzimuthLine'])) & (lines <= float(vector['lastAzimuthLine']))
+        inPixels = (common >= float(vector['firstRangeSample'])) & (common <= float(vector['lastRangeSample']))
+        scale = numpy.interp(lines[inLines], floats(vector['line']), floats(vector['noiseAzimuthLut']))
+        grid[numpy.ix_(inLines, inPixels)] *= scale.astype(numpy.float32)[:, numpy.newaxis]
+
+    return lines, common, grid
+
+def jsonValue(value):
+    """
+    json for the values json can't handle itself (see Metadata.saveCache)
+    """
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    raise TypeError(type(value).__name__ + ' can not be cached')
+
+def jsonObject(obj):
+    """
+    Undo jsonValue (see Metadata.loadCache)
+    """
+    if '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
 def readdate(date, sattype):
     """
     Takes a Rsat2 formated date 2009-05-31T14:43:17.184550Z
@@ -1477,14 +2151,9 @@ def datetime2iso(datetimeobj):
 def getEarthRadius( ellip_maj, ellip_min, plat_lat):
     """
     Calculates the earth radius at the latitude of the satellite from the ellipsoid params
+    (see Geometry.earthRadius)
     """
-    ellip_maj = float(ellip_maj)
-    ellip_min = float(ellip_min)
-    plat_lat = float(plat_lat)
-    r =  ellip_min * ( \
-          math.sqrt( 1 + math.tan( plat_lat*D2R )**2 ) / \
-          math.sqrt( ((ellip_min**2) / (ellip_maj**2)) + math.tan( plat_lat*D2R )**2 ))
-    return r
+    return float(Geometry.earthRadius(ellip_maj, ellip_min, float(plat_lat)))
 
 def getSlantRange(gsr, pixelSpacing, n_cols, order_Rg, groundRangeOrigin=0.0):
     """
@@ -1492,39 +2161,16 @@ def getSlantRange(gsr, pixelSpacing, n_cols, order_Rg, groundRangeOrigin=0.0):
         pixelSpacing - the image resolution, n_cols - how many pixels in range
         ground range orig - for RSat2 (seems to be zero always)
 
-        Valid for SLC as well as SGF
+        Valid for SLC as well as SGF (see Geometry.slantRange)
     """
-
-    slantRange = numpy.zeros(n_cols, dtype=numpy.float32)
-    for j in range(n_cols):
-        slantRange[j] = gsr[0] \
-            + gsr[1] * (pixelSpacing * j - groundRangeOrigin)\
-            + gsr[2] * (pixelSpacing * j - groundRangeOrigin) ** 2 \
-            + gsr[3] * (pixelSpacing * j - groundRangeOrigin) ** 3 \
-            + gsr[4] * (pixelSpacing * j - groundRangeOrigin) ** 4 \
-            + gsr[5] * (pixelSpacing * j - groundRangeOrigin) ** 5
-
-    if order_Rg.lower() == 'decreasing':  #see Altrix doc (applies to all SAR sats - I think)
-            slantRange = slantRange[::-1].copy()
-
-    return slantRange
+    return Geometry.slantRange(gsr, pixelSpacing, n_cols, order_Rg, groundRangeOrigin)
 
 def getGroundRange(slantRange, radius, sat_alt):
     """
     Finds the ground range from nadir which corresponds to a given slant range
-    must be an slc image, must have calculated the slantRange first
+    must be an slc image, must have calculated the slantRange first (see Geometry.groundRange)
     """
-
-    ## is this for the start of pixel, end of pixel or middle?
-    ## if this is applied (through resampling) how does it affect the GCPs
-
-    #if not 'SLC' don't continue
-    r, R, A = slantRange, radius, sat_alt
-    #make sure r is a numpy array or a single value
-
-    numer = A*A + 2*A*R + 2*R*R - r*r
-    denom = 2*A*R + 2*R*R
-    return R*numpy.arccos(numer/denom)
+    return Geometry.groundRange(slantRange, radius, sat_alt)
 
 def getThetaPixel(RS, r, h):
     """
@@ -1536,13 +2182,9 @@ def getThetaPixel(RS, r, h):
 
 def getThetaVector(n_cols, slantRange, radius, sat_alt):
     """
-    Make a vector of incidence angles in range direction
+    Make a vector of incidence angles in range direction (see Geometry.incidenceAngle)
     """
-
-    thetaVector = numpy.zeros(n_cols, dtype=numpy.float32)
-    for j in range(len(thetaVector)):
-        thetaVector[j] = getThetaPixel(slantRange[j], radius, sat_alt)
-    return thetaVector
+    return Geometry.incidenceAngle(slantRange[:n_cols], radius, sat_alt)
     
 def debyte(bb):
     """
@@ -30,13 +30,15 @@ import logging
 import shutil
 import time
 import csv
+import multiprocessing
+import functools
 from time import localtime, strftime
 from glob import glob
-from func_timeout import func_timeout
+from func_timeout import func_timeout, FunctionTimedOut
 #from builtins import input
 
-from Database import Database
-from Metadata import Metadata
+from Database import Database, meta_columns
+from Metadata import Metadata, writeRecords
 from Image import Image
 from Query import Query
 import Util
@@ -55,6 +57,9 @@ class SigLib:
         self.vectDir = str(os.path.abspath(os.path.expanduser(config.get("Directories","vectDir"))))
         self.logDir = str(os.path.abspath(os.path.expanduser(config.get("Directories","logDir"))))
         self.outDir = str(os.path.abspath(os.path.expanduser(config.get("Directories","outDir"))))
+        self.metaCache = str(config.get("Directories", "metaCache", fallback=''))  # cached metadata, blank for none
+        if self.metaCache != '':
+            self.metaCache = str(os.path.abspath(os.path.expanduser(self.metaCache)))
         
         self.dbName = str(config.get("Database", "db"))
         self.dbHost = str(config.get("Database", "host"))
@@ -79,10 +84,24 @@ class SigLib:
         self.roiProjSRID = str(config.get('MISC',"roiProjSRID"))
         self.spatialrel = str(config.get('MISC',"spatialrel"))
         self.imgType = str(config.get('MISC',"imgTypes"))
+        self.imgTypes = self.imgType.replace(',', ' ').split()   # several products can be made in one pass
         self.imgFormat = str(config.get('MISC',"imgFormat"))
         self.uploadData = str(config.get("MISC", "uploadResults"))
 
         self.elevation_correction = str(config.get('MISC', "elevationCorrection"))
+        self.dem = str(config.get('MISC', "dem", fallback=''))  # DEM in projDir for per GCP heights
+        self.memIntermediates = str(config.get('MISC', "memIntermediates", fallback=''))  # MB, intermediates this small stay in memory
+        self.tmpBudget = str(config.get('MISC', "tmpBudget", fallback=''))  # MB of intermediates allowed in tmpDir
+        self.bandMath = str(config.get('MISC', "bands", fallback=''))  # band math expressions, evaluated while calibrating
+        self.encoding = str(config.get('MISC', "encoding", fallback=''))  # compact encoding of sigma products
+        self.discardLSB = str(config.get('MISC', "discardLSB", fallback=''))
+        self.multilook = str(config.get('MISC', "multilook", fallback=''))  # azimuth x range looks
+        self.stretch = str(config.get('MISC', "stretch", fallback=''))  # byte products made by imgWrite
+        self.speckle = str(config.get('MISC', "speckle", fallback=''))  # speckle filter for sigma
+        self.stretchFormat = str(config.get('MISC', "stretchFormat", fallback=''))
+        self.catalogueWorkers = str(config.get('MISC', "catalogueWorkers", fallback=''))  # processes reading metadata
+        self.catalogueBatch = str(config.get('MISC', "catalogueBatch", fallback=''))  # images uploaded at once
+        self.catalogueExport = str(config.get('MISC', "catalogueExport", fallback=''))  # csv or parquet of the records
 
         self.issueString = ""
         self.zipname = None
@@ -150,6 +169,8 @@ class SigLib:
             self.logger.error("Image processing exception, moving to next image")
             self.bad_img = 1
 
+        Util.datasetCache.clear()  # close the granule's files before they are removed
+        Util.clearMemFiles()  # and free the in-memory intermediates
         if cleanup:
             os.chdir(self.tmpDir)
             try:
@@ -161,22 +182,22 @@ class SigLib:
         good_img = self.count_img - self.bad_img
         self.logger.info("%i images were successfully processed out of %i", good_img, self.count_img)
 
-    def proc_Dir(self, path, pattern):
+    def findZips(self, path, pattern):
         """
-        Locates satelite image raw data files (zipfiles) using a
-        *pattern* in *path* search method, and then calls createImg()
-        to process the data into image.
+        Finds the satellite image zip files in the *path* tree that match *pattern*, 
+        or that are listed in the csv or txt files that match it
 
         **Parameters**
             
             *path*    : directory tree to scan
 
-            *pattern* : file pattern to discover
+            *pattern* : file pattern to discover (*.zip, *.csv or *.txt)
+
+        **Returns**
+
+            *ziproots* : sorted list of zip files, None if the pattern is not accepted
         """
-            
-        self.logger = self.createLog()
-        self.logger = logging.getLogger(__name__)
-                
+
         ziproots = []           # List of the zip files (dirpath + *.zip: '/xx/yy/zz/*.zip')
 
         # Returns a list 'ziproots' of the zip files with the specified path and pattern
@@ -204,14 +225,35 @@ class SigLib:
 
             else:
                 self.logger.error("Unaccepted pattern, aborting!")
-                return Exception
+                return None
 
             ziproots = fileList
             print(ziproots)
 
+        ziproots.sort() # Nice to have this in some kind of order
+        return ziproots
+
+    def proc_Dir(self, path, pattern):
+        """
+        Locates satelite image raw data files (zipfiles) using a
+        *pattern* in *path* search method, and then calls createImg()
+        to process the data into image.
+
+        **Parameters**
+            
+            *path*    : directory tree to scan
+
+            *pattern* : file pattern to discover
+        """
+            
+        self.logger = self.createLog()
+        self.logger = logging.getLogger(__name__)
+
+        ziproots = self.findZips(path, pattern)
+        if ziproots is None:
+            return Exception
 
         self.logger.info('Found %i files to process', len(ziproots))
-        ziproots.sort() # Nice to have this in some kind of order
         
         # Process every zipfile in ziproots 1 by 1
         for zipfile in ziproots:
@@ -235,6 +277,8 @@ class SigLib:
                 self.bad_img += 1
                   
             # Do clean-up
+            Util.datasetCache.clear()  # close the granule's files before they are removed
+            Util.clearMemFiles()  # and free the in-memory intermediates
             os.chdir(self.tmpDir)
             try:
                 shutil.rmtree(os.path.splitext(os.path.basename(self.zipname))[0])
@@ -252,6 +296,124 @@ class SigLib:
         #del sys.modules['Database']
         #del sys.modules['Util']
 
+    def catalogue(self, path, pattern):
+        """
+        Uploads the metadata of every zip file found (see findZips) to the metadata table. 
+        Same result as proc_Dir with metaUpload alone but much faster: a pool of processes 
+        (catalogueWorkers, one per cpu by default) reads the metadata straight from the zip 
+        files and it is uploaded catalogueBatch images at a time (see Database.metaBatch2db).
+        
+        Progress is logged, the zip files that failed and why are listed in 
+        <cfg>_<starttime>_failures.csv in logDir (the workers log to <cfg>_<starttime>_worker<pid>.log). 
+        The metadata records are also written to catalogueExport (csv or parquet) if it is set
+
+        **Parameters**
+            
+            *path*    : directory tree to scan
+
+            *pattern* : file pattern to discover
+        """
+
+        self.logger = self.createLog()
+        self.logger = logging.getLogger(__name__)
+
+        ziproots = self.findZips(path, pattern)
+        if ziproots is None:
+            return Exception
+
+        workers = int(self.catalogueWorkers) if self.catalogueWorkers else multiprocessing.cpu_count()
+        batchSize = int(self.catalogueBatch) if self.catalogueBatch else 500
+        self.logger.info('Found %i files to catalogue with %i processes', len(ziproots), workers)
+
+        db = Database(self.table_to_query, self.dbName, loghandler=self.loghandler, host=self.dbHost)
+        workerLog = os.path.join(self.logDir, self.cfg + "_" + self.starttime + "_worker{}.log")
+        failName = os.path.join(self.logDir, self.cfg + "_" + self.starttime + "_failures.csv")
+
+        start_time = time.time()
+        batch = []
+        exported = []   # every record, for catalogueExport
+        with open(failName, 'w', newline='') as f:
+            failures = csv.writer(f)
+            failures.writerow(['zipfile', 'error'])
+
+            pool = multiprocessing.Pool(workers, initializer=initCatalogueWorker, initargs=(workerLog,))
+            try:
+                results = pool.imap_unordered(functools.partial(catalogueZip, tmpDir=self.tmpDir, metaCache=self.metaCache), ziproots, chunksize=4)
+                for zipfile, record, error in results:
+                    self.count_img += 1
+                    if record is None:
+                        self.bad_img += 1
+                        failures.writerow([zipfile, error])
+                        self.logger.error('Image failed %s, due to: %s', zipfile, error)
+                    else:
+                        batch.append(record)
+                        if self.catalogueExport:
+                            exported.append(record)
+
+                    if len(batch) >= batchSize or self.count_img == len(ziproots):
+                        self.catalogueUpload(db, batch, failures)
+                        batch = []
+
+                    if self.count_img % 100 == 0 or self.count_img == len(ziproots):
+                        elapsed = time.time() - start_time
+                        left = elapsed / self.count_img * (len(ziproots) - self.count_img)
+                        self.logger.info('Catalogued %i of %i (%i failed), %.1f images/s, %i minutes left', 
+                            self.count_img, len(ziproots), self.bad_img, self.count_img / elapsed, left / 60)
+            finally:
+                pool.close()
+                pool.join()
+
+        db.removeHandler()
+
+        if self.catalogueExport:
+            writeRecords(exported, self.catalogueExport)
+            self.logger.info("The metadata of %i images was written to %s", len(exported), self.catalogueExport)
+
+        good_img = self.count_img - self.bad_img
+        self.logger.info("%i images were successfully catalogued out of %i", good_img, self.count_img)
+        if self.bad_img > 0:
+            self.logger.info("The failures are listed in %s", failName)
+
+    def catalogueUpload(self, db, batch, failures):
+        """
+        Uploads a batch of metadata for catalogue. If the batch fails, the images are 
+        uploaded one by one so that only the bad ones are lost
+
+        **Parameters**
+            
+            *db*       : database connection
+
+            *batch*    : list of Metadata.MetaRecord
+
+            *failures* : csv writer for the images that failed
+        """
+
+        if len(batch) == 0:
+            return
+
+        locations = {record.dimgname: record.location for record in batch}
+        try:
+            skipped = db.metaBatch2db(batch)
+        except Exception as e:
+            db.connection.rollback()
+            self.logger.error('Batch upload failed (%s), uploading one at a time', e)
+            skipped = []
+            for record in batch:
+                if record.sattype not in meta_columns:
+                    skipped.append(record.dimgname)
+                    continue
+                try:
+                    db.meta2db(record.asDict(), overwrite=True)
+                except Exception as e:
+                    db.connection.rollback()
+                    self.bad_img += 1
+                    failures.writerow([record.location, 'upload: ' + str(e).strip()])
+                    self.logger.error('Upload failed %s, due to: %s', record.location, e)
+
+        for dimgname in skipped:
+            self.bad_img += 1
+            failures.writerow([locations[dimgname], 'satellite type not supported in the metadata table'])
+
     def retrieve(self, zipfile):
         """
         Given a zip file name this function will: find out what satellite it is, unzip it, get instance of metadata, then 
@@ -271,17 +433,32 @@ class SigLib:
 
         self.logger.debug("Zipfile %s will unzip to %s. Granule is %s and Nested is %s", zipfile, unzipdir, granule, nested)        
 
-        # Unzip the zip file into the unzip directory
-        Util.unZip(zipfile, unzipdir)
-        self.logger.debug("Unzip ok")
-        
+        zipdir = ''     # where the files are inside the zip file
         if self.unzipdir == self.tmpDir:      # If files have been unzipped in their own subdirectory
             self.unzipdir = os.path.join(self.tmpDir, self.zipname)    # Then correct the name of unzipdir
+            zipdir = self.zipname
             if nested == 1:   # If zipfile has nested directories
                 self.unzipdir = os.path.join(self.unzipdir, self.zipname)    # Then correct the name of unzipdir
-                
-        # Parse zipfile
-        fname, imgname, sattype = Util.getFilename(self.granule, self.unzipdir, self.loghandler)
+                zipdir = self.zipname + '/' + self.zipname
+
+        # Metadata alone is read straight from the zip file, the imagery is never unzipped
+        metaOnly = self.processData2db == "1" and "1" not in {self.qualitativeProcess, self.quantitativeProcess}
+        if metaOnly:
+            zippath = Util.zipPath(os.path.join(self.scanDir, zipfile), zipdir)
+            fname, imgname, sattype = Util.getFilename(self.granule, zippath, self.loghandler)
+            if sattype == 'ASF_CEOS':   # the ASF tools only read files on disk
+                metaOnly = False
+            else:
+                self.unzipdir = zippath
+                self.logger.debug("Reading metadata from %s", zippath)
+
+        if not metaOnly:
+            # Unzip the zip file into the unzip directory
+            Util.unZip(zipfile, unzipdir)
+            self.logger.debug("Unzip ok")
+
+            # Parse zipfile
+            fname, imgname, sattype = Util.getFilename(self.granule, self.unzipdir, self.loghandler)
 
         self.fname = fname
         self.imgname = imgname
@@ -290,8 +467,9 @@ class SigLib:
         if sattype == 'SEN-1':
             self.granule = self.granule.split('.')[0]
             self.zipname = self.granule
-            os.rename(self.unzipdir, os.path.join(self.tmpDir, self.granule))
-            self.unzipdir = os.path.join(self.tmpDir, self.granule)
+            if not metaOnly:
+                os.rename(self.unzipdir, os.path.join(self.tmpDir, self.granule))
+                self.unzipdir = os.path.join(self.tmpDir, self.granule)
         
         formatter = logging.Formatter('')        
         self.loghandler.setFormatter(formatter)
@@ -308,7 +486,7 @@ class SigLib:
             self.bad_img += 1
 
         else:#begin processing data ...
-            self.sar_meta = func_timeout(300, Metadata, args=(self.granule, self.imgname, self.unzipdir, zipfile, self.sattype, self.loghandler))   # Retrieve metadata
+            self.sar_meta = func_timeout(300, Metadata, args=(self.granule, self.imgname, self.unzipdir, zipfile, self.sattype, self.loghandler, self.metaCache))   # Retrieve metadata
 
             if self.sar_meta.status != "ok":       # Meta class unsuccessful
                 self.logger.error("Creating an instance of the meta class failed, moving to next image")
@@ -342,6 +520,9 @@ class SigLib:
                     self.quantitative_mode(db, fname, imgname, zipname, sattype, granule, zipfile, unzipdir)
                     db.removeHandler()
 
+                if self.sar_meta.status == "ok" and self.sar_meta.cacheFile is not None:
+                    self.sar_meta.saveCache()   # again, with the calibration vectors used
+
                 end_time = time.time()
 
                 self.logger.info("Image Processing Time: " + str(int((end_time - start_time) / 60)) + " Minutes " + str(
@@ -423,7 +604,7 @@ class SigLib:
         os.chdir(newTmp)
             
         # Process the image
-        sar_img = func_timeout(800, Image, args=(self.fname, self.unzipdir, self.sar_meta, self.imgType, self.imgFormat, self.zipname, self.imgDir, newTmp, self.projDir, self.loghandler, self.elevation_correction))
+        sar_img = func_timeout(800, Image, args=(self.fname, self.unzipdir, self.sar_meta, self.imgType, self.imgFormat, self.zipname, self.imgDir, newTmp, self.projDir, self.loghandler, self.elevation_correction), kwargs={'bandMath': self.bandMath, 'encoding': self.encoding, 'discardLSB': self.discardLSB, 'multilook': self.multilook, 'stretch': self.stretch, 'stretchFormat': self.stretchFormat, 'dem': self.dem, 'memLimit': self.memIntermediates, 'tmpBudget': self.tmpBudget, 'speckle': self.speckle})
 
         if sar_img.status == "error":
             self.logger.error("Image could not be opened or manipulated, moving to next image")
@@ -432,47 +613,50 @@ class SigLib:
             self.bad_img += 1
             
         else:
-            try:    
-                if self.imgType == 'amp':
-                    ok = sar_img.projectImg(self.proj, self.projSRID, resample='bilinear')
-                else:  # no smoothing for quantitative images
-                    ok = sar_img.projectImg(self.proj, self.projSRID, resample='near')
-            except:
-                self.logger.error('ERROR: Issue with projection... will stop projecting this img')
-                self.issueString += "\n\nWARNING (image projection): " + zipfile
-                return Exception
-
-            if ok != 0: # trap errors here
-                self.logger.error('ERROR: Issue with projection... will stop projecting this img')
-                self.issueString += "\n\nWARNING (image projection): " + zipfile
-                       
-            self.logger.debug('Image projected ok')   
-
-            if self.crop:
-                self.logger.debug("Image Crop")
-                sar_img.cropImg([list(map(float, self.crop.split(" ")[:2])), list(map(float, self.crop.split(" ")[2:]))], 'crop')
-                self.logger.debug("Cropping complete")
-   
-            try: 
-                sar_img.vrt2RealImg()
-                self.logger.debug('Image convert vrt to real ok')
-            except:
-                self.logger.error("Issue converting from vrt to real image")
-                self.issueString += "\n\nWARNING (vrt2real): " + zipfile
-                self.bad_img += 1
-  
-            if self.mask != '':     #If providing a mask, mask
-                sar_img.maskImg(self.mask, self.vectDir, 'outside') 
-            
-            #if self.imgType == 'amp':                                  
-            #	stats = sar_img.getImgStats()
-            #	sar_img.applyStretch(stats, procedure='std', sd=3, sep=True)
-            #	self.logger.debug('Image stretch ok')
-            
-            sar_img.compress()
-            sar_img.makePyramids()
-            self.logger.debug('Image pyramid ok')
-            shutil.copy(os.path.join(newTmp, sar_img.FileNames[-1]), self.imgDir)
+            for imgType in sar_img.imgTypes:   # each product written by Image
+                sar_img.selectProduct(imgType)
+                try:    
+                    if imgType == 'amp':
+                        ok = sar_img.projectImg(self.proj, self.projSRID, resample='bilinear')
+                    else:  # no smoothing for quantitative images
+                        ok = sar_img.projectImg(self.proj, self.projSRID, resample='near')
+                except:
+                    self.logger.error('ERROR: Issue with projection... will stop projecting this img')
+                    self.issueString += "\n\nWARNING (image projection): " + zipfile
+                    return Exception
+
+                if ok != 0: # trap errors here
+                    self.logger.error('ERROR: Issue with projection... will stop projecting this img')
+                    self.issueString += "\n\nWARNING (image projection): " + zipfile
+                           
+                self.logger.debug('Image projected ok')   
+
+                if self.crop:
+                    self.logger.debug("Image Crop")
+                    sar_img.cropImg([list(map(float, self.crop.split(" ")[:2])), list(map(float, self.crop.split(" ")[2:]))], 'crop')
+                    self.logger.debug("Cropping complete")
+       
+                try: 
+                    sar_img.vrt2RealImg()
+                    self.logger.debug('Image convert vrt to real ok')
+                except:
+                    self.logger.error("Issue converting from vrt to real image")
+                    self.issueString += "\n\nWARNING (vrt2real): " + zipfile
+                    self.bad_img += 1
+      
+                if self.mask != '':     #If providing a mask, mask
+                    sar_img.maskImg(self.mask, self.vectDir, 'outside') 
+                
+                #if imgType == 'amp':                                  
+                #	stats = sar_img.getImgStats()
+                #	sar_img.applyStretch(stats, procedure='std', sd=3, sep=True)
+                #	self.logger.debug('Image stretch ok')
+                
+                sar_img.compress(self.imgDir)  # final product is written straight to imgDir
+                sar_img.makePyramids()
+                self.logger.debug('Image pyramid ok')
+                sar_img.retireFiles(['nil', 'stretch', 'proj', 'crop', 'subset'])  # deleted once no other product needs them
+            sar_img.artifacts.report()
             sar_img.removeHandler()
             self.sar_meta.removeHandler()
         print("Quatlitative Mode Complete.")
@@ -512,11 +696,11 @@ class SigLib:
         os.chdir(newTmp)
         
         # Process the image
-        sar_img = func_timeout(600, Image, args=(self.fname, self.unzipdir, self.sar_meta, self.imgType, self.imgFormat, self.zipname, self.imgDir, newTmp, self.projDir, self.loghandler))
+        sar_img = func_timeout(600, Image, args=(self.fname, self.unzipdir, self.sar_meta, self.imgType, self.imgFormat, self.zipname, self.imgDir, newTmp, self.projDir, self.loghandler), kwargs={'bandMath': self.bandMath, 'encoding': self.encoding, 'discardLSB': self.discardLSB, 'multilook': self.multilook, 'stretch': self.stretch, 'stretchFormat': self.stretchFormat, 'dem': self.dem, 'memLimit': self.memIntermediates, 'tmpBudget': self.tmpBudget, 'speckle': self.speckle})
 
         if sar_img.status == "error":
             self.logger.error("Image could not be opened or manipulated, moving to next image")
-            os.remove(sar_img.tifname)
+            sar_img.cleanFiles(levels=['nil'])
             self.issueString += "\n\nError (image processing): " + zipfile
             self.bad_img += 1
             return
@@ -529,54 +713,56 @@ class SigLib:
             self.logger.error('No instances!')
             return
 
-        sar_img.tmpFiles = sar_img.FileNames
-
         for i, inst in enumerate(instances):
 
-            sar_img.FileNames = sar_img.tmpFiles   #reset list of filenames within Image.py each loop
-
             self.logger.debug('Processing '+ str(inst) + ' : ' + str(i+1) + ' of ' + str(len(instances)) + ' subsets')
 
-            #PROJECT
-            if self.imgType == 'amp':
-                ok = sar_img.projectImg(self.proj, self.projSRID, resample='bilinear')
-            else:  # no smoothing for quantitative_mode images
-                ok = sar_img.projectImg(self.proj, self.projSRID, resample='near')
-
-            if ok != 0: # trap errors here 
-                self.logger.error('ERROR: Issue with projection... will stop processing this img')
-                sar_img.cleanFiles(levels=['nil','proj']) 
-                continue
-            #Issues with qry crop zone for sentinel-1
-            crop = db.qryCropZone(granule, self.roi, self.spatialrel, inst, self.table_to_query, srid=self.projSRID) 
-            ok = sar_img.cropImg(crop, inst)
-            if ok != 0: # trap errors here 
-                self.logger.error('ERROR: Issue with cropping... will stop processing this subset')
-                sar_img.cleanFiles(['nil', 'proj', 'crop'])
-                continue
-
-            sar_img.vrt2RealImg(inst)
-            
-            ### MASK
-            maskwkt = db.qryMaskZone(granule, self.roi, self.roiProjSRID, inst, self.table_to_query)
-            if self.proj == '':
-                Util.wkt2shp('instmask'+str(inst), newTmp, self.projSRID, self.projDir, maskwkt, projFile=False)
-            else:
-                Util.wkt2shp('instmask'+str(inst), newTmp, self.proj, self.projDir, maskwkt, projFile=True)
-            sar_img.maskImg('instmask'+str(inst), newTmp, 'outside')
-            sep = 'sep'
-                
-            if self.uploadData == '1':  
-                for i, bandName in enumerate(sar_img.bandNames):
-                    band = i+1
-                    imgData = sar_img.getBandData(band)                    
-                    db.imgData2db(imgData, bandName, inst, sar_img.meta.dimgname, self.granule)  # self.granule or could be zipname
-            else:
-                #stats = sar_img.getImgStats(save_stats = True)
-                #sar_img.applyStretch(stats, procedure='std', sd=3, sep=sep, inst=inst)
-            shutil.copy(os.path.join(newTmp, sar_img.FileNames[-1]), self.imgDir)
-            #sar_img.cleanFiles(levels=['proj', 'crop'])
+            for imgType in sar_img.imgTypes:   # each product written by Image
 
+                sar_img.selectProduct(imgType)   #reset list of filenames within Image.py each loop
+
+                #PROJECT
+                if imgType == 'amp':
+                    ok = sar_img.projectImg(self.proj, self.projSRID, resample='bilinear')
+                else:  # no smoothing for quantitative_mode images
+                    ok = sar_img.projectImg(self.proj, self.projSRID, resample='near')
+
+                if ok != 0: # trap errors here 
+                    self.logger.error('ERROR: Issue with projection... will stop processing this img')
+                    sar_img.cleanFiles(levels=['nil','proj']) 
+                    continue
+                #Issues with qry crop zone for sentinel-1
+                crop = db.qryCropZone(granule, self.roi, self.spatialrel, inst, self.table_to_query, srid=self.projSRID) 
+                ok = sar_img.cropImg(crop, inst)
+                if ok != 0: # trap errors here 
+                    self.logger.error('ERROR: Issue with cropping... will stop processing this subset')
+                    sar_img.cleanFiles(['nil', 'proj', 'crop'])
+                    continue
+
+                sar_img.vrt2RealImg(inst, outdir=self.imgDir)  # final product is written straight to imgDir
+                
+                ### MASK
+                maskDir = Util.vsimemDir if self.memIntermediates else newTmp
+                maskwkt = db.qryMaskZone(granule, self.roi, self.roiProjSRID, inst, self.table_to_query)
+                if self.proj == '':
+                    Util.wkt2shp('instmask'+str(inst), maskDir, self.projSRID, self.projDir, maskwkt, projFile=False)
+                else:
+                    Util.wkt2shp('instmask'+str(inst), maskDir, self.proj, self.projDir, maskwkt, projFile=True)
+                sar_img.maskImg('instmask'+str(inst), maskDir, 'outside')
+                sep = 'sep'
+                    
+                if self.uploadData == '1':  
+                    for j, bandName in enumerate(sar_img.bandNames):
+                        band = j+1
+                        imgData = sar_img.getBandData(band)                    
+                        db.imgData2db(imgData, bandName, inst, sar_img.meta.dimgname, self.granule)  # self.granule or could be zipname
+                #else:
+                    #stats = sar_img.getImgStats(save_stats = True)
+                    #sar_img.applyStretch(stats, procedure='std', sd=3, sep=sep, inst=inst)
+                sar_img.retireFiles(['proj', 'crop'])   # this subset is done
+
+        sar_img.retireFiles(['nil', 'stretch'], allProducts=True)
+        sar_img.artifacts.report()
         self.logger.debug('Intermediate file cleanup done')
         sar_img.removeHandler()
         print("Quantitative Mode Complete.")
@@ -617,8 +803,10 @@ class SigLib:
                         
             self.query_mode(db, query_methods[ans])
         
-        #TODO - make sure that there is a way to run siglib for upload meta only (without making images)
-        if self.qualitativeProcess == "1" or self.quantitativeProcess == "1":
+        metaOnly = self.processData2db == "1" and "1" not in {self.qualitativeProcess, self.quantitativeProcess}
+        if metaOnly and self.scanPath == "1":
+            self.catalogue(self.scanDir, self.scanFor)      # Metadata upload alone, in parallel
+        elif "1" in {self.processData2db, self.qualitativeProcess, self.quantitativeProcess}:
             if self.scanPath == "1":
                 self.proc_Dir(self.scanDir, self.scanFor)      # Scan by path pattern
             elif self.scanFile == "1":
@@ -629,6 +817,78 @@ class SigLib:
                 print("\nPlease specify one method to scan the data in the config file.\n")
                 
 
+def initCatalogueWorker(logName):
+    """
+    Sets up the log of a SigLib.catalogue worker process
+
+    **Parameters**
+        
+        *logName* : log file name, {} is replaced with the process id
+    """
+
+    global workerHandler
+    workerHandler = logging.FileHandler(logName.format(os.getpid()))
+    workerHandler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+def catalogueZip(zipfile, tmpDir, metaCache=''):
+    """
+    Reads the metadata of one zip file for SigLib.catalogue, in a worker process. The 
+    metadata is read from the zip file without unzipping it (except ASF, see retrieve)
+
+    **Parameters**
+        
+        *zipfile* : zip file with full path
+
+        *tmpDir*  : where ASF zip files are unzipped
+
+        *metaCache* : directory of cached metadata (see Metadata.saveCache), '' for none
+
+    **Returns**
+
+        *zipfile*  : the zip file
+
+        *record*   : the fields of the metadata table (Metadata.MetaRecord), None if it failed
+
+        *error*    : why it failed
+    """
+
+    path = None
+    try:
+        unzipdir, zipname, nested, granule = Util.getZipRoot(zipfile, tmpDir)
+        zipdir = ''     # where the files are inside the zip file
+        if unzipdir == tmpDir:
+            zipdir = zipname
+            if nested == 1:
+                zipdir = zipname + '/' + zipname
+
+        path = Util.zipPath(zipfile, zipdir)
+        fname, imgname, sattype = Util.getFilename(granule, path, workerHandler)
+        if fname == "error":
+            return zipfile, None, "file not valid or available"
+
+        if sattype == 'ASF_CEOS':   # the ASF tools only read files on disk
+            Util.unZip(zipfile, unzipdir)
+            path = os.path.join(tmpDir, zipdir or zipname)
+        if sattype == 'SEN-1':
+            granule = granule.split('.')[0]
+
+        meta = func_timeout(300, Metadata, args=(granule, imgname, path, zipfile, sattype, workerHandler, metaCache))
+        meta.removeHandler()
+        if meta.status != "ok":
+            return zipfile, None, "metadata: " + meta.status
+
+        return zipfile, meta.createRecord(), None
+
+    except FunctionTimedOut:
+        return zipfile, None, "metadata: timed out"
+    except Exception as e:
+        return zipfile, None, str(e)
+    finally:
+        Util.datasetCache.clear()
+        if path is not None and not path.startswith('/vsizip/'):
+            shutil.rmtree(os.path.join(tmpDir, zipname), ignore_errors=True)
+
+
 if __name__ == "__main__":   
     SigLib().run()
     
@@ -23,8 +23,20 @@ from osgeo import gdal
 from osgeo import osr
 from osgeo import ogr
 import shlex
+import collections
+import errno
+import mmap
+import hashlib
+import struct
+import contextlib
+import re
 import numpy      
 
+try:
+    import numexpr  # optional, evaluates band math without temporary arrays
+except ImportError:
+    numexpr = None
+
 #KEEP    
 def getFilename(zipname, unzipdir, loghandler=None):
     """
@@ -57,7 +69,8 @@ def getFilename(zipname, unzipdir, loghandler=None):
         logger.setLevel(logging.DEBUG)
         logger.addHandler(logging.StreamHandler())
         
-    dirlist = os.listdir(unzipdir)      # List of all the files in zip_file to be used as the loop iterative element
+    dirlist = listDir(unzipdir)      # List of all the files in zip_file to be used as the loop iterative element
+    inZip = splitZipPath(unzipdir)[0] is not None  # read in place, the CEOS files keep their names (see Metadata.getCEOSmetafile)
     countdown = len(dirlist)            # Number of files in zip_file to be used as a counter inside the loop
     
     for file in dirlist:
@@ -78,26 +91,30 @@ def getFilename(zipname, unzipdir, loghandler=None):
             fname = imgname+".img"
             sattype = "CDPF"
             # Look for leader file, then deal with *.trl and *.img
-            if os.path.isfile(os.path.join(unzipdir,imgname+".sarl")):
-                os.rename(os.path.join(unzipdir,imgname+".sarl"), os.path.join(unzipdir,imgname+".led"))
+            if fileExists(os.path.join(unzipdir,imgname+".sarl")):
+                if not inZip:
+                    os.rename(os.path.join(unzipdir,imgname+".sarl"), os.path.join(unzipdir,imgname+".led"))
 
             else:
                 logger.error("No file named *.sarl found")
                 return "error", "error", "error"
 
-            if os.path.isfile(os.path.join(unzipdir,imgname+".sart")):
-                os.rename(os.path.join(unzipdir,imgname+".sart"), os.path.join(unzipdir,imgname+".trl"))
+            if fileExists(os.path.join(unzipdir,imgname+".sart")):
+                if not inZip:
+                    os.rename(os.path.join(unzipdir,imgname+".sart"), os.path.join(unzipdir,imgname+".trl"))
 
             else:
                 logger.error("could not find a trailer file")
                 return "error", "error", "error"
 
-            if os.path.isfile(os.path.join(unzipdir,imgname+".sard")):
-                os.rename(os.path.join(unzipdir,imgname+".sard"), os.path.join(unzipdir,imgname+".img"))
+            if fileExists(os.path.join(unzipdir,imgname+".sard")):
+                if not inZip:
+                    os.rename(os.path.join(unzipdir,imgname+".sard"), os.path.join(unzipdir,imgname+".img"))
 
             # Special case for im_radar*.zip files that have *01f.sard name
-            elif os.path.isfile(os.path.join(unzipdir,imgname+"01f.sard")):
-                os.rename(os.path.join(unzipdir,imgname+"01f.sard"), os.path.join(unzipdir,imgname+".img"))
+            elif fileExists(os.path.join(unzipdir,imgname+"01f.sard")):
+                if not inZip:
+                    os.rename(os.path.join(unzipdir,imgname+"01f.sard"), os.path.join(unzipdir,imgname+".img"))
 
             else:
                 logger.error("could not find a CIS CEOS data file named *.sard")
@@ -242,6 +259,235 @@ def unZip(zip_file, unzipdir, ext='all'):
 
     zip.close()
 
+
+#KEEP
+def zipPath(zip_file, member=''):
+    """
+    Name a file or directory inside a zip file so that it can be read in place: GDAL 
+    opens it as is (/vsizip/) and listDir, fileExists, fileSize and openFile understand it
+
+    **Parameters**
+        
+        *zip_file* : Name of a zip file - with extension
+
+    **Optional**
+
+        *member*   : file or directory in the zip file ('' for the top)
+
+    **Returns**
+        
+        *path*     : /vsizip/ path to the member 
+    """
+
+    return ('/vsizip/' + os.path.abspath(zip_file) + '/' + member.replace(os.sep, '/')).rstrip('/')
+
+
+#KEEP
+def splitZipPath(fname):
+    """
+    Split a path from zipPath into the zip file and the member in it
+    
+    **Parameters**
+        
+        *fname*    : a path, on disk or in a zip file
+
+    **Returns**
+        
+        *zip_file* : the zip file or None if fname is not in one
+
+        *member*   : the name of the file in the zip file (fname if not in one)
+    """
+
+    match = re.match(r'/vsizip/(.+?\.zip)(?:[/\\](.*))?$', fname, re.IGNORECASE)
+    if match is None:
+        return None, fname
+    return match.group(1), (match.group(2) or '').replace('\\', '/').rstrip('/')
+
+
+#KEEP
+def listDir(path):
+    """
+    List a directory like os.listdir, path can also be a directory in a zip file (see zipPath)
+    
+    **Parameters**
+        
+        *path*     : directory to list
+
+    **Returns**
+        
+        *names*    : names of the files and directories in path
+    """
+
+    zip_file, member = splitZipPath(path)
+    if zip_file is None:
+        return os.listdir(path)
+
+    prefix = member + '/' if member else ''
+    names = []
+    with zipfile.ZipFile(zip_file) as zip:
+        for name in zip.namelist():
+            if name.startswith(prefix) and name != prefix:
+                name = name[len(prefix):].split('/')[0]
+                if name not in names:
+                    names.append(name)
+    return names
+
+
+#KEEP
+def fileExists(fname):
+    """
+    os.path.isfile for a path on disk or in a zip file (see zipPath)
+    
+    **Parameters**
+        
+        *fname*    : file to look for
+    """
+
+    zip_file, member = splitZipPath(fname)
+    if zip_file is None:
+        return os.path.isfile(fname)
+    with zipfile.ZipFile(zip_file) as zip:
+        return member in zip.namelist()
+
+
+#KEEP
+def fileSize(fname):
+    """
+    Size (bytes) of a file on disk or (uncompressed) in a zip file (see zipPath)
+    
+    **Parameters**
+        
+        *fname*    : file name
+    """
+
+    zip_file, member = splitZipPath(fname)
+    if zip_file is None:
+        return os.path.getsize(fname)
+    with zipfile.ZipFile(zip_file) as zip:
+        return zip.getinfo(member).file_size
+
+
+#KEEP
+def openFile(fname):
+    """
+    Open a file for binary reading, on disk or in a zip file (see zipPath). Members of a 
+    zip file are streamed from it: they are never extracted and only decompressed as far 
+    as they are read
+    
+    **Parameters**
+        
+        *fname*    : file name
+
+    **Returns**
+        
+        *fp*       : file object, seek works but going back in a zip member is slow
+    """
+
+    zip_file, member = splitZipPath(fname)
+    if zip_file is None:
+        return open(fname, 'rb')
+    zip = zipfile.ZipFile(zip_file)
+    fp = zip.open(member)       # keeps the zip file open until fp is closed
+    zip.close()
+    return fp
+
+
+#KEEP
+@contextlib.contextmanager
+def mapFile(fname):
+    """
+    The whole of a file as a read-only buffer, for use in a with statement. A file on 
+    disk or stored (not compressed) in a zip file (see zipPath) is memory mapped, so only 
+    the pages used are read. A compressed zip file member is read into memory. Views of 
+    the buffer (eg. numpy.frombuffer) must be gone before the with statement ends
+    
+    **Parameters**
+        
+        *fname*    : file name
+
+    **Returns**
+        
+        *buf*      : mmap, memoryview (of the zip file) or bytes
+    """
+
+    zip_file, member = splitZipPath(fname)
+    if zip_file is not None:
+        with zipfile.ZipFile(zip_file) as zip:
+            info = zip.getinfo(member)
+            if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1 or info.file_size == 0:
+                yield zip.read(member)
+                return
+
+        with open(zip_file, 'rb') as fp:
+            fp.seek(info.header_offset + 26)     # the local header ends with the name and extra field
+            name_length, extra_length = struct.unpack('<HH', fp.read(4))
+            start = info.header_offset + 30 + name_length + extra_length
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(buf)[start:start + info.file_size]
+            try:
+                yield view
+            finally:
+                view.release()
+                buf.close()
+        return
+
+    with open(fname, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:   # can't map an empty file
+            yield b''
+            return
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+
+#KEEP
+def zipKey(zip_file):
+    """
+    A key for the contents of a zip file that is quick to make: its size, modification 
+    time and a hash of its table of contents (names, sizes and CRCs of the members)
+    
+    **Parameters**
+        
+        *zip_file* : Name of a zip file - with extension
+
+    **Returns**
+        
+        *key*      : hex digest
+    """
+
+    stat = os.stat(zip_file)
+    digest = hashlib.sha1(repr((stat.st_size, stat.st_mtime_ns)).encode())
+    with zipfile.ZipFile(zip_file) as zip:
+        for info in zip.infolist():
+            digest.update(repr((info.filename, info.file_size, info.CRC)).encode())
+    return digest.hexdigest()
+
+
+#KEEP
+def findFile(stem, exts):
+    """
+    The first of stem + ext that exists (on disk or in a zip file), for files that 
+    come with one of several extensions
+    
+    **Parameters**
+        
+        *stem*     : path and name without extension
+
+        *exts*     : the possible extensions, most likely first
+
+    **Returns**
+        
+        *fname*    : the file found, stem + exts[0] if there is none
+    """
+
+    for ext in exts:
+        if fileExists(stem + ext):
+            return stem + ext
+    return stem + exts[0]
+
+
 #KEEP    
 def wktpoly2pts(wkt, bbox=False):
     """
@@ -443,7 +689,10 @@ def wkt2shp(shpname, vectdir, proj, projdir, wkt, projFile=False):
 
     extlist = ['.shp', '.dbf','.prj','.shx']
     #first delete any shapefiles that might be old so they can be overwriten
-    if os.path.isfile(os.path.join(vectdir, shpname+'.shp')):  # if shp, assume they are all around...
+    if isMemFile(vectdir):
+        if gdal.VSIStatL(os.path.join(vectdir, shpname+'.shp')) is not None:
+            driver.DeleteDataSource(os.path.join(vectdir, shpname+'.shp'))
+    elif os.path.isfile(os.path.join(vectdir, shpname+'.shp')):  # if shp, assume they are all around...
         try:
             for ext in extlist:
                 os.remove(os.path.join(vectdir, shpname+ext))  #Must remove because it won't overwrite!
@@ -467,42 +716,56 @@ def wkt2shp(shpname, vectdir, proj, projdir, wkt, projFile=False):
 
 #KEEP
 def interpolate_biquadratic(P_corr, Pixels, Lines, x_matrix, y_matrix, z_matrix):
-    x, y, z = numpy.empty(P_corr.shape), numpy.empty(P_corr.shape), numpy.empty(P_corr.shape)
-    N,M = P_corr.shape
-    for l in range(N):
-        if l < 0.5:
-            v = 1
-        elif l >= N-1.5:
-            v = N - 2
-        else:
-            v = l
-        for p in range(M):
-            if p < 0.5:
-                u = 1
-            elif p >= M-1.5:
-                u = M-2
-            else:
-                u = p
-
-            P = numpy.matrix([[P_corr[l][p]**2], [P_corr[l][p]], [1]])
-            L = numpy.matrix([[Lines[l][p]**2], [Lines[l][p]], [1]])
-            U = numpy.matrix([[(u-1)**2, u-1, 1],[u**2, u , 1],[(u+1)**2, u+1 , 1]])
-            V = numpy.matrix([[(v-1)**2, v-1, 1],[v**2, v , 1],[(v+1)**2, v+1 , 1]])
-            X = numpy.matrix([
-                    [x_matrix[v-1][u-1], x_matrix[v-1][u], x_matrix[v-1][u+1]],
-                    [x_matrix[v][u-1], x_matrix[v][u], x_matrix[v][u+1]],
-                    [x_matrix[v+1][u-1], x_matrix[v+1][u], x_matrix[v+1][u+1]]])
-            Y = numpy.matrix([
-                    [y_matrix[v-1][u-1], y_matrix[v-1][u], y_matrix[v-1][u+1]],
-                    [y_matrix[v][u-1], y_matrix[v][u], y_matrix[v][u+1]],
-                    [y_matrix[v+1][u-1], y_matrix[v+1][u], y_matrix[v+1][u+1]]])
-            Z = numpy.matrix([
-                    [z_matrix[v-1][u-1], z_matrix[v-1][u], z_matrix[v-1][u+1]],
-                    [z_matrix[v][u-1], z_matrix[v][u], z_matrix[v][u+1]],
-                    [z_matrix[v+1][u-1], z_matrix[v+1][u], z_matrix[v+1][u+1]]])
-            x[l][p] = numpy.transpose(L) * numpy.linalg.inv(V) * X * numpy.transpose(numpy.linalg.inv(U)) * P
-            y[l][p] = numpy.transpose(L) * numpy.linalg.inv(V) * Y * numpy.transpose(numpy.linalg.inv(U)) * P
-            z[l][p] = numpy.transpose(L) * numpy.linalg.inv(V) * Z * numpy.transpose(numpy.linalg.inv(U)) * P
+    """
+    Biquadratic interpolation of x, y, z grids (N x M) at the positions P_corr (pixel) 
+    and Lines (line), in tie point grid units. Each point uses the 3 x 3 neighbourhood 
+    of its own grid node (moved in by one at the edges): L' inv(V) X inv(U)' P where U and 
+    V are the quadratic Vandermonde matrices of the neighbourhood.
+
+    U and V only depend on the integer node positions, so their inverses are made once 
+    for the whole grid and the interpolation of all points is done with einsum.
+    
+    **Parameters**
+        
+        *P_corr*   : N x M pixel positions to interpolate at
+
+        *Pixels*   : N x M grid pixel positions (not used, kept for the call signature)
+
+        *Lines*    : N x M line positions to interpolate at
+
+        *x_matrix, y_matrix, z_matrix* : N x M grids to interpolate
+
+    **Returns**
+
+        *x, y, z*  : N x M interpolated values
+    """
+
+    N, M = P_corr.shape
+
+    # centre node of the 3 x 3 neighbourhood of each row/column
+    v = numpy.clip(numpy.arange(N), 1, N-2)
+    u = numpy.clip(numpy.arange(M), 1, M-2)
+
+    def vandermondeInv(centres):
+        pos = centres[:, None] + numpy.array([-1, 0, 1])      # (n, 3) node positions
+        vander = numpy.stack([pos**2, pos, numpy.ones_like(pos)], axis=-1).astype(float)
+        return numpy.linalg.inv(vander)                     # (n, 3, 3)
+
+    Vinv = vandermondeInv(v)     # one per row
+    Uinv = vandermondeInv(u)     # one per column
+
+    Lvec = numpy.stack([Lines**2, Lines, numpy.ones_like(Lines)], axis=-1)       # (N, M, 3)
+    Pvec = numpy.stack([P_corr**2, P_corr, numpy.ones_like(P_corr)], axis=-1)    # (N, M, 3)
+    a = numpy.einsum('lpi,lij->lpj', Lvec, Vinv)     # L' inv(V)
+    b = numpy.einsum('pmk,lpm->lpk', Uinv, Pvec)     # inv(U)' P
+
+    # 3 x 3 neighbourhoods of x, y and z at every point (3, N, M, 3, 3)
+    rows = (v[:, None] + numpy.array([-1, 0, 1]))[:, None, :, None]
+    cols = (u[:, None] + numpy.array([-1, 0, 1]))[None, :, None, :]
+    grids = numpy.stack([x_matrix, y_matrix, z_matrix])
+    blocks = grids[:, rows, cols]
+
+    x, y, z = numpy.einsum('lpj,clpjk,lpk->clp', a, blocks, b)
     return x, y, z
 
 #KEEP
@@ -551,3 +814,902 @@ def cartesian_to_geographic(x, y, z, a, b):
     lat = numpy.arctan((a*z)/(b*numpy.sqrt(b**2-z**2)))
     lng = numpy.arctan2(y,x)
     return numpy.degrees(lat), numpy.degrees(lng)
+
+# functions that can be used in band math (same names as numexpr)
+bandMathFunctions = {
+    'log10' : numpy.log10,
+    'log' : numpy.log,
+    'exp' : numpy.exp,
+    'sqrt' : numpy.sqrt,
+    'abs' : numpy.abs,
+    'where' : numpy.where,
+    'sin' : numpy.sin,
+    'cos' : numpy.cos,
+    'tan' : numpy.tan,
+    'arctan2' : numpy.arctan2,
+    }
+
+#KEEP
+def parseBandMath(text):
+    """
+    Parses the band math entry of the config file into a list of expressions. 
+    Expressions are separated by semicolons and each one is given a name:
+    
+        sigma_HH_dB = 10*log10(sigma_HH); ratio = sigma_HH/sigma_HV
+
+    **Parameters**
+        
+        *text*  : band math string from the config file
+
+    **Returns**
+
+        *exprs* : list of (name, expression) tuples
+    """
+
+    exprs = []
+    for item in text.split(';'):
+        if item.strip() == '':
+            continue
+        if '=' not in item:
+            raise ValueError('Band math needs a name for each expression: ' + item.strip())
+        name, expr = item.split('=', 1)
+        exprs.append((name.strip(), expr.strip()))
+    return exprs
+
+#KEEP
+def bandMathNames(expr):
+    """
+    Returns the names of the bands (variables) used in a band math expression
+    
+    **Parameters**
+        
+        *expr* : a band math expression (eg. sigma_HH/sigma_HV)
+    """
+
+    names = re.findall(r'[A-Za-z_][A-Za-z0-9_]*', expr)
+    return [name for name in names if name not in bandMathFunctions]
+
+#KEEP
+def evalBandMath(expr, bandData, noDataVal=0):
+    """
+    Evaluates a band math expression on a chunk of image data. numexpr is used if it
+    is installed (no temporary arrays, multithreaded), numpy otherwise.
+    
+    Pixels where any of the bands used are noDataVal, or where the result is not 
+    finite (log of 0, division by 0...) are set to noDataVal
+
+    **Parameters**
+        
+        *expr*      : a band math expression (eg. sigma_HH/sigma_HV)
+
+        *bandData*  : dictionary of band name: data chunk
+
+        *noDataVal* : nodata value of the bands and the result
+
+    **Returns**
+
+        *result*    : float32 array the size of the data chunk
+    """
+
+    names = bandMathNames(expr)
+    missing = [name for name in names if name not in bandData]
+    if missing:
+        raise KeyError('Band math uses unknown band(s): ' + ', '.join(missing))
+    local = dict((name, bandData[name]) for name in names)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        if numexpr is not None:
+            result = numexpr.evaluate(expr, local_dict=local)
+        else:
+            local.update(bandMathFunctions)
+            result = eval(expr, {'__builtins__': {}}, local)
+
+    result = numpy.asarray(result, dtype=numpy.float32)
+    invalid = ~numpy.isfinite(result)
+    for name in names:
+        invalid |= bandData[name] == noDataVal
+    result[invalid] = noDataVal
+    return result
+
+#KEEP
+def histKeys(data):
+    """
+    Histogram bin (0-65535) of each value of an array: the upper 16 bits of the float32 
+    value (sign, exponent and 7 bits of mantissa) reordered so that bins sort like the 
+    values. Bins are < 1% of the value wide over any range, so the same 65536 bins work 
+    for amplitudes, sigma, dB, angles etc. without knowing the range ahead of time
+
+    **Parameters**
+        
+        *data* : array of values
+
+    **Returns**
+
+        *keys* : uint16 array of bins, same shape as data
+    """
+
+    bits = numpy.ascontiguousarray(data, dtype=numpy.float32).view(numpy.uint32) >> 16
+    keys = numpy.where(bits >= 0x8000, 0xFFFF - bits, bits | 0x8000)
+    return keys.astype(numpy.uint16)
+
+#KEEP
+def histValues(keys):
+    """
+    The value at the middle of histogram bin(s) made by histKeys
+
+    **Parameters**
+        
+        *keys* : bin or array of bins
+    """
+
+    keys = numpy.asarray(keys, dtype=numpy.uint32)
+    bits = numpy.where(keys >= 0x8000, keys & 0x7FFF, 0xFFFF - keys).astype(numpy.uint32)
+    return ((bits << 16) | 0x8000).view(numpy.float32)
+
+#KEEP
+def histPercentile(hist, pct):
+    """
+    Percentile(s) of the data from a histogram made with histKeys
+    
+    **Parameters**
+        
+        *hist* : counts per bin (65536)
+
+        *pct*  : percentile or list of percentiles (0-100)
+
+    **Returns**
+
+        *vals* : value(s) at the percentile(s), numpy.nan if the histogram is empty
+    """
+
+    cumulative = numpy.cumsum(hist)
+    total = cumulative[-1]
+    if total == 0:
+        return numpy.full(numpy.shape(pct), numpy.nan)
+    index = numpy.searchsorted(cumulative, numpy.asarray(pct, dtype=float)/100.0 * total)
+    index = numpy.clip(index, 0, len(hist)-1)
+    return histValues(index).astype(float)
+
+#KEEP
+def validMask(data, noDataVal=0):
+    """
+    Boolean mask of the valid pixels of a chunk: not noDataVal and (for float data) finite. 
+    Compute it once per chunk and pass it to the other nodata-aware functions 
+    (validValues, stretchChunk) rather than using masked arrays
+
+    **Parameters**
+        
+        *data*      : array
+
+        *noDataVal* : nodata value
+
+    **Returns**
+
+        *valid*     : boolean array the shape of data
+    """
+
+    valid = numpy.not_equal(data, noDataVal)
+    if numpy.issubdtype(numpy.asarray(data).dtype, numpy.floating):
+        valid &= numpy.isfinite(data)
+    return valid
+
+#KEEP
+def validValues(data, noDataVal=0, valid=None):
+    """
+    The valid pixels of a chunk as a 1D array (see validMask)
+    """
+
+    if valid is None:
+        valid = validMask(data, noDataVal)
+    return numpy.asarray(data)[valid]
+
+#KEEP
+def validStats(values):
+    """
+    Summary stats of an array of valid values (see validValues): one pass for the moments 
+    and one partition for the median and quartiles. Skew and kurtosis are the (biased) 
+    Fisher definitions, same as scipy.stats.skew/kurtosis
+
+    **Parameters**
+        
+        *values* : 1D array of valid values
+
+    **Returns**
+
+        *stats*  : dictionary of mean, var, max, min, median, quart1, quart3, skew, kurtosis
+    """
+
+    values = numpy.asarray(values, dtype=numpy.float64)
+    mean = values.mean()
+    dev = values - mean
+    sq = dev * dev
+    var = sq.mean()
+    m3 = numpy.dot(sq, dev) / values.size
+    m4 = numpy.dot(sq, sq) / values.size
+    quart1, median, quart3 = numpy.percentile(values, [25, 50, 75])
+    if var > 0:
+        skew, kurtosis = m3 / var**1.5, m4 / var**2 - 3.0
+    else:
+        skew, kurtosis = numpy.nan, numpy.nan
+    return {'mean' : mean, 'var' : var, 'max' : values.max(), 'min' : values.min(),
+            'median' : median, 'quart1' : quart1, 'quart3' : quart3, 
+            'skew' : skew, 'kurtosis' : kurtosis}
+
+#KEEP
+def stretchChunk(data, scaleRange, dynRange, minVal, offset=0, noDataVal=0, valid=None):
+    """
+    Linear stretch of a chunk to 1..scaleRange+1 with nodata kept as noDataVal. 
+    Done in place in one float32 buffer
+
+    **Parameters**
+        
+        *data*       : array to stretch (not modified)
+
+        *scaleRange* : range to scale to
+
+        *dynRange*   : range to scale from
+
+        *minVal*     : value that goes to 1
+
+        *offset*     : added to the data first (see Image.applyStretch)
+
+        *noDataVal*  : nodata value
+
+        *valid*      : validity mask of data if already computed (see validMask)
+
+    **Returns**
+
+        *out*        : float32 array of the stretched values
+    """
+
+    if valid is None:
+        valid = validMask(data, noDataVal)
+    out = numpy.array(data, dtype=numpy.float32)
+    out += offset - minVal
+    out *= scaleRange / dynRange
+    numpy.rint(out, out=out)
+    numpy.clip(out, 0, scaleRange, out=out)
+    out += 1
+    out[~valid] = noDataVal
+    return out
+
+#KEEP
+def integralImage(data, r):
+    """
+    Summed area table of data padded with r zeros all round, with a leading row and 
+    column of zeros (float64, so the sums do not lose precision), see rectSums
+    """
+
+    integral = numpy.zeros((data.shape[0]+2*r+1, data.shape[1]+2*r+1), dtype=numpy.float64)
+    integral[r+1:r+1+data.shape[0], r+1:r+1+data.shape[1]] = data
+    integral.cumsum(axis=0, out=integral)
+    integral.cumsum(axis=1, out=integral)
+    return integral
+
+#KEEP
+def rectSums(integral, shape, r, rows, cols):
+    """
+    Sum over a rectangle around each pixel, from a summed area table (see integralImage)
+
+    **Parameters**
+        
+        *integral* : summed area table of the data padded with r
+
+        *shape*    : shape of the data
+
+        *r*        : padding
+
+        *rows*     : first and last line of the rectangle (offsets from the pixel, inclusive)
+
+        *cols*     : first and last pixel of the rectangle (offsets from the pixel, inclusive)
+
+    **Returns**
+
+        *sums*     : array the shape of the data
+    """
+
+    n, m = shape
+    a, b = r + rows[0], r + rows[1] + 1
+    c, d = r + cols[0], r + cols[1] + 1
+    return integral[b:b+n, d:d+m] - integral[a:a+n, d:d+m] - integral[b:b+n, c:c+m] + integral[a:a+n, c:c+m]
+
+#KEEP
+def spanSums(prefix, shape, r, spans):
+    """
+    Sum over an arbitrary window around each pixel, made of one span of pixels per line, 
+    from the running sums along the lines of the data padded with r (see speckleFilter)
+
+    **Parameters**
+        
+        *prefix* : running sums along the lines, with a leading column of zeros
+
+        *shape*  : shape of the data
+
+        *r*      : padding
+
+        *spans*  : list of (line, first pixel, last pixel), offsets from the pixel (inclusive)
+
+    **Returns**
+
+        *sums*   : array the shape of the data
+    """
+
+    n, m = shape
+    sums = numpy.zeros(shape)
+    for dy, lo, hi in spans:
+        lines = prefix[r+dy:r+dy+n]
+        sums += lines[:, r+hi+1:r+hi+1+m]
+        sums -= lines[:, r+lo:r+lo+m]
+    return sums
+
+#KEEP
+def leeWeights(mean, meanSq, looks):
+    """
+    Weight of the pixel (vs the local mean) in the Lee filter, from the local mean and 
+    mean square of the intensity and the number of looks
+    """
+
+    cu2 = 1.0 / looks   # squared coefficient of variation of the speckle (intensity)
+    var = meanSq - mean**2
+    varx = (var - mean**2 * cu2) / (1 + cu2)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        k = numpy.where(var > 0, varx / var, 0)
+    return numpy.clip(k, 0, 1)
+
+refinedLeeWindows = {5: (3, 1), 7: (3, 2), 9: (5, 2), 11: (5, 3)}   # window: (sub-window, step)
+
+#KEEP
+def speckleFilter(data, method='lee', size=5, looks=1, noDataVal=0):
+    """
+    Speckle filter a chunk of calibrated data in the power (intensity) domain. Nodata 
+    pixels are kept and left out of the local statistics, so the edges of the chunk are 
+    filtered with the part of the window that is inside (give the chunk halo lines from 
+    its neighbours to filter it like the whole image)
+
+    * boxcar     : mean of the size x size window
+    * lee        : Lee (1980) filter, local mean and variance of the size x size window
+    * refinedlee : Lee (1981) refined filter, local statistics of the half (or triangle) 
+                   of the window on the side of the strongest edge that is most like the 
+                   centre. Sizes 5, 7, 9 or 11
+
+    **Parameters**
+        
+        *data*      : 2D array (power)
+
+        *method*    : boxcar, lee or refinedlee
+
+        *size*      : window size (odd)
+
+        *looks*     : equivalent number of looks of the data
+
+        *noDataVal* : nodata value
+
+    **Returns**
+
+        *out*       : float32 array of the filtered values
+    """
+
+    method = method.lower().replace('_', '').replace(' ', '')
+    r = size // 2
+    valid = validMask(data, noDataVal)
+    x = numpy.where(valid, data, 0).astype(numpy.float64)
+    shape = x.shape
+
+    sumX = integralImage(x, r)
+    sumX2 = integralImage(x*x, r)
+    count = integralImage(valid, r)
+
+    def windowStats(rows, cols):
+        n = rectSums(count, shape, r, rows, cols)
+        empty = n == 0
+        n[empty] = 1
+        return rectSums(sumX, shape, r, rows, cols) / n, rectSums(sumX2, shape, r, rows, cols) / n, empty
+
+    if method == 'boxcar':
+        out = windowStats((-r, r), (-r, r))[0]
+
+    elif method == 'lee':
+        mean, meanSq, empty = windowStats((-r, r), (-r, r))
+        out = mean + leeWeights(mean, meanSq, looks) * (x - mean)
+
+    elif method == 'refinedlee':
+        if size not in refinedLeeWindows:
+            raise ValueError('Refined Lee window must be one of ' + str(sorted(refinedLeeWindows)))
+        sub, step = refinedLeeWindows[size]
+        h = sub // 2
+        # 3 x 3 means of the sub-windows (an empty one, off the chunk, is like the centre)
+        centre = windowStats((-h, h), (-h, h))[0]
+        M = []
+        for i in (-1, 0, 1):
+            M.append([])
+            for j in (-1, 0, 1):
+                mean, meanSq, empty = windowStats((i*step-h, i*step+h), (j*step-h, j*step+h))
+                M[-1].append(numpy.where(empty, centre, mean))
+        gradients = numpy.stack([
+            numpy.abs(M[0][2] + M[1][2] + M[2][2] - M[0][0] - M[1][0] - M[2][0]),   # across columns
+            numpy.abs(M[2][0] + M[2][1] + M[2][2] - M[0][0] - M[0][1] - M[0][2]),   # across lines
+            numpy.abs(M[1][2] + M[2][1] + M[2][2] - M[0][0] - M[0][1] - M[1][0]),   # across the / diagonal
+            numpy.abs(M[1][0] + M[2][0] + M[2][1] - M[0][1] - M[0][2] - M[1][2])])  # across the \ diagonal
+        edge = numpy.argmax(gradients, axis=0)
+        gradients = None
+        # which side of the edge is like the centre: window 2*edge or 2*edge+1
+        first = numpy.choose(edge, [numpy.abs(M[1][0]-centre), numpy.abs(M[0][1]-centre),
+                                    numpy.abs(M[0][0]-centre), numpy.abs(M[0][2]-centre)])
+        second = numpy.choose(edge, [numpy.abs(M[1][2]-centre), numpy.abs(M[2][1]-centre),
+                                     numpy.abs(M[2][2]-centre), numpy.abs(M[2][0]-centre)])
+        window = 2*edge + (second < first)
+        M = first = second = None
+
+        # the 8 edge aligned windows: left, right, upper and lower halves, then the 
+        # triangles on either side of the diagonals (one span per line each)
+        mean = numpy.zeros(shape)
+        meanSq = numpy.zeros(shape)
+        halves = [((-r, r), (-r, 0)), ((-r, r), (0, r)), ((-r, 0), (-r, r)), ((0, r), (-r, r))]
+        for w, (rows, cols) in enumerate(halves):
+            sel = window == w
+            if sel.any():
+                m, m2 = windowStats(rows, cols)[:2]
+                mean[sel], meanSq[sel] = m[sel], m2[sel]
+        lines = range(-r, r+1)
+        triangles = [[(dy, -r, min(r, -dy)) for dy in lines], [(dy, max(-r, -dy), r) for dy in lines],
+                     [(dy, max(-r, dy), r) for dy in lines], [(dy, -r, min(r, dy)) for dy in lines]]
+        prefixes = []
+        for values in (x, x*x, valid):
+            prefix = numpy.zeros((shape[0]+2*r, shape[1]+2*r+1))
+            prefix[r:r+shape[0], r+1:r+1+shape[1]] = values
+            prefixes.append(prefix.cumsum(axis=1, out=prefix))
+        for w, spans in enumerate(triangles, 4):
+            sel = window == w
+            if sel.any():
+                s, s2, n = [spanSums(prefix, shape, r, spans) for prefix in prefixes]
+                n[n == 0] = 1
+                mean[sel], meanSq[sel] = (s/n)[sel], (s2/n)[sel]
+        out = mean + leeWeights(mean, meanSq, looks) * (x - mean)
+
+    else:
+        raise ValueError('Speckle filter ' + method + ' not supported (boxcar, lee or refinedlee)')
+
+    out = out.astype(numpy.float32)
+    out[~valid] = noDataVal
+    return out
+
+#KEEP
+class DatasetCache(object):
+    """
+    Small LRU cache of open GDAL datasets (read only), keyed by file name. 
+
+    Image and Metadata open the same files over and over (the product they just 
+    wrote, the manifest...) and each gdal.Open parses the header and loads the GCPs 
+    again. Open through datasetCache.open instead and call datasetCache.invalidate 
+    on a file before it is written, replaced or deleted. SigLib clears the cache 
+    after each granule.
+
+    **Parameters**
+        
+        *maxsize* : number of datasets to keep open
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.datasets = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, fname):
+        if fname.startswith('/vsi'):
+            return fname
+        return os.path.abspath(fname)
+
+    def open(self, fname):
+        """
+        Returns the open dataset for fname, opening it (read only) if need be. None if 
+        gdal can not open it
+        """
+
+        key = self.key(fname)
+        if key in self.datasets:
+            self.datasets.move_to_end(key)
+            self.hits += 1
+            return self.datasets[key]
+
+        self.misses += 1
+        if self.misses == 1:
+            gdal.AllRegister() # for all purposes
+        ds = gdal.Open(fname, gdal.GA_ReadOnly)
+        if ds is None:
+            return None
+        self.datasets[key] = ds
+        while len(self.datasets) > self.maxsize:
+            self.datasets.popitem(last=False)   # closes the least recently used
+        return ds
+
+    def invalidate(self, fname):
+        """
+        Closes fname if it is open (call before writing, replacing or deleting it)
+        """
+
+        self.datasets.pop(self.key(fname), None)
+
+    def clear(self):
+        """
+        Closes all the datasets
+        """
+
+        self.datasets.clear()
+
+datasetCache = DatasetCache()
+
+vsimemDir = '/vsimem/siglib'   # where in memory intermediates go (see intermediatePath)
+
+#KEEP
+def intermediatePath(fname, nbytes=0, limit=0):
+    """
+    Where to write an intermediate file: in GDAL's memory file system (/vsimem/) if it 
+    is not bigger than limit, or fname (on disk in tmpDir) if it is or limit is 0. 
+    Only GDAL (in this process) can read or write /vsimem/ files, see gdalUtil
+
+    **Parameters**
+        
+        *fname*  : name of the file on disk
+
+        *nbytes* : (estimated) size of the file, 0 for a vrt
+
+        *limit*  : largest file to keep in memory (bytes), 0 to write everything to disk
+
+    **Returns**
+
+        *path*   : /vsimem/ path or fname
+    """
+
+    if limit and nbytes <= limit:
+        return vsimemDir + '/' + os.path.basename(fname)
+    return fname
+
+#KEEP
+def isMemFile(fname):
+    """
+    True for a file in GDAL's memory file system
+    """
+
+    return fname.startswith('/vsimem/')
+
+#KEEP
+def datasetBytes(ds):
+    """
+    Uncompressed size of the raster data of a gdal dataset (bytes)
+    """
+
+    if ds is None or ds.RasterCount == 0:
+        return 0
+    bits = gdal.GetDataTypeSize(ds.GetRasterBand(1).DataType)
+    return ds.RasterXSize * ds.RasterYSize * ds.RasterCount * bits // 8
+
+#KEEP
+def removeFile(fname):
+    """
+    Deletes a file on disk or in /vsimem/
+    """
+
+    if isMemFile(fname):
+        gdal.Unlink(fname)
+    else:
+        os.remove(fname)
+
+#KEEP
+def renameFile(src, dst):
+    """
+    Renames a file on disk or in /vsimem/ (both must be on the same one)
+    """
+
+    if isMemFile(src):
+        gdal.Rename(src, dst)
+    else:
+        os.rename(src, dst)
+
+#KEEP
+def clearMemFiles():
+    """
+    Deletes all the intermediates kept in memory (call when a granule is done)
+    """
+
+    files = gdal.ReadDirRecursive(vsimemDir)
+    if files:
+        for fname in files:
+            gdal.Unlink(vsimemDir + '/' + fname)
+
+#KEEP
+def gdalUtil(utility, outname, inname, options):
+    """
+    Runs gdal_translate, gdalwarp or gdal_rasterize in this process (so /vsimem/ files 
+    can be used) with the same options as on the command line. gdal_rasterize burns into 
+    the existing raster outname, like the command line tool.
+
+    **Parameters**
+        
+        *utility* : gdal_translate, gdalwarp or gdal_rasterize
+
+        *outname* : output (raster to burn into for gdal_rasterize)
+
+        *inname*  : input (vector for gdal_rasterize)
+
+        *options* : command line options, without the file names
+
+    **Returns**
+
+        *ok*      : 0 if it worked (like the return code of the command line tool)
+    """
+
+    try:
+        if utility == 'gdal_translate':
+            ds = gdal.Translate(outname, inname, options=options)
+        elif utility == 'gdalwarp':
+            ds = gdal.Warp(outname, inname, options=options)
+        elif utility == 'gdal_rasterize':
+            ds = gdal.Open(outname, gdal.GA_Update)
+            if ds is None:
+                return 1
+            ok = gdal.Rasterize(ds, inname, options=options)
+            ds = None
+            return 0 if ok else 1
+        else:
+            raise ValueError('Not a supported gdal utility: ' + utility)
+    except RuntimeError as e:
+        logging.getLogger(__name__).error(str(e))
+        return 1
+
+    if ds is None:
+        return 1
+    ds = None   # close to flush it
+    return 0
+
+#KEEP
+def fileBytes(fname):
+    """
+    Size of a file on disk or in /vsimem/ (bytes), 0 if it does not exist
+    """
+
+    stat = gdal.VSIStatL(fname)
+    if stat is None:
+        return 0
+    return stat.size
+
+#KEEP
+class LutGrid(object):
+    """
+    A look up table given on a sparse grid of image lines and pixels (eg. the S1 
+    calibration and noise vectors), interpolated bilinearly to the full width of the 
+    image for the lines of a chunk. 
+
+    The table is interpolated in range once, for every one of its lines, so a chunk 
+    only needs a weighted sum of two of those rows per line. The last chunk is kept, 
+    the same lines are asked for again for each product made from a band.
+
+    **Parameters**
+        
+        *lines*  : image line of each row of values (increasing)
+
+        *pixels* : image pixel of each column of values (increasing)
+
+        *values* : 2D array (lines x pixels)
+
+        *n_cols* : width of the image
+    """
+
+    def __init__(self, lines, pixels, values, n_cols):
+        self.lines = numpy.asarray(lines, dtype=numpy.float64)
+        self.n_cols = n_cols
+        lower, upper, weight = interpWeights(numpy.asarray(pixels, dtype=numpy.float64), numpy.arange(n_cols))
+        values = numpy.asarray(values, dtype=numpy.float32)
+        self.rangeRows = values[:, lower] * (1 - weight) + values[:, upper] * weight
+        self.last = None   # (first_line, n_lines, rows)
+
+    def rows(self, first_line, n_lines):
+        """
+        The table for n_lines lines from first_line (float32, n_lines x n_cols)
+        """
+
+        if self.last is not None and self.last[:2] == (first_line, n_lines):
+            return self.last[2]
+
+        lower, upper, weight = interpWeights(self.lines, numpy.arange(first_line, first_line + n_lines))
+        weight = weight[:, numpy.newaxis]
+        rows = self.rangeRows[lower] * (1 - weight) + self.rangeRows[upper] * weight
+        self.last = (first_line, n_lines, rows)
+        return rows
+
+def interpWeights(nodes, points):
+    """
+    Index of the nodes below and above each point and the weight of the node above, for 
+    linear interpolation (as numpy.interp: held constant outside the nodes)
+
+    **Parameters**
+        
+        *nodes*  : increasing positions of the values
+
+        *points* : where the values are wanted
+
+    **Returns**
+
+        *lower*  : index of the node below
+
+        *upper*  : index of the node above
+
+        *weight* : float32, 0 at the node below, 1 at the node above
+    """
+
+    if len(nodes) == 1:   # the same value everywhere
+        zeros = numpy.zeros(len(points), dtype=int)
+        return zeros, zeros, numpy.zeros(len(points), dtype=numpy.float32)
+    points = numpy.clip(points, nodes[0], nodes[-1])
+    upper = numpy.searchsorted(nodes, points, side='right').clip(1, len(nodes) - 1)
+    lower = upper - 1
+    weight = (points - nodes[lower]) / (nodes[upper] - nodes[lower])
+    return lower, upper, weight.astype(numpy.float32)
+
+#KEEP
+class ArtifactRegistry(object):
+    """
+    Keeps track of the files (artifacts) written while a granule is processed: the 
+    stage that made each one, its size and the artifacts that read it (consumers, eg. 
+    a vrt reads the image it was made from). An artifact is deleted as soon as it is 
+    retired (nothing will use it directly any more) and its last consumer is gone, 
+    instead of when the granule's tmp directory is removed. 
+
+    The chain is the list of artifacts for the image being worked on (the granule 
+    first, then the product and what was made from it), what Image.FileNames returns.
+
+    **Parameters**
+        
+        *root*   : the granule (first entry of the chain, not a file)
+
+        *budget* : bytes of intermediates allowed on disk, 0 for no limit
+
+        *logger* : where to log deletions and the bytes written
+    """
+
+    def __init__(self, root, budget=0, logger=None):
+        self.root = root
+        self.budget = budget
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.artifacts = collections.OrderedDict()   # fname: record (see add)
+        self.chain = [root]
+        self.stageBytes = collections.defaultdict(int)   # stage: bytes written
+
+    def add(self, fname, stage, sources=(), final=False, chain=True):
+        """
+        Registers a file that was just written (again, if it was overwritten)
+
+        **Parameters**
+            
+            *fname*   : the file
+
+            *stage*   : what made it (nil, proj, crop, subset, stretch...)
+
+            *sources* : artifacts it reads from when it is read (for a vrt), they 
+                        are kept as long as it is
+
+            *final*   : a product (in imgDir), never deleted or counted in the budget
+
+            *chain*   : append it to the chain
+        """
+
+        if fname in self.artifacts:
+            self.unlink(fname)
+        size = fileBytes(fname)
+        self.artifacts[fname] = {'stage': stage, 'size': size, 'sources': [],
+                                 'consumers': set(), 'retired': False, 'final': final}
+        for source in sources:
+            if source in self.artifacts and source != fname:
+                self.artifacts[source]['consumers'].add(fname)
+                self.artifacts[fname]['sources'].append(source)
+        self.stageBytes[stage] += size
+        if chain and fname not in self.chain:
+            self.chain.append(fname)
+        self.logger.debug('{} written by {} ({:.1f} MB)'.format(fname, stage, size / 2.0**20))
+
+    def unlink(self, fname):
+        """
+        Forgets where fname was read from (its sources may be collected)
+        """
+
+        sources = self.artifacts[fname]['sources']
+        self.artifacts[fname]['sources'] = []
+        for source in sources:
+            if source in self.artifacts:
+                self.artifacts[source]['consumers'].discard(fname)
+                self.collect(source)
+
+    def retire(self, fname):
+        """
+        Nothing will read fname directly any more, delete it once its consumers are gone
+        """
+
+        if fname in self.artifacts:
+            self.artifacts[fname]['retired'] = True
+            self.collect(fname)
+
+    def retireStage(self, stages):
+        """
+        Retires all the artifacts made by one of the stages
+        """
+
+        for fname, record in list(self.artifacts.items()):
+            if record['stage'] in stages:
+                self.retire(fname)
+
+    def collect(self, fname):
+        """
+        Deletes fname if it is retired and nothing reads it
+        """
+
+        record = self.artifacts.get(fname)
+        if record is None or not record['retired'] or record['consumers'] or record['final']:
+            return
+        self.remove(fname)
+
+    def remove(self, fname):
+        """
+        Deletes fname now (and forgets it), whatever reads it
+        """
+
+        record = self.artifacts.pop(fname, None)
+        if fname in self.chain:
+            self.chain.remove(fname)
+        datasetCache.invalidate(fname)
+        try:
+            removeFile(fname)
+            self.logger.debug('Removed ' + fname)
+        except OSError:
+            pass
+        if record is None:
+            return
+        for consumer in record['consumers']:
+            if consumer in self.artifacts and fname in self.artifacts[consumer]['sources']:
+                self.artifacts[consumer]['sources'].remove(fname)
+        for source in record['sources']:
+            if source in self.artifacts:
+                self.artifacts[source]['consumers'].discard(fname)
+                self.collect(source)
+
+    def stage(self, fname):
+        """
+        The stage that made fname (None if it is not registered)
+        """
+
+        record = self.artifacts.get(fname)
+        return record['stage'] if record is not None else None
+
+    def diskBytes(self):
+        """
+        Bytes of intermediates on disk (not in memory and not final products)
+        """
+
+        return sum(record['size'] for fname, record in self.artifacts.items()
+                   if not record['final'] and not isMemFile(fname))
+
+    def reserve(self, nbytes):
+        """
+        Checks that nbytes more on disk fits in the budget, raises OSError (no space) if not
+        """
+
+        if not self.budget or nbytes + self.diskBytes() <= self.budget:
+            return
+        raise OSError(errno.ENOSPC, 'tmpDir budget of {:.0f} MB exceeded ({:.0f} MB in use, {:.0f} MB more needed)'.format(
+            self.budget / 2.0**20, self.diskBytes() / 2.0**20, nbytes / 2.0**20))
+
+    def report(self):
+        """
+        Logs the bytes written by each stage
+        """
+
+        for stage, nbytes in self.stageBytes.items():
+            self.logger.info('Stage {} wrote {:.1f} MB'.format(stage, nbytes / 2.0**20))
+
+    def clear(self):
+        """
+        Deletes everything that is not a final product
+        """
+
+        for fname, record in list(self.artifacts.items()):
+            if not record['final']:
+                self.remove(fname)